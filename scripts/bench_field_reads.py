@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of reading and writing the fields of generated structs, comparing the default
+layout (bb.Attribute) with the one generated with --slot-fields (bb.SlotAttribute).
+
+Usage: python scripts/bench_field_reads.py [--number N]
+"""
+
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+# Run from a checkout: use the stone package next to this script.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SPEC = """\
+namespace bench
+
+struct Entry
+    name String
+    size UInt64
+    rev String?
+    count UInt64 = 0
+"""
+
+LAYOUTS = [
+    ('attribute', ()),
+    ('slot_fields', ('--slot-fields',)),
+]
+
+STATEMENTS = [
+    ('read set field', 'e.name'),
+    ('read unset nullable', 'e.rev'),
+    ('read unset default', 'e.count'),
+    ('write field', 'e.size = 1'),
+]
+
+
+def generate(out_dir, package, backend_args):
+    p = subprocess.Popen(
+        [sys.executable, '-m', 'stone.cli', 'python_types', os.path.join(out_dir, package),
+         '-', '--', '--package', package] + list(backend_args),
+        stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = p.communicate(input=SPEC.encode('utf-8'))
+    if p.wait() != 0:
+        raise RuntimeError('Could not execute stone tool: %s' % stderr.decode('utf-8'))
+    return importlib.import_module(package + '.bench')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=1000000,
+                        help='Number of times each statement is run.')
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp()
+    sys.path.insert(0, out_dir)
+    results = {}
+    for package, backend_args in LAYOUTS:
+        bench = generate(out_dir, 'bench_' + package, backend_args)
+        e = bench.Entry(name='n', size=1)
+        for label, stmt in STATEMENTS:
+            results[package, label] = min(timeit.repeat(
+                stmt, globals={'e': e}, number=args.number, repeat=5))
+
+    print('%-22s %12s %12s %8s' % ('', 'attribute', 'slot_fields', 'speedup'))
+    for label, _ in STATEMENTS:
+        before = results['attribute', label]
+        after = results['slot_fields', label]
+        print('%-22s %11.3fs %11.3fs %7.2fx' % (label, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of pickling and copying generated structs and unions, comparing the generic
+protocol of copyreg with the hooks of bb.Struct and bb.Union.
+
+Usage: python scripts/bench_pickle_copy.py [--count N] [--number N]
+"""
+
+import argparse
+import contextlib
+import copy
+import importlib
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import timeit
+
+# Run from a checkout: use the stone package next to this script.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stone.backends.python_rsrc import stone_base as bb  # noqa: E402
+
+SPEC = """\
+namespace bench
+
+struct Entry
+    name String
+    size UInt64
+    rev String?
+    count UInt64 = 0
+
+union Status
+    active Entry
+    deleted
+"""
+
+HOOKS = ('__getstate__', '__setstate__', '__copy__', '__deepcopy__')
+
+STATEMENTS = [
+    ('pickle.dumps', 'pickle.dumps(objs)'),
+    ('pickle.loads', 'pickle.loads(data)'),
+    ('copy.copy', '[copy.copy(o) for o in objs]'),
+    ('copy.deepcopy', 'copy.deepcopy(objs)'),
+]
+
+
+def generate(out_dir, package):
+    p = subprocess.Popen(
+        [sys.executable, '-m', 'stone.cli', 'python_types', os.path.join(out_dir, package),
+         '-', '--', '--package', package],
+        stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = p.communicate(input=SPEC.encode('utf-8'))
+    if p.wait() != 0:
+        raise RuntimeError('Could not execute stone tool: %s' % stderr.decode('utf-8'))
+    return importlib.import_module(package + '.bench')
+
+
+@contextlib.contextmanager
+def generic_protocol():
+    # Removes the hooks, so that pickle and copy fall back to copyreg.
+    hooks = {name: vars(bb._SlotState)[name] for name in HOOKS}
+    for name in HOOKS:
+        delattr(bb._SlotState, name)
+    try:
+        yield
+    finally:
+        for name, hook in hooks.items():
+            setattr(bb._SlotState, name, hook)
+
+
+def measure(objs, number):
+    data = pickle.dumps(objs, pickle.HIGHEST_PROTOCOL)
+    env = {'pickle': pickle, 'copy': copy, 'objs': objs, 'data': data}
+    results = {'pickle size': len(data)}
+    for label, stmt in STATEMENTS:
+        results[label] = min(timeit.repeat(stmt, globals=env, number=number, repeat=5))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=1000,
+                        help='Number of objects of each kind.')
+    parser.add_argument('--number', type=int, default=100,
+                        help='Number of times each statement is run.')
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp()
+    sys.path.insert(0, out_dir)
+    bench = generate(out_dir, 'bench_pickle')
+    entries = [bench.Entry(name='n%d' % i, size=i) for i in range(args.count)]
+    kinds = [
+        ('struct', entries),
+        ('union', [bench.Status.active(e) for e in entries]),
+    ]
+
+    for kind, objs in kinds:
+        with generic_protocol():
+            before = measure(objs, args.number)
+        after = measure(objs, args.number)
+        print('%-22s %12s %12s %8s' % ('%d %ss' % (args.count, kind), 'copyreg', 'hooks', ''))
+        print('%-22s %12d %12d %7.2fx' % (
+            'pickle size', before['pickle size'], after['pickle size'],
+            float(before['pickle size']) / after['pickle size']))
+        for label, _ in STATEMENTS:
+            print('%-22s %11.3fs %11.3fs %7.2fx' % (
+                label, before[label], after[label], before[label] / after[label]))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,14 @@ Helpers for representing Stone data types in Python.
 """
 
 
+import base64
+import binascii
+import copy
 import functools
+import importlib.util
+import operator
+import sys
+import threading
 
 from stone.backends.python_rsrc import stone_validators as bv
 
@@ -33,6 +40,10 @@ class NotSet:
         # disable copying so we can do identity comparison even after copying stone objects
         return self
 
+    def __reduce__(self):
+        # pickle as a reference to the module-level instance, for the same reason
+        return "NOT_SET"
+
     def __repr__(self):
         return "NOT_SET"
 
@@ -60,6 +71,8 @@ class Attribute:
         if instance is None:
             return self
         value = getattr(instance, self.name)
+        if value.__class__ is LazyValue:
+            value = value.materialize(instance, self)
         if value is not NOT_SET:
             return value
         if self.nullable:
@@ -85,7 +98,234 @@ class Attribute:
         setattr(instance, self.name, NOT_SET)
 
 
-class Struct:
+class SlotAttribute(property):
+    """
+    Alternative to ``Attribute`` for structs generated with ``--slot-fields``. Reading a field
+    that is set calls the C-level getter of its slot; an unset field leaves its slot empty,
+    and the read falls through to ``SlotStruct.__getattr__``, which gives the same result as
+    ``Attribute.__get__``. Values are validated when they are set, as with ``Attribute``.
+    """
+
+    def __init__(self, name, nullable=False, user_defined=False, slot=None):
+        # type: (typing.Text, bool, bool, typing.Any) -> None
+        # Internal name to store actual value for attribute.
+        self.name = "_{}_value".format(name)
+        # The getter is that of the member descriptor of the slot, which only exists once the
+        # class has been created; see with_slot().
+        super(SlotAttribute, self).__init__(
+            None if slot is None else slot.__get__, self._set_value, self._delete_value)
+        self.nullable = nullable
+        self.user_defined = user_defined
+        # These should be set later, because of possible cross-references.
+        self.validator = None  # type: typing.Any
+        self.default = NO_DEFAULT
+
+    def with_slot(self, slot):
+        # type: (typing.Any) -> SlotAttribute
+        """
+        Returns a copy of this attribute that reads its value with ``slot``, the member
+        descriptor of the slot.
+        """
+        attribute = SlotAttribute(public_name(self.name), self.nullable, self.user_defined, slot)
+        attribute.validator = self.validator
+        attribute.default = self.default
+        return attribute
+
+    def _set_value(self, instance, value):
+        # type: (typing.Any, typing.Any) -> None
+        if self.nullable and value is None:
+            self._delete_value(instance)
+            return
+        if self.user_defined:
+            self.validator.validate_type_only(value)
+        else:
+            value = self.validator.validate(value)
+        setattr(instance, self.name, value)
+
+    def _delete_value(self, instance):
+        # type: (typing.Any) -> None
+        try:
+            delattr(instance, self.name)
+        except AttributeError:
+            pass
+
+
+class LazyValue:
+    """
+    Stands in for the value of a struct field in its slot until the field is first read, for
+    structs decoded lazily. The value is decoded by calling ``decode`` with the
+    JSON-compatible ``raw`` value and the path to the field, a tuple of field names starting
+    from the outermost struct.
+    """
+    __slots__ = ("decode", "raw", "path")
+
+    def __init__(self, decode, raw, path):
+        # type: (typing.Callable[[typing.Any, typing.Tuple[str, ...]], typing.Any], typing.Any, typing.Tuple[str, ...]) -> None # noqa: E501
+        self.decode = decode
+        self.raw = raw
+        # Path to the struct the field belongs to
+        self.path = path
+
+    def materialize(self, instance, attribute):
+        # type: (typing.Any, Attribute) -> typing.Any
+        """
+        Decodes the value and assigns it to ``attribute`` of ``instance`` through its setter.
+        Returns the new content of the slot. Validation errors are raised with the path to the
+        field.
+        """
+        field_name = public_name(attribute.name)
+        try:
+            attribute.__set__(instance, self.decode(self.raw, self.path + (field_name,)))
+        except bv.ValidationError as e:
+            e.add_parent(field_name)
+            for parent in reversed(self.path):
+                e.add_parent(parent)
+            raise
+        return getattr(instance, attribute.name)
+
+    def __repr__(self):
+        return "LazyValue({!r})".format(self.raw)
+
+
+@functools.lru_cache(maxsize=None)
+def _slot_layout(cls):
+    # type: (type) -> typing.Tuple[typing.Tuple[str, ...], typing.Callable[[typing.Any], typing.Tuple[typing.Any, ...]], typing.Callable[[typing.Any, typing.Tuple[typing.Any, ...]], None], bool] # noqa: E501
+    """
+    Returns the names of the slots of instances of ``cls``, from its base classes down, a
+    function returning their values in a tuple, a function assigning such a tuple to them,
+    and whether the instances have a dict.
+    """
+    names = []  # type: typing.List[str]
+    for base in reversed(cls.__mro__):
+        slots = vars(base).get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for slot in slots:
+            if slot in ("__dict__", "__weakref__"):
+                continue
+            if slot.startswith("__") and not slot.endswith("__"):
+                slot = "_{}{}".format(base.__name__.lstrip("_"), slot)
+            names.append(slot)
+    if not names:
+        get_values = lambda instance: ()  # noqa: E731
+    elif len(names) == 1:
+        get_value = operator.attrgetter(names[0])
+        get_values = lambda instance: (get_value(instance),)  # noqa: E731
+    else:
+        get_values = operator.attrgetter(*names)
+    set_values = _compile_slot_setter(names, issubclass(cls, SlotStruct))
+    return tuple(names), get_values, set_values, cls.__dictoffset__ != 0
+
+def _compile_slot_setter(names, skip_not_set):
+    # type: (typing.List[str], bool) -> typing.Callable[[typing.Any, typing.Tuple[typing.Any, ...]], None] # noqa: E501
+    # Assigning the slots by unpacking the tuple is several times faster than a loop. The names
+    # of slots are identifiers, so they can be compiled into the function.
+    lines = ["def set_values(instance, values):"]
+    if not names:
+        lines.append("    pass")
+    elif skip_not_set:
+        lines.append("    {} = values".format(
+            "".join("v{}, ".format(i) for i in range(len(names)))))
+        for i, name in enumerate(names):
+            lines.append("    if v{} is not NOT_SET: instance.{} = v{}".format(i, name, i))
+    else:
+        lines.append("    {} = values".format(
+            "".join("instance.{}, ".format(name) for name in names)))
+    namespace = {"NOT_SET": NOT_SET}  # type: typing.Dict[str, typing.Any]
+    exec("\n".join(lines), namespace)
+    return namespace["set_values"]
+
+class _SlotState:
+    # Pickling and copying for Struct and Union, whose values are kept in slots. The state is
+    # the tuple of slot names, shared by all instances of a class so that pickle only writes
+    # it once, and the tuple of slot values; the instance dict, if any and not empty, follows.
+    # Values are restored as they are, without being validated again, and NOT_SET stays the
+    # module-level instance.
+    __slots__ = ()
+
+    def __getstate__(self):
+        # type: () -> typing.Tuple[typing.Any, ...]
+        names, get_values, _, has_dict = _slot_layout(type(self))
+        try:
+            values = get_values(self)
+        except AttributeError:
+            values = self._slot_values(names)
+        if LazyValue in map(type, values):
+            values = self._materialize(names, values)
+        if has_dict and self.__dict__:
+            return names, values, self.__dict__
+        return names, values
+
+    def __setstate__(self, state):
+        # type: (typing.Tuple[typing.Any, ...]) -> None
+        names, _, set_values, _ = _slot_layout(type(self))
+        if state[0] == names:
+            set_values(self, state[1])
+            dict_ = state[2] if len(state) > 2 else None
+        elif state[1].__class__ is dict:
+            # (instance dict or None, {slot name: value}), as pickled by earlier versions
+            dict_, slot_state = state
+            self._set_slots(slot_state.keys(), slot_state.values())
+        else:
+            # Pickled with another version of the class
+            self._set_slots(state[0], state[1])
+            dict_ = state[2] if len(state) > 2 else None
+        if dict_:
+            self.__dict__.update(dict_)
+
+    def __copy__(self):
+        # type: () -> typing.Any
+        cls = type(self)
+        names, get_values, set_values, has_dict = _slot_layout(cls)
+        try:
+            values = get_values(self)
+        except AttributeError:
+            values = self._slot_values(names)
+        other = cls.__new__(cls)
+        set_values(other, values)
+        if has_dict and self.__dict__:
+            other.__dict__.update(self.__dict__)
+        return other
+
+    def __deepcopy__(self, memo):
+        # type: (typing.Dict[int, typing.Any]) -> typing.Any
+        cls = type(self)
+        names, get_values, set_values, has_dict = _slot_layout(cls)
+        try:
+            values = get_values(self)
+        except AttributeError:
+            values = self._slot_values(names)
+        if LazyValue in map(type, values):
+            values = self._materialize(names, values)
+        other = cls.__new__(cls)
+        # Register the copy first, for values that refer back to this instance.
+        memo[id(self)] = other
+        set_values(other, copy.deepcopy(values, memo))
+        if has_dict and self.__dict__:
+            other.__dict__.update(copy.deepcopy(self.__dict__, memo))
+        return other
+
+    def _slot_values(self, names):
+        # type: (typing.Tuple[str, ...]) -> typing.Tuple[typing.Any, ...]
+        # Empty slots, in an instance that wasn't initialized, are saved as NOT_SET.
+        return tuple(getattr(self, name, NOT_SET) for name in names)
+
+    def _materialize(self, names, values):
+        # type: (typing.Tuple[str, ...], typing.Tuple[typing.Any, ...]) -> typing.Tuple[typing.Any, ...] # noqa: E501
+        # Decodes the fields of a lazily decoded struct that haven't been read yet: their
+        # LazyValue holds the decoder, which can't be pickled. Shallow copies share it instead.
+        cls = type(self)
+        return tuple(
+            value.materialize(self, getattr(cls, public_name(name)))
+            if value.__class__ is LazyValue else value
+            for name, value in zip(names, values))
+
+    def _set_slots(self, names, values):
+        # type: (typing.Iterable[str], typing.Iterable[typing.Any]) -> None
+        for name, value in zip(names, values):
+            setattr(self, name, value)
+
+class Struct(_SlotState):
     # This is a base class for all classes representing Stone structs.
 
     # every parent class in the inheritance tree must define __slots__ in order to get full memory
@@ -93,6 +333,9 @@ class Struct:
     __slots__ = ()
 
     _all_field_names_ = set()  # type: typing.Set[str]
+    # Annotation types that _process_custom_annotations can find in instances of the class,
+    # including in the values of their fields
+    _custom_annotation_types_ = frozenset()  # type: typing.FrozenSet[typing.Type[AnnotationType]]
 
     def __eq__(self, other):
         # type: (object) -> bool
@@ -124,19 +367,58 @@ class Struct:
         # type: (typing.Type[T], typing.Text, typing.Callable[[T, U], U]) -> None
         pass
 
-class Union:
+class _SlotStructType(type):
+    # Gives the SlotAttributes of every new SlotStruct class the getter of their slot.
+
+    def __init__(cls, name, bases, namespace):
+        super(_SlotStructType, cls).__init__(name, bases, namespace)
+        for field_name, attribute in list(namespace.items()):
+            if isinstance(attribute, SlotAttribute) and attribute.fget is None:
+                setattr(cls, field_name, attribute.with_slot(getattr(cls, attribute.name)))
+
+class SlotStruct(Struct, metaclass=_SlotStructType):
+    # Base class for structs generated with --slot-fields, whose fields are SlotAttributes.
+    # Unset fields leave their slot empty, so reading them ends up here.
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        # type: (str) -> typing.Any
+        attribute = getattr(type(self), name, None)
+        if isinstance(attribute, SlotAttribute):
+            if attribute.nullable:
+                return None
+            if attribute.default is not NO_DEFAULT:
+                return attribute.default
+            raise AttributeError("missing required field '{}'".format(name))
+        if name.startswith("_") and name.endswith("_value"):
+            # Code that reads the slots directly expects NOT_SET for unset fields.
+            attribute = getattr(type(self), public_name(name), None)
+            if isinstance(attribute, SlotAttribute) and attribute.name == name:
+                return NOT_SET
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, name))
+
+    def _set_slots(self, names, values):
+        # type: (typing.Iterable[str], typing.Iterable[typing.Any]) -> None
+        # Unset fields are read as NOT_SET, through __getattr__; leave their slots empty.
+        for name, value in zip(names, values):
+            if value is not NOT_SET:
+                setattr(self, name, value)
+
+class Union(_SlotState):
     # TODO(kelkabany): Possible optimization is to remove _value if a
     # union is composed of only symbols.
     __slots__ = ['_tag', '_value']
     _tagmap = {}  # type: typing.Dict[str, bv.Validator]
     _permissioned_tagmaps = set()  # type: typing.Set[typing.Text]
+    # See Struct._custom_annotation_types_
+    _custom_annotation_types_ = frozenset()  # type: typing.FrozenSet[typing.Type[AnnotationType]]
 
     def __init__(self, tag, value=None):
-        validator = None
-        tagmap_names = ['_{}_tagmap'.format(map_name) for map_name in self._permissioned_tagmaps]
-        for tagmap_name in ['_tagmap'] + tagmap_names:
-            if tag in getattr(self, tagmap_name):
-                validator = getattr(self, tagmap_name)[tag]
+        if self._permissioned_tagmaps:
+            validator = bv.full_tagmap(type(self)).get(tag)
+        else:
+            validator = self._tagmap.get(tag)
         assert validator is not None, 'Invalid tag %r.' % tag
         if isinstance(validator, bv.Void):
             assert value is None, 'Void type union member must have None value.'
@@ -173,26 +455,13 @@ class Union:
     def _is_tag_present(cls, tag, caller_permissions):
         assert tag is not None, 'tag value should not be None'
 
-        if tag in cls._tagmap:
-            return True
-
-        for extra_permission in caller_permissions.permissions:
-            tagmap_name = '_{}_tagmap'.format(extra_permission)
-            if hasattr(cls, tagmap_name) and tag in getattr(cls, tagmap_name):
-                return True
-
-        return False
+        return tag in bv.permissioned_tagmap(cls, caller_permissions)
 
     @classmethod
     def _get_val_data_type(cls, tag, caller_permissions):
         assert tag is not None, 'tag value should not be None'
 
-        for extra_permission in caller_permissions.permissions:
-            tagmap_name = '_{}_tagmap'.format(extra_permission)
-            if hasattr(cls, tagmap_name) and tag in getattr(cls, tagmap_name):
-                return getattr(cls, tagmap_name)[tag]
-
-        return cls._tagmap[tag]
+        return bv.permissioned_tagmap(cls, caller_permissions)[tag]
 
 class Route:
     __slots__ = ("name", "version", "deprecated", "arg_type", "result_type", "error_type", "attrs")
@@ -217,6 +486,28 @@ class Route:
             self.error_type,
             self.attrs)
 
+class LazyRoute(Route):
+    """
+    A route whose data types are returned by ``get_types``, as an ``(arg_type, result_type,
+    error_type)`` tuple, when one of them is first read. Modules generated with --lazy-imports
+    define the routes referring to other namespaces with it, and those generated with
+    --deferred-wiring all their routes.
+    """
+    __slots__ = ("_get_types",)
+
+    def __init__(self, name, version, deprecated, get_types, attrs):
+        super(LazyRoute, self).__init__(name, version, deprecated, None, None, None, attrs)
+        # Leave the slots of the data types empty, so that reading them ends up in __getattr__.
+        del self.arg_type, self.result_type, self.error_type
+        self._get_types = get_types
+
+    def __getattr__(self, name):
+        if name in ("arg_type", "result_type", "error_type"):
+            self.arg_type, self.result_type, self.error_type = self._get_types()
+            return getattr(self, name)
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, name))
+
 # helper functions used when constructing custom annotation processors
 
 # put this here so that every other file doesn't need to import functools
@@ -230,7 +521,50 @@ def make_struct_annotation_processor(annotation_type, processor):
         return struct
     return g
 
+class _StructAnnotationProcessor:
+    # Returned by make_pruning_struct_annotation_processor. Structs and unions are processed in
+    # place, and only if their class can contain annotations of annotation_type: the other ones
+    # are returned as they are without visiting their fields.
+    __slots__ = ("annotation_type", "processor")
+
+    def __init__(self, annotation_type, processor):
+        self.annotation_type = annotation_type
+        self.processor = processor
+
+    def __call__(self, field_path, struct):
+        if struct is not None and self.annotation_type in struct._custom_annotation_types_:
+            struct._process_custom_annotations(self.annotation_type, field_path, self.processor)
+        return struct
+
+    def process_many(self, field_path, items):
+        # Processes the values of the (key or index, value) pairs items in one pass, formatting
+        # the paths of only the values that are visited.
+        annotation_type = self.annotation_type
+        processor = self.processor
+        for key, struct in items:
+            if struct is not None and annotation_type in struct._custom_annotation_types_:
+                struct._process_custom_annotations(
+                    annotation_type, '{}[{!r}]'.format(field_path, key), processor)
+
+def make_pruning_struct_annotation_processor(annotation_type, processor):
+    """
+    Like make_struct_annotation_processor, but skips the structs and unions whose
+    _custom_annotation_types_ doesn't include annotation_type. For classes generated with
+    _custom_annotation_types_ tables only: classes without one inherit an empty table.
+    Lists and maps of them are processed in a single pass by make_list_annotation_processor
+    and make_map_value_annotation_processor.
+    """
+    return _StructAnnotationProcessor(annotation_type, processor)
+
 def make_list_annotation_processor(processor):
+    if isinstance(processor, _StructAnnotationProcessor):
+        def process_structs(field_path, list_):
+            if list_ is None:
+                return list_
+            processor.process_many(field_path, enumerate(list_))
+            return list(list_)
+        return process_structs
+
     def g(field_path, list_):
         if list_ is None:
             return list_
@@ -238,12 +572,315 @@ def make_list_annotation_processor(processor):
     return g
 
 def make_map_value_annotation_processor(processor):
+    if isinstance(processor, _StructAnnotationProcessor):
+        def process_structs(field_path, map_):
+            if map_ is None:
+                return map_
+            processor.process_many(field_path, map_.items())
+            return dict(map_)
+        return process_structs
+
     def g(field_path, map_):
         if map_ is None:
             return map_
         return {k: processor('{}[{}]'.format(field_path, repr(k)), v) for k, v in map_.items()}
     return g
 
+@functools.lru_cache(maxsize=None)
+def union_symbol(cls, tag):
+    """
+    Returns a shared instance of the union class ``cls`` with ``tag`` and no value, for use by
+    decoders: the symbol instance the python_types backend assigns to the class
+    (``UploadMode.add``) or, for tags it doesn't assign, such as inherited ones, a cached
+    instance. Union instances are treated as immutable, so sharing them is safe.
+    """
+    symbol = vars(cls).get(tag)
+    if type(symbol) is cls and symbol._tag == tag and symbol._value is None:
+        return symbol
+    return cls(tag)
+
+def validate_all(struct):
+    """
+    Decodes all the fields of ``struct`` that were decoded lazily and haven't been read yet,
+    including those of nested structs, so that any validation error is raised now rather than
+    when the field is read. Returns ``struct``.
+    """
+    for field_name, _ in struct._all_fields_:
+        value = getattr(struct, "_{}_value".format(field_name))
+        if value.__class__ is LazyValue:
+            value = getattr(struct, field_name)
+        if isinstance(value, Struct):
+            validate_all(value)
+    return struct
+
+def lazy_import(name):
+    """
+    Returns the module ``name``. Unless it has been imported already, it's only executed when
+    one of its attributes is first accessed. Modules generated with --lazy-imports refer to the
+    namespaces they import through it.
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        spec = importlib.util.find_spec(name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+    return module
+
+# Held while a class deferred with defer_wiring() is being wired
+_wiring_lock = threading.RLock()
+
+def lazy_constant(make):
+    """
+    Returns a function returning the value returned by ``make``, which is called once, when the
+    function is first called. Modules generated with --lazy-imports define the validators that
+    refer to other namespaces with it, and those generated with --deferred-wiring all their
+    validators.
+    """
+    value = []  # type: typing.List[typing.Any]
+
+    def get():
+        if not value:
+            with _wiring_lock:
+                if not value:
+                    value.append(make())
+        return value[0]
+
+    return get
+
+class _Wiring:
+    """
+    Runs the function wiring a class when the class is first used; see defer_wiring().
+    """
+    __slots__ = ("cls", "wire", "names", "init", "originals", "pending")
+
+    def __init__(self, cls, wire, names):
+        self.cls = cls
+        self.wire = wire
+        self.names = names
+        # The __init__ defined by the class itself, if any
+        self.init = vars(cls).get("__init__")
+        # The class attributes among names that the wiring completes rather than assigns, such
+        # as the Attributes of fields, whose validators and defaults it sets
+        self.originals = {name: vars(cls)[name] for name in names if name in vars(cls)}
+        self.pending = True
+
+    def run(self):
+        # type: () -> None
+        with _wiring_lock:
+            if not self.pending:
+                # Done, or being done further up the stack of this thread.
+                return
+            self.pending = False
+            cls = self.cls
+            for name, value in self.originals.items():
+                setattr(cls, name, value)
+            try:
+                self.wire()
+            except BaseException:
+                # Left to be wired again, so that the class doesn't go on with the attributes
+                # of its base classes, or with incomplete ones.
+                self.pending = True
+                for name in self.originals:
+                    setattr(cls, name, _WiredAttribute(self, name))
+                raise
+            # Remove what's left of the triggers, so that the class is as if it had been wired
+            # at import.
+            for name in self.names:
+                if isinstance(vars(cls).get(name), _WiredAttribute):
+                    delattr(cls, name)
+            if self.init is None:
+                del cls.__init__
+            else:
+                cls.__init__ = self.init
+            del cls.__setstate__
+
+    def set_state(self, instance, state):
+        """
+        Applies pickled or copied ``state`` to ``instance`` as pickle does for classes without
+        a __setstate__ method.
+        """
+        if isinstance(state, tuple) and len(state) == 2:
+            state, slot_state = state
+        else:
+            slot_state = None
+        if state:
+            instance.__dict__.update(state)
+        if slot_state:
+            for name, value in slot_state.items():
+                setattr(instance, name, value)
+
+class _WiredAttribute:
+    """
+    Stands in for the class attribute ``name`` of a class until the class is wired.
+    """
+    __slots__ = ("wiring", "name")
+
+    def __init__(self, wiring, name):
+        self.wiring = wiring
+        self.name = name
+
+    def __get__(self, instance, owner):
+        wiring = self.wiring
+        wiring.run()
+        if vars(wiring.cls).get(self.name) is not self:
+            return getattr(owner if instance is None else instance, self.name)
+        # Read while the class is being wired, before the attribute has been assigned.
+        return getattr(super(wiring.cls, owner if instance is None else instance), self.name)
+
+def defer_wiring(cls, wire, names):
+    """
+    Defers calling ``wire``, which sets the class attributes ``names`` of ``cls``, until one
+    of them is first read or an instance of ``cls`` is first initialized or unpickled. Those
+    of ``names`` that ``cls`` already has, such as the Attributes of fields whose validators
+    and defaults ``wire`` sets, are put back just before ``wire`` is called. Modules generated
+    with --deferred-wiring use this for the reflection attributes and fields of their classes.
+    """
+    wiring = _Wiring(cls, wire, tuple(names))
+    for name in wiring.names:
+        setattr(cls, name, _WiredAttribute(wiring, name))
+
+    def __init__(self, *args, **kwargs):
+        wiring.run()
+        # Not cls.__init__, which is still this function while cls is being wired.
+        if wiring.init is not None:
+            wiring.init(self, *args, **kwargs)
+        else:
+            super(cls, self).__init__(*args, **kwargs)
+
+    def __setstate__(self, state):
+        # Unpickled and copied instances aren't initialized.
+        wiring.run()
+        setstate = getattr(self, "__setstate__", None)
+        if setstate is not None:
+            setstate(state)
+        else:
+            wiring.set_state(self, state)
+
+    __init__.wiring = wiring  # type: ignore
+    cls.__init__ = __init__
+    cls.__setstate__ = __setstate__
+
+def wire(cls):
+    """
+    Wires ``cls`` and its base classes now if defer_wiring() was used for them. Returns
+    ``cls``.
+    """
+    for base in cls.__mro__:
+        wiring = getattr(vars(base).get("__init__"), "wiring", None)
+        if wiring is not None:
+            wiring.run()
+    return cls
+
 def public_name(name):
     # _some_attr_value -> some_attr
     return "_".join(name.split("_")[1:-1])
+
+# helper functions used by the _to_json_compat and _from_json_compat functions that the
+# python_types backend generates with --generate-serializers
+
+def json_compat_encode_bytes(value):
+    return base64.b64encode(value).decode('ascii')
+
+def json_compat_decode_bytes(obj):
+    try:
+        return base64.b64decode(obj)
+    except (TypeError, binascii.Error):
+        raise bv.ValidationError('invalid base64-encoded bytes')
+
+def json_compat_encode_timestamp(value, fmt):
+    return bv.timestamp_codec(fmt)[1](value)
+
+def json_compat_decode_timestamp(obj, fmt):
+    try:
+        return bv.timestamp_codec(fmt)[0](obj)
+    except (TypeError, ValueError) as e:
+        raise bv.ValidationError(e.args[0])
+
+def json_compat_decode_void(obj, strict):
+    if strict and obj is not None:
+        raise bv.ValidationError("expected null, got value")
+    return None
+
+def json_compat_list(obj):
+    if not isinstance(obj, list):
+        raise bv.ValidationError('expected list, got %s' % bv.generic_type_name(obj))
+    return obj
+
+def json_compat_dict(obj):
+    if not isinstance(obj, dict):
+        raise bv.ValidationError('expected dict, got %s' % bv.generic_type_name(obj))
+    return obj
+
+def json_compat_check_struct_keys(obj, field_names):
+    for key in obj:
+        if key not in field_names and not key.startswith('.tag'):
+            raise bv.ValidationError("unknown field '%s'" % key)
+
+def json_compat_encode_struct_tree(validator, value):
+    validator.validate(value)
+    definition = validator.definition
+    pytype = type(value)
+    assert pytype in definition._pytype_to_tag_and_subtype_, \
+        '{!r} is not a serializable subtype of {!r}.'.format(pytype, definition)
+
+    tags, subtype = definition._pytype_to_tag_and_subtype_[pytype]
+
+    assert len(tags) == 1, tags
+    assert not isinstance(subtype, bv.StructTree), \
+        'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+
+    d = {'.tag': tags[0]}
+    d.update(subtype.definition._to_json_compat(value))
+    return d
+
+def json_compat_decode_struct_tree(validator, obj, strict):
+    definition = validator.definition
+    if '.tag' not in obj:
+        raise bv.ValidationError("missing '.tag' key")
+    tag = obj['.tag']
+    if not isinstance(tag, str):
+        raise bv.ValidationError('expected string, got %s' % bv.generic_type_name(tag),
+                                 parent='.tag')
+
+    subtype = definition._tag_to_subtype_.get((tag,))
+    if subtype is not None:
+        if isinstance(subtype, bv.StructTree):
+            raise bv.ValidationError("tag '%s' refers to non-leaf subtype" % tag)
+        return subtype.definition._from_json_compat(obj, strict)
+    elif strict:
+        # In strict mode, the entirety of the tag hierarchy should point to a known subtype.
+        raise bv.ValidationError("unknown subtype '%s'" % tag)
+    elif definition._is_catch_all_:
+        # If subtype was not found, use the base.
+        return definition._from_json_compat(obj, strict)
+    else:
+        raise bv.ValidationError("unknown subtype '%s' and '%s' is not a catch-all" %
+                                 (tag, definition.__name__))
+
+def json_compat_union_tag(obj):
+    if '.tag' not in obj:
+        raise bv.ValidationError("missing '.tag' key")
+    tag = obj['.tag']
+    if not isinstance(tag, str):
+        raise bv.ValidationError('tag must be string, got %s' % bv.generic_type_name(tag))
+    return tag
+
+def json_compat_check_union_keys(obj, tag):
+    for key in obj:
+        if key != tag and key != '.tag':
+            raise bv.ValidationError("unexpected key '%s'" % key)
+
+def json_compat_check_void_union_keys(obj, tag):
+    # Only called in strict mode. In non-strict mode, we accept that other keys may be set due
+    # to a change of the void type to another.
+    if tag in obj and obj[tag] is not None:
+        raise bv.ValidationError('expected null, got %s' % bv.generic_type_name(obj[tag]))
+    json_compat_check_union_keys(obj, tag)
+
+def json_compat_unknown_union_tag(cls, tag, strict):
+    if not strict and cls._catch_all:
+        return union_symbol(cls, cls._catch_all)
+    raise bv.ValidationError("unknown tag '%s'" % tag)
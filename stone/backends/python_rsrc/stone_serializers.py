@@ -13,9 +13,11 @@ than being added to a project.
 
 import base64
 import binascii
+import codecs
 import collections
-import datetime
+import copy
 import functools
+import itertools
 import json
 import re
 import time
@@ -122,15 +124,19 @@ class StoneSerializerBase(StoneEncoderInterface):
 
         if isinstance(validator, bv.List):
             # Because Lists are mutable, we always validate them during
-            # serialization
-            validate_f = validator.validate  # type: typing.Callable[[typing.Any], None]
+            # serialization. Items are validated by encode_list as they're
+            # encoded.
+            validate_f = validator.validate_type_only  # type: typing.Callable[[typing.Any], None]
             encode_f = self.encode_list  # type: typing.Callable[[typing.Any, typing.Any], typing.Any] # noqa: E501
         elif isinstance(validator, bv.Map):
             # Also validate maps during serialization because they are also mutable
-            validate_f = validator.validate
+            validate_f = validator.validate_type_only
             encode_f = self.encode_map
         elif isinstance(validator, bv.Nullable):
-            validate_f = validator.validate
+            if isinstance(validator.validator, (bv.List, bv.Map)):
+                validate_f = validator.validate_type_only
+            else:
+                validate_f = validator.validate
             encode_f = self.encode_nullable
         elif isinstance(validator, bv.Primitive):
             validate_f = validator.validate
@@ -222,6 +228,24 @@ class StoneSerializerBase(StoneEncoderInterface):
         """
         raise NotImplementedError
 
+def _encoding_validates(validator, should_redact):
+    """
+    Returns whether encoding a value with ``validator`` does all the checks of
+    ``validator.validate``, so that members of lists and maps needn't be validated before
+    they're encoded. This is the case for primitives, which are validated by their encoder,
+    and for lists and maps, whose members are validated as they're encoded. Reals are the
+    exception, since ``validate`` also converts them to floats.
+    """
+    if should_redact and hasattr(validator, '_redact'):
+        return False
+    if isinstance(validator, bv.Nullable):
+        validator = validator.validator
+        if should_redact and hasattr(validator, '_redact'):
+            return False
+    if isinstance(validator, bv.Real):
+        return False
+    return isinstance(validator, (bv.Primitive, bv.List, bv.Map))
+
 # ------------------------------------------------------------------------
 class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
 
@@ -264,31 +288,52 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         return self._old_style
 
     def encode_sub(self, validator, value):
-        if self.should_redact and hasattr(validator, '_redact'):
+        redactor = getattr(validator, '_redact', None) if self.should_redact else None
+        if redactor is not None:
             if isinstance(value, list):
-                return [validator._redact.apply(v) for v in value]
+                return redactor.apply_many(value)
             elif isinstance(value, dict):
-                return {k: validator._redact.apply(v) for k, v in value.items()}
+                return dict(zip(value, redactor.apply_many(value.values())))
             else:
-                return validator._redact.apply(value)
+                return redactor.apply(value)
 
         # Encode value normally
         return super().encode_sub(validator, value)
 
     def encode_list(self, validator, value):
-        validated_value = validator.validate(value)
-
-        return [self.encode_sub(validator.item_validator, value_item) for value_item in
-                validated_value]
+        # The type and length of the list have been checked by encode_sub
+        item_validator = validator.item_validator
+        if isinstance(item_validator, bv.Primitive) and \
+                item_validator not in self.alias_validators and \
+                not (self.should_redact and hasattr(item_validator, '_redact')):
+            # Validate all the members at once, see _EncodePlanCompiler._batches_primitive
+            return [self.encode_primitive(item_validator, value_item)
+                    for value_item in item_validator.validate_many(value)]
+        if _encoding_validates(item_validator, self.should_redact):
+            return [self.encode_sub(item_validator, value_item) for value_item in value]
+        return [self.encode_sub(item_validator, item_validator.validate(value_item))
+                for value_item in value]
 
     def encode_map(self, validator, value):
-        validated_value = validator.validate(value)
-
-        return {
-            self.encode_sub(validator.key_validator, key):
-                self.encode_sub(validator.value_validator, value) for
-            key, value in validated_value.items()
-        }
+        key_validator = validator.key_validator
+        value_validator = validator.value_validator
+        if not _encoding_validates(key_validator, self.should_redact):
+            validate_key = key_validator.validate
+        else:
+            validate_key = None
+        if not _encoding_validates(value_validator, self.should_redact):
+            validate_value = value_validator.validate
+        else:
+            validate_value = None
+
+        d = {}
+        for key, value in value.items():
+            if validate_key is not None:
+                key = validate_key(key)
+            if validate_value is not None:
+                value = validate_value(value)
+            d[self.encode_sub(key_validator, key)] = self.encode_sub(value_validator, value)
+        return d
 
     def encode_nullable(self, validator, value):
         if value is None:
@@ -303,7 +348,7 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         if isinstance(validator, bv.Void):
             return None
         elif isinstance(validator, bv.Timestamp):
-            return _strftime(value, validator.format)
+            return validator.render(value)
         elif isinstance(validator, bv.Bytes):
             if self.for_msgpack:
                 return value
@@ -323,11 +368,7 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         # they've already been validated on assignment
         d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
 
-        all_fields = validator.definition._all_fields_
-
-        for extra_permission in self.caller_permissions.permissions:
-            all_fields_name = '_all_{}_fields_'.format(extra_permission)
-            all_fields = all_fields + getattr(validator.definition, all_fields_name, [])
+        all_fields = bv.permissioned_fields(validator.definition, self.caller_permissions)
 
         for field_name, field_validator in all_fields:
             try:
@@ -433,251 +474,2379 @@ class StoneToJsonSerializer(StoneToPythonPrimitiveSerializer):
     def encode(self, validator, value):
         return json.dumps(super().encode(validator, value))
 
-# --------------------------------------------------------------
-# JSON Encoder
+# ------------------------------------------------------------------------
+# Compiled encode plans
 #
-# These interfaces are preserved for backward compatibility and symmetry with deserialization
-# functions.
-
-def json_encode(data_type, obj, caller_permissions=None, alias_validators=None, old_style=False,
-                should_redact=False):
-    """Encodes an object into JSON based on its type.
+# ``StoneToPythonPrimitiveSerializer`` re-discovers the type of every validator it visits. An
+# encode plan is the same traversal resolved ahead of time: a tree of closures, one per
+# validator, each of which already knows how to validate and encode its value. Plans are
+# specialized for one set of serialization options and cached, so encoding the same type again
+# only pays for the actual work.
 
-    Args:
-        data_type (Validator): Validator for obj.
-        obj (object): Object to be serialized.
-        caller_permissions (list): The list of raw-string caller permissions with which
-                to serialize.
-        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
-            Custom validation functions. These must raise bv.ValidationError on
-            failure.
+# Upper bound on the number of (validator, options) combinations kept in each plan cache.
+_PLAN_CACHE_SIZE = 1024
 
-    Returns:
-        str: JSON-encoded object.
 
-    This function will also do additional validation that wasn't done by the
-    objects themselves:
+class _FrozenCallerPermissions(CallerPermissionsInterface):
+    """
+    Immutable snapshot of a caller's permissions, safe to capture in a cached plan.
+    """
+    __slots__ = ('_permissions',)
 
-    1. The passed in obj may not have been validated with data_type yet.
-    2. If an object that should be a Struct was assigned to a field, its
-       type has been validated, but the presence of all required fields
-       hasn't been.
-    3. If an object that should be a Union was assigned to a field, whether
-       or not a tag has been set has not been validated.
-    4. A list may have passed validation initially, but been mutated since.
+    def __init__(self, permissions):
+        self._permissions = tuple(permissions)
 
-    Example of serializing a struct to JSON:
+    @property
+    def permissions(self):
+        return self._permissions
 
-    struct FileRef
-       path String
-       rev String
 
-    > fr = FileRef()
-    > fr.path = 'a/b/c'
-    > fr.rev = '1234'
-    > JsonEncoder.encode(fr)
-    "{'path': 'a/b/c', 'rev': '1234'}"
+def _plan_cache_key(caller_permissions, alias_validators):
+    """
+    Returns the hashable parts of a plan cache key derived from ``caller_permissions`` and
+    ``alias_validators``, or ``None`` if they can't be used as a key.
+    """
+    permissions = tuple(caller_permissions.permissions) if caller_permissions else ()
+    try:
+        aliases = frozenset(alias_validators.items()) if alias_validators else frozenset()
+    except TypeError:
+        # Unhashable custom validation callables; the plan simply won't be cached.
+        return None
+    return permissions, aliases
+
+@functools.lru_cache(maxsize=_PLAN_CACHE_SIZE)
+def _parse_field_mask(paths):
+    """
+    Parses the field paths of a field mask, such as ``('entries[*].name', 'cursor')``, into a
+    tree of ``(field name, subtree)`` pairs sorted by field name, where the subtree is ``None``
+    if the whole field is included. The tree is hashable, so that it can be part of a plan
+    cache key.
+
+    Paths are made of the names of struct fields separated by dots. Lists, maps, nullables,
+    unions and struct subtypes are traversed implicitly: the rest of the path applies to their
+    members, values or fields. A ``[*]`` suffix may be added to a name to make it explicit that
+    a field is a list or map.
+    """
+    tree = {}  # type: typing.Dict[str, typing.Any]
+    for path in paths:
+        if not isinstance(path, str):
+            raise TypeError('field paths must be strings, got %r' % (path,))
+        names = []
+        for segment in path.split('.'):
+            name = segment
+            while name.endswith('[*]'):
+                name = name[:-3]
+            if name:
+                names.append(name)
+            elif not segment:
+                raise ValueError('invalid field path %r' % path)
+        if not names:
+            raise ValueError('invalid field path %r' % path)
+        node = tree
+        for name in names[:-1]:
+            child = node.setdefault(name, {})
+            if child is None:
+                # An enclosing field is already fully included.
+                break
+            node = child
+        else:
+            node[names[-1]] = None
 
-    Example of serializing a union to JSON:
+    def freeze(node):
+        if node is None:
+            return None
+        return tuple(sorted(((name, freeze(child)) for name, child in node.items()),
+                            key=lambda item: item[0]))
 
-    union UploadMode
-        add
-        overwrite
-        update FileRef
+    return freeze(tree)
 
-    > um = UploadMode()
-    > um.set_add()
-    > JsonEncoder.encode(um)
-    '"add"'
-    > um.update = fr
-    > JsonEncoder.encode(um)
-    "{'update': {'path': 'a/b/c', 'rev': '1234'}}"
+def _field_mask_tree(field_mask):
     """
-    for_msgpack = False
-    serializer = StoneToJsonSerializer(
-        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
-    return serializer.encode(data_type, obj)
+    Returns the tree of the field mask ``field_mask``, an iterable of field paths, or ``None``
+    if no mask is given. See ``_parse_field_mask``.
+    """
+    if field_mask is None:
+        return None
+    if isinstance(field_mask, str):
+        field_mask = (field_mask,)
+    return _parse_field_mask(tuple(field_mask))
 
-def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_validators=None,
-                           old_style=False, for_msgpack=False, should_redact=False):
-    """Encodes an object into a JSON-compatible dict based on its type.
+def _masked_compiler(compiler, field_mask):
+    """
+    Returns a plan compiler with the same options as ``compiler``, for values whose fields are
+    masked with the tree ``field_mask``. Compilers are shared between all the fields with the
+    same mask, which also terminates recursive types.
+    """
+    masked = compiler._compilers.get(field_mask)
+    if masked is None:
+        masked = compiler._compilers[field_mask] = copy.copy(compiler)
+        masked.field_mask = field_mask
+        masked.use_generated = compiler.use_generated_options and field_mask is None
+        masked._memo = {}
+    return masked
+
+def _masked_fields(compiler, fields):
+    """
+    Returns ``(field name, validator, compiler)`` for each of the ``(field name, validator)``
+    pairs ``fields`` of a struct that are included by the field mask of ``compiler``, where
+    ``compiler`` is the one to compile the field's plan with.
+    """
+    if compiler.field_mask is None:
+        return [(name, field_validator, compiler) for name, field_validator in fields]
+    mask = dict(compiler.field_mask)
+    return [(name, field_validator, _masked_compiler(compiler, mask[name]))
+            for name, field_validator in fields if name in mask]
 
-    Args:
-        data_type (Validator): Validator for obj.
-        obj (object): Object to be serialized.
-        caller_permissions (list): The list of raw-string caller permissions
-            with which to serialize.
+def _check_field_mask(validator, field_mask, caller_permissions):
+    """
+    Raises ValueError if a name in the tree ``field_mask`` (see ``_parse_field_mask``) is not
+    the name of a field of any of the structs it applies to in ``validator``, including their
+    subtypes and the structs of union members. A misspelled name would otherwise silently
+    leave the field out.
+    """
+    def check(validators, mask, path):
+        fields = {}  # type: typing.Dict[str, typing.List[bv.Validator]]
+        seen = set()  # type: typing.Set[typing.Any]
+        for v in validators:
+            _collect_mask_fields(v, caller_permissions, fields, seen)
+        for name, child in mask:
+            if name not in fields:
+                raise ValueError('field path %r does not name a field' %
+                                 '.'.join(path + (name,)))
+            if child is not None:
+                check(fields[name], child, path + (name,))
+
+    if field_mask is not None:
+        check([validator], field_mask, ())
+
+def _collect_mask_fields(validator, caller_permissions, fields, seen):
+    """
+    Adds the validators of the fields that a field mask applied to ``validator`` can name to
+    ``fields``, a map from field name to validators. Definitions in ``seen`` are skipped.
+    """
+    while isinstance(validator, (bv.Nullable, bv.List, bv.Map)):
+        if isinstance(validator, bv.Nullable):
+            validator = validator.validator
+        elif isinstance(validator, bv.List):
+            validator = validator.item_validator
+        else:
+            validator = validator.value_validator
+    if not isinstance(validator, (bv.Struct, bv.Union)) or validator.definition in seen:
+        return
+    definition = validator.definition
+    seen.add(definition)
+    if isinstance(validator, bv.Union):
+        for member in bv.permissioned_tagmap(definition, caller_permissions).values():
+            _collect_mask_fields(member, caller_permissions, fields, seen)
+        return
+    for name, field_validator in bv.permissioned_fields(definition, caller_permissions):
+        fields.setdefault(name, []).append(field_validator)
+    if isinstance(validator, bv.StructTree):
+        for _, subtype in definition._pytype_to_tag_and_subtype_.values():
+            _collect_mask_fields(subtype, caller_permissions, fields, seen)
+
+
+class _EncodePlanCompiler:
+    """
+    Compiles validators into encode plans.
 
-    Returns:
-        An object that when passed to json.dumps() will produce a string
-        giving the JSON-encoded object.
+    A plan is a callable taking a single value and returning its JSON-compatible encoding,
+    with the same validation and error reporting as ``StoneToPythonPrimitiveSerializer``.
+    Composite plans are memoized per definition, which also terminates recursive types.
 
-    See json_encode() for additional information about validation.
+    With a field mask, only the fields it includes are encoded, and only those are required to
+    be present.
     """
-    serializer = StoneToPythonPrimitiveSerializer(
-        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
-    return serializer.encode(data_type, obj)
 
-# --------------------------------------------------------------
-# JSON Decoder
-class PythonPrimitiveToStoneDecoder:
-    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict):
-        self.caller_permissions = (caller_permissions if
-            caller_permissions else CallerPermissionsDefault())
-        self.alias_validators = alias_validators
-        self.strict = strict
-        self._old_style = old_style
-        self._for_msgpack = for_msgpack
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style,
+                 should_redact, field_mask=None):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool, typing.Any) -> None # noqa: E501
+        self.caller_permissions = caller_permissions
+        self.alias_validators = alias_validators or {}
+        self.for_msgpack = for_msgpack
+        self.old_style = old_style
+        self.should_redact = should_redact
+        # Tree of the field mask (see _parse_field_mask), or None to encode all fields
+        self.field_mask = field_mask
+        # Serializers generated with the python_types backend's --generate-serializers option
+        # only implement the default options, without a field mask.
+        self.use_generated_options = not (
+            caller_permissions.permissions or self.alias_validators or for_msgpack or
+            old_style or should_redact)
+        self.use_generated = self.use_generated_options and field_mask is None
+        self._compilers = {field_mask: self}
+        self._memo = {}  # type: typing.Dict[typing.Any, typing.Callable[[typing.Any], typing.Any]] # noqa: E501
+
+    def compile(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any], typing.Any]
+        if self.should_redact and hasattr(validator, '_redact'):
+            return self._compile_redacted(validator)
 
-    @property
-    def for_msgpack(self):
+        if self.use_generated and isinstance(validator, (bv.Struct, bv.Union)) \
+                and '_to_json_compat' in vars(validator.definition):
+            return self._compile_generated(validator)
+        elif isinstance(validator, bv.List):
+            return self._compile_list(validator)
+        elif isinstance(validator, bv.Map):
+            return self._compile_map(validator)
+        elif isinstance(validator, bv.Nullable):
+            return self._compile_nullable(validator)
+        elif isinstance(validator, bv.Primitive):
+            return self._compile_primitive(validator)
+        elif isinstance(validator, bv.StructTree):
+            return self._memoized(('struct_tree', validator.definition),
+                                  self._compile_struct_tree, validator)
+        elif isinstance(validator, bv.Struct):
+            return self._memoized(('struct', validator.definition),
+                                  self._compile_struct, validator)
+        elif isinstance(validator, bv.Union):
+            return self._memoized(('union', validator.definition),
+                                  self._compile_union, validator)
+        else:
+            message = 'Unsupported data type {}'.format(type(validator).__name__)
+
+            def encode_unsupported(value):  # pylint: disable=unused-argument
+                raise bv.ValidationError(message)
+
+            return encode_unsupported
+
+    def _memoized(self, key, compile_f, validator):
+        plan = self._memo.get(key)
+        if plan is None:
+            plan = compile_f(validator)
+        return plan
+
+    def _compile_generated(self, validator):
+        if isinstance(validator, bv.StructTree):
+            def encode_generated(value):
+                return bb.json_compat_encode_struct_tree(validator, value)
+        else:
+            # Fields are already validated on assignment
+            validate = validator.validate_type_only
+            to_json_compat = validator.definition._to_json_compat
+
+            def encode_generated(value):
+                validate(value)
+                return to_json_compat(value)
+
+        return encode_generated
+
+    def _compile_redacted(self, validator):
+        apply = validator._redact.apply
+        apply_many = validator._redact.apply_many
+
+        def encode_redacted(value):
+            if isinstance(value, list):
+                return apply_many(value)
+            elif isinstance(value, dict):
+                return dict(zip(value, apply_many(value.values())))
+            else:
+                return apply(value)
+
+        return encode_redacted
+
+    def _compile_list(self, validator):
+        # Because Lists are mutable, we always validate them during serialization, in the same
+        # pass as they're encoded.
+        validate = validator.validate_type_only
+        item_validator = validator.item_validator
+        if self._batches_primitive(item_validator):
+            encode_items = self._compile_primitive_batch(item_validator)
+
+            def encode_list(value):
+                validate(value)
+                return encode_items(value)
+        else:
+            encode_item = self._compile_validated(item_validator)
+
+            def encode_list(value):
+                validate(value)
+                return [encode_item(item) for item in value]
+
+        return encode_list
+
+    def _compile_map(self, validator):
+        # Also validate maps during serialization because they are also mutable
+        validate = validator.validate_type_only
+        encode_key = self._compile_validated(validator.key_validator)
+        encode_value = self._compile_validated(validator.value_validator)
+
+        def encode_map(value):
+            validate(value)
+            return {
+                encode_key(k): encode_value(v) for k, v in value.items()
+            }
+
+        return encode_map
+
+    def _compile_validated(self, validator):
         """
-        EXPERIMENTAL: A flag associated with the serializer indicating
-        whether objects produced by the ``encode`` method should be
-        encoded for msgpack.
+        Returns a plan that validates its value with ``validator.validate`` and encodes the
+        result, for the members of lists and maps. Most plans already do all of the checks of
+        ``validate``, in which case they're returned as they are.
         """
-        return self._for_msgpack
+        encode = self.compile(validator)
+        if _encoding_validates(validator, self.should_redact) or self._masks_struct(validator):
+            return encode
+        validate = validator.validate
 
-    @property
-    def old_style(self):
+        def encode_validated(value):
+            return encode(validate(value))
+
+        return encode_validated
+
+    def _compile_nullable(self, validator):
+        encode_inner = self.compile(validator.validator)
+
+        if not isinstance(validator.validator, bv.Struct) or self._masks_struct(validator):
+            # The wrapped plan starts with exactly the validation Nullable.validate would do.
+            def encode_nullable(value):
+                if value is None:
+                    return None
+                return encode_inner(value)
+        else:
+            # Struct plans only check the type, but a nullable struct is fully validated
+            # (including required fields) before any of its fields are encoded.
+            validate = validator.validate
+
+            def encode_nullable(value):
+                if value is None:
+                    return None
+                validate(value)
+                return encode_inner(value)
+
+        return encode_nullable
+
+    def _batches_primitive(self, validator):
         """
-        A flag associated with the serializer indicating whether objects
-        produced by the ``encode`` method should be encoded according to
-        Dropbox's old or new API styles.
+        Returns whether the members of lists of ``validator`` are validated all at once with
+        ``validate_many`` rather than one by one as they're encoded. Alias validators are run
+        on each value right after it's validated, so their lists are still encoded one by one.
         """
-        return self._old_style
+        return isinstance(validator, bv.Primitive) and \
+            validator not in self.alias_validators and \
+            not (self.should_redact and hasattr(validator, '_redact'))
+
+    def _compile_primitive_batch(self, validator):
+        validate_many = validator.validate_many
+        convert = self._primitive_converter(validator)
+
+        if convert is None:
+            return validate_many
+        elif isinstance(validator, bv.Integer):
+            def encode_primitives(values):
+                values = validate_many(values)
+                if bool in set(map(type, values)):
+                    return list(map(convert, values))
+                return values
+        else:
+            def encode_primitives(values):
+                return list(map(convert, validate_many(values)))
 
-    def json_compat_obj_decode_helper(self, data_type, obj):
+        return encode_primitives
+
+    def _primitive_converter(self, validator):
         """
-        See json_compat_obj_decode() for argument descriptions.
+        Returns a function converting validated values of the primitive ``validator`` to
+        their encoding, or ``None`` if they're encoded as they are.
         """
-        if isinstance(data_type, bv.StructTree):
-            return self.decode_struct_tree(data_type, obj)
-        elif isinstance(data_type, bv.Struct):
-            return self.decode_struct(data_type, obj)
-        elif isinstance(data_type, bv.Union):
-            if self.old_style:
-                return self.decode_union_old(data_type, obj)
-            else:
-                return self.decode_union(data_type, obj)
-        elif isinstance(data_type, bv.List):
-            return self.decode_list(
-                data_type, obj)
-        elif isinstance(data_type, bv.Map):
-            return self.decode_map(
-                data_type, obj)
-        elif isinstance(data_type, bv.Nullable):
-            return self.decode_nullable(
-                data_type, obj)
-        elif isinstance(data_type, bv.Primitive):
-            # Set validate to false because validation will be done by the
-            # containing struct or union when the field is assigned.
-            return self.make_stone_friendly(data_type, obj, False)
+        if isinstance(validator, bv.Void):
+            def convert(value):  # pylint: disable=unused-argument
+                return None
+        elif isinstance(validator, bv.Timestamp):
+            convert = validator.render
+        elif isinstance(validator, bv.Bytes) and not self.for_msgpack:
+            def convert(value):
+                return base64.b64encode(value).decode('ascii')
+        elif isinstance(validator, bv.Integer):
+            def convert(value):
+                # bool is sub-class of int so it passes Integer validation,
+                # but we want the bool to be encoded as ``0`` or ``1``, rather
+                # than ``False`` or ``True``, respectively
+                return int(value) if isinstance(value, bool) else value
         else:
-            raise AssertionError('Cannot handle type %r.' % data_type)
+            convert = None
+        return convert
+
+    def _compile_primitive(self, validator):
+        validate = validator.validate
+        alias_validator = self.alias_validators.get(validator)
+        convert = self._primitive_converter(validator)
+
+        if alias_validator is not None:
+            def encode_primitive(value):
+                validate(value)
+                alias_validator(value)
+                return value if convert is None else convert(value)
+        elif convert is None:
+            def encode_primitive(value):
+                validate(value)
+                return value
+        else:
+            def encode_primitive(value):
+                validate(value)
+                return convert(value)
 
-    def decode_struct(self, data_type, obj):
+        return encode_primitive
+
+    def _masks_struct(self, validator):
         """
-        The data_type argument must be a Struct.
-        See json_compat_obj_decode() for argument descriptions.
+        Returns whether ``validator`` is a (nullable) struct whose fields are masked. Masked-out
+        fields needn't be present, and the struct plan already checks the type and reports
+        missing fields that are included, so such structs aren't validated beforehand.
         """
-        if obj is None and data_type.has_default():
-            return data_type.get_default()
-        elif not isinstance(obj, dict):
-            raise bv.ValidationError('expected object, got %s' %
-                                     bv.generic_type_name(obj))
-        all_fields = data_type.definition._all_fields_
-        for extra_permission in self.caller_permissions.permissions:
-            all_extra_fields = '_all_{}_fields_'.format(extra_permission)
-            all_fields = all_fields + getattr(data_type.definition, all_extra_fields, [])
+        if isinstance(validator, bv.Nullable):
+            validator = validator.validator
+        return self.field_mask is not None and isinstance(validator, bv.Struct)
 
-        if self.strict:
-            all_field_names = data_type.definition._all_field_names_
-            for extra_permission in self.caller_permissions.permissions:
-                all_extra_field_names = '_all_{}_field_names_'.format(extra_permission)
-                all_field_names = all_field_names.union(
-                    getattr(data_type.definition, all_extra_field_names, {}))
+    def _struct_validate_f(self, validator, default_validate):
+        if self.field_mask is not None:
+            # See _masks_struct
+            return validator.validate_type_only
+        if self.caller_permissions.permissions:
+            caller_permissions = self.caller_permissions
 
-            for key in obj:
-                if (key not in all_field_names and
-                        not key.startswith('.tag')):
-                    raise bv.ValidationError("unknown field '%s'" % key)
-        ins = data_type.definition()
-        self.decode_struct_fields(ins, all_fields, obj)
-        # Check that all required fields have been set.
-        data_type.validate_fields_only_with_permissions(ins, self.caller_permissions)
-        return ins
+            def validate_with_permissions(value):
+                validator.validate_with_permissions(value, caller_permissions)
 
-    def decode_struct_fields(self, ins, fields, obj):
+            return validate_with_permissions
+        return default_validate
+
+    def _compile_struct_fields(self, definition):
         """
-        Args:
-            ins: An instance of the class representing the data type being decoded.
-                The object will have its fields set.
-            fields: A tuple of (field_name: str, field_validator: Validator)
-            obj (dict): JSON-compatible dict that is being decoded.
-            strict (bool): See :func:`json_compat_obj_decode`.
-        Returns:
-            None: `ins` has its fields set based on the contents of `obj`.
+        Returns a function encoding the fields of an instance of ``definition`` that are
+        visible to the caller into an ``OrderedDict``. Fields are not validated, since they
+        already were on assignment.
         """
-        for name, field_data_type in fields:
-            if name in obj:
+        key = ('fields', definition)
+        encode_fields_f = self._memo.get(key)
+        if encode_fields_f is not None:
+            return encode_fields_f
+
+        fields = []  # type: typing.List[typing.Tuple[str, str, typing.Callable[[typing.Any], typing.Any]]] # noqa: E501
+
+        def encode_fields(value):
+            d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+            for field_name, value_key, encode_field in fields:
                 try:
-                    v = self.json_compat_obj_decode_helper(field_data_type, obj[name])
-                    setattr(ins, name, v)
-                except bv.ValidationError as e:
-                    e.add_parent(name)
-                    raise
-            elif field_data_type.has_default():
-                setattr(ins, name, field_data_type.get_default())
+                    field_value = getattr(value, field_name)
+                except AttributeError as exc:
+                    raise bv.ValidationError(exc.args[0])
+
+                if field_value is not None \
+                        and getattr(value, value_key) is not bb.NOT_SET:
+                    # Only serialize struct fields that have been explicitly
+                    # set, even if there is a default
+                    try:
+                        d[field_name] = encode_field(field_value)
+                    except bv.ValidationError as exc:
+                        exc.add_parent(field_name)
 
-    def decode_union(self, data_type, obj):
+                        raise
+            return d
+
+        # Register before compiling the fields so that recursive references resolve.
+        self._memo[key] = encode_fields
+
+        for field_name, field_validator, compiler in _masked_fields(
+                self, self._visible_fields(definition)):
+            fields.append(
+                (field_name, '_%s_value' % field_name, compiler.compile(field_validator)))
+        return encode_fields
+
+    def _visible_fields(self, definition):
+        return bv.permissioned_fields(definition, self.caller_permissions)
+
+    def _compile_struct(self, validator):
+        # Fields are already validated on assignment
+        validate = self._struct_validate_f(validator, validator.validate_type_only)
+
+        def encode_struct(value):
+            validate(value)
+            return encode_fields(value)
+
+        self._memo[('struct', validator.definition)] = encode_struct
+        encode_fields = self._compile_struct_fields(validator.definition)
+        return encode_struct
+
+    def _compile_struct_tree(self, validator):
+        validate = self._struct_validate_f(validator, validator.validate)
+        definition = validator.definition
+        old_style = self.old_style
+        # Python class -> (tag, fields encoder), filled in as subtypes are encountered.
+        subtypes = {}  # type: typing.Dict[type, typing.Tuple[str, typing.Callable[[typing.Any], typing.Any]]] # noqa: E501
+
+        def resolve_subtype(pytype):
+            assert pytype in definition._pytype_to_tag_and_subtype_, \
+                '{!r} is not a serializable subtype of {!r}.'.format(pytype, definition)
+
+            tags, subtype = definition._pytype_to_tag_and_subtype_[pytype]
+
+            assert len(tags) == 1, tags
+            assert not isinstance(subtype, bv.StructTree), \
+                'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+
+            resolved = subtypes[pytype] = (
+                tags[0], self._compile_struct_fields(subtype.definition))
+            return resolved
+
+        def encode_struct_tree(value):
+            validate(value)
+            pytype = type(value)
+            try:
+                tag, encode_fields = subtypes[pytype]
+            except KeyError:
+                tag, encode_fields = resolve_subtype(pytype)
+
+            if old_style:
+                return {tag: encode_fields(value)}
+            d = collections.OrderedDict()
+            d['.tag'] = tag
+            d.update(encode_fields(value))
+            return d
+
+        self._memo[('struct_tree', definition)] = encode_struct_tree
+        return encode_struct_tree
+
+    def _compile_union_tag(self, definition, tag):
         """
-        The data_type argument must be a Union.
-        See json_compat_obj_decode() for argument descriptions.
+        Returns a function encoding a union value with tag ``tag``.
         """
-        val = None
-        if isinstance(obj, str):
-            # Handles the shorthand format where the union is serialized as only
+        if not definition._is_tag_present(tag, self.caller_permissions):
+            message = "caller does not have access to '{}' tag".format(tag)
+
+            def encode_inaccessible(value):  # pylint: disable=unused-argument
+                raise bv.ValidationError(message)
+
+            return encode_inaccessible
+
+        field_validator = definition._get_val_data_type(tag, self.caller_permissions)
+
+        if field_validator is None or isinstance(field_validator, bv.Void):
+            if self.old_style:
+                def encode_symbol(value):  # pylint: disable=unused-argument
+                    return tag
+            else:
+                def encode_symbol(value):  # pylint: disable=unused-argument
+                    return {'.tag': tag}
+
+            return encode_symbol
+
+        nullable = isinstance(field_validator, bv.Nullable)
+        encode_val = self.compile(field_validator)
+
+        def encode_sub(sub_value):
+            try:
+                return encode_val(sub_value)
+            except bv.ValidationError as exc:
+                exc.add_parent(tag)
+
+                raise
+
+        if self.old_style:
+            def encode_tagged(value):
+                if nullable and value._value is None:
+                    return tag
+                return {tag: encode_sub(value._value)}
+
+            return encode_tagged
+
+        # We're only interested in what the wrapped validator is, since the null case is
+        # handled separately.
+        inner_validator = field_validator.validator if nullable else field_validator
+        if isinstance(inner_validator, bv.Struct) \
+                and not isinstance(inner_validator, bv.StructTree):
+            def encode_tagged(value):
+                if nullable and value._value is None:
+                    return {'.tag': tag}
+                d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+                d['.tag'] = tag
+                d.update(encode_sub(value._value))
+                return d
+        else:
+            def encode_tagged(value):
+                if nullable and value._value is None:
+                    return {'.tag': tag}
+                return collections.OrderedDict((
+                    ('.tag', tag),
+                    (tag, encode_sub(value._value)),
+                ))
+
+        return encode_tagged
+
+    def _compile_union(self, validator):
+        # Fields are already validated on assignment
+        validate = validator.validate_type_only
+        definition = validator.definition
+        # Tag -> encoder, filled in as tags are encountered.
+        tags = {}  # type: typing.Dict[str, typing.Callable[[typing.Any], typing.Any]]
+
+        def encode_union(value):
+            validate(value)
+            tag = value._tag
+            if tag is None:
+                raise bv.ValidationError('no tag set')
+            try:
+                encode_tag = tags[tag]
+            except KeyError:
+                encode_tag = tags[tag] = self._compile_union_tag(definition, tag)
+            return encode_tag(value)
+
+        self._memo[('union', definition)] = encode_union
+        return encode_union
+
+    # Streaming plans
+
+    def compile_streaming(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any], typing.Iterator[str]]
+        """
+        Like ``compile``, but the returned plan yields the JSON encoding of a value as a
+        sequence of string chunks. Structs, unions, lists and maps are written out member by
+        member. List items, map values and fields of any other type are encoded with their
+        regular plan and dumped as a single chunk each.
+        """
+        if self.should_redact and hasattr(validator, '_redact'):
+            return self._compile_streaming_leaf(validator)
+
+        if isinstance(validator, bv.List):
+            return self._compile_streaming_list(validator)
+        elif isinstance(validator, bv.Map):
+            return self._compile_streaming_map(validator)
+        elif isinstance(validator, bv.Nullable):
+            return self._compile_streaming_nullable(validator)
+        elif isinstance(validator, bv.StructTree):
+            return self._memoized(('streaming_struct_tree', validator.definition),
+                                  self._compile_streaming_struct_tree, validator)
+        elif isinstance(validator, bv.Struct):
+            return self._memoized(('streaming_struct', validator.definition),
+                                  self._compile_streaming_struct, validator)
+        elif isinstance(validator, bv.Union):
+            return self._memoized(('streaming_union', validator.definition),
+                                  self._compile_streaming_union, validator)
+        else:
+            return self._compile_streaming_leaf(validator)
+
+    def _compile_streaming_leaf(self, validator):
+        encode = self.compile(validator)
+
+        def iterencode_leaf(value):
+            return iter((json.dumps(encode(value)),))
+
+        return iterencode_leaf
+
+    def _compile_member(self, validator, stream_user_defined):
+        """
+        Returns ``(encode, iterencode)`` for a member of a container, exactly one of which is
+        set. Lists and maps are always streamed, structs and unions only if
+        ``stream_user_defined`` is set, and everything else is encoded as a single chunk.
+        """
+        if self.should_redact and hasattr(validator, '_redact'):
+            return self.compile(validator), None
+        inner_validator = validator.validator if isinstance(validator, bv.Nullable) else validator
+        if isinstance(inner_validator, (bv.List, bv.Map)) or (
+                stream_user_defined and isinstance(inner_validator, (bv.Struct, bv.Union))):
+            return None, self.compile_streaming(validator)
+        return self.compile(validator), None
+
+    def _compile_streaming_list(self, validator):
+        validate = validator.validate_type_only
+        item_validator = validator.item_validator
+        encode_item, iterencode_item = self._compile_member(item_validator, False)
+        if encode_item is not None:
+            encode_item = self._compile_validated(item_validator)
+
+        def iterencode_list(value):
+            validate(value)
+            if not value:
+                yield '[]'
+                return
+            sep = '['
+            for item in value:
+                if encode_item is not None:
+                    yield sep + json.dumps(encode_item(item))
+                else:
+                    yield sep
+                    yield from iterencode_item(item)
+                sep = ', '
+            yield ']'
+
+        return iterencode_list
+
+    def _compile_streaming_map(self, validator):
+        validate = validator.validate_type_only
+        value_validator = validator.value_validator
+        encode_key = self._compile_validated(validator.key_validator)
+        encode_value, iterencode_value = self._compile_member(value_validator, False)
+        if encode_value is not None:
+            encode_value = self._compile_validated(value_validator)
+
+        def iterencode_map(value):
+            validate(value)
+            if not value:
+                yield '{}'
+                return
+            sep = '{'
+            for k, v in value.items():
+                key = json.dumps(encode_key(k))
+                if encode_value is not None:
+                    yield sep + key + ': ' + json.dumps(encode_value(v))
+                else:
+                    yield sep + key + ': '
+                    yield from iterencode_value(v)
+                sep = ', '
+            yield '}'
+
+        return iterencode_map
+
+    def _compile_streaming_nullable(self, validator):
+        iterencode_inner = self.compile_streaming(validator.validator)
+        validate = validator.validate if isinstance(validator.validator, bv.Struct) else None
+
+        def iterencode_nullable(value):
+            if value is None:
+                return iter(('null',))
+            if validate is not None:
+                validate(value)
+            return iterencode_inner(value)
+
+        return iterencode_nullable
+
+    def _compile_streaming_struct_fields(self, definition):
+        """
+        Returns a function ``f(value, opening)`` yielding the fields of an instance of
+        ``definition`` visible to the caller as the members of a JSON object that starts with
+        ``opening``, which is either ``'{'`` or ``'{'`` followed by members already written.
+        """
+        key = ('streaming_fields', definition)
+        iterencode_fields_f = self._memo.get(key)
+        if iterencode_fields_f is not None:
+            return iterencode_fields_f
+
+        fields = []  # type: typing.List[typing.Tuple[str, str, str, typing.Any, typing.Any]]
+
+        def iterencode_fields(value, opening):
+            sep = opening if opening == '{' else opening + ', '
+            written = False
+            for field_name, value_key, prefix, encode_field, iterencode_field in fields:
+                try:
+                    field_value = getattr(value, field_name)
+                except AttributeError as exc:
+                    raise bv.ValidationError(exc.args[0])
+
+                if field_value is None or getattr(value, value_key) is bb.NOT_SET:
+                    # Only serialize struct fields that have been explicitly
+                    # set, even if there is a default
+                    continue
+                try:
+                    if encode_field is not None:
+                        yield sep + prefix + json.dumps(encode_field(field_value))
+                    else:
+                        yield sep + prefix
+                        yield from iterencode_field(field_value)
+                except bv.ValidationError as exc:
+                    exc.add_parent(field_name)
+
+                    raise
+                sep = ', '
+                written = True
+            yield '}' if written else opening + '}'
+
+        # Register before compiling the fields so that recursive references resolve.
+        self._memo[key] = iterencode_fields
+
+        for field_name, field_validator in self._visible_fields(definition):
+            encode_field, iterencode_field = self._compile_member(field_validator, True)
+            fields.append((field_name, '_%s_value' % field_name, json.dumps(field_name) + ': ',
+                           encode_field, iterencode_field))
+        return iterencode_fields
+
+    def _compile_streaming_struct(self, validator):
+        validate = self._struct_validate_f(validator, validator.validate_type_only)
+
+        def iterencode_struct(value):
+            validate(value)
+            return iterencode_fields(value, '{')
+
+        self._memo[('streaming_struct', validator.definition)] = iterencode_struct
+        iterencode_fields = self._compile_streaming_struct_fields(validator.definition)
+        return iterencode_struct
+
+    def _compile_streaming_struct_tree(self, validator):
+        validate = self._struct_validate_f(validator, validator.validate)
+        definition = validator.definition
+        old_style = self.old_style
+        # Python class -> (tag, fields encoder), filled in as subtypes are encountered.
+        subtypes = {}  # type: typing.Dict[type, typing.Tuple[str, typing.Any]]
+
+        def resolve_subtype(pytype):
+            assert pytype in definition._pytype_to_tag_and_subtype_, \
+                '{!r} is not a serializable subtype of {!r}.'.format(pytype, definition)
+
+            tags, subtype = definition._pytype_to_tag_and_subtype_[pytype]
+
+            assert len(tags) == 1, tags
+            assert not isinstance(subtype, bv.StructTree), \
+                'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+
+            resolved = subtypes[pytype] = (
+                json.dumps(tags[0]), self._compile_streaming_struct_fields(subtype.definition))
+            return resolved
+
+        def iterencode_struct_tree(value):
+            validate(value)
+            pytype = type(value)
+            try:
+                tag, iterencode_fields = subtypes[pytype]
+            except KeyError:
+                tag, iterencode_fields = resolve_subtype(pytype)
+
+            if old_style:
+                return itertools.chain(
+                    ('{' + tag + ': ',), iterencode_fields(value, '{'), ('}',))
+            return iterencode_fields(value, '{".tag": ' + tag)
+
+        self._memo[('streaming_struct_tree', definition)] = iterencode_struct_tree
+        return iterencode_struct_tree
+
+    def _compile_streaming_union_tag(self, definition, tag):
+        """
+        Returns a function yielding the encoding of a union value with tag ``tag``.
+        """
+        if not definition._is_tag_present(tag, self.caller_permissions):
+            message = "caller does not have access to '{}' tag".format(tag)
+
+            def iterencode_inaccessible(value):  # pylint: disable=unused-argument
+                raise bv.ValidationError(message)
+
+            return iterencode_inaccessible
+
+        field_validator = definition._get_val_data_type(tag, self.caller_permissions)
+        symbol = json.dumps(tag if self.old_style else {'.tag': tag})
+
+        if field_validator is None or isinstance(field_validator, bv.Void):
+            def iterencode_symbol(value):  # pylint: disable=unused-argument
+                return iter((symbol,))
+
+            return iterencode_symbol
+
+        nullable = isinstance(field_validator, bv.Nullable)
+        # We're only interested in what the wrapped validator is, since the null case is
+        # handled separately.
+        inner_validator = field_validator.validator if nullable else field_validator
+        encoded_tag = json.dumps(tag)
+
+        if not self.old_style and isinstance(inner_validator, bv.Struct) \
+                and not isinstance(inner_validator, bv.StructTree):
+            # The struct's fields are merged into the union's object.
+            validate_struct = self._struct_validate_f(
+                inner_validator, inner_validator.validate_type_only)
+            validate = field_validator.validate if nullable else None
+            iterencode_fields = self._compile_streaming_struct_fields(inner_validator.definition)
+            opening = '{".tag": ' + encoded_tag
+
+            def iterencode_members(sub_value):
+                if validate is not None:
+                    validate(sub_value)
+                validate_struct(sub_value)
+                return iterencode_fields(sub_value, opening)
+        else:
+            if self.old_style:
+                opening, closing = '{' + encoded_tag + ': ', '}'
+            else:
+                opening, closing = '{".tag": ' + encoded_tag + ', ' + encoded_tag + ': ', '}'
+            iterencode_val = self.compile_streaming(field_validator)
+
+            def iterencode_members(sub_value):
+                return itertools.chain((opening,), iterencode_val(sub_value), (closing,))
+
+        def iterencode_tagged(value):
+            if nullable and value._value is None:
+                yield symbol
+                return
+            try:
+                yield from iterencode_members(value._value)
+            except bv.ValidationError as exc:
+                exc.add_parent(tag)
+
+                raise
+
+        return iterencode_tagged
+
+    def _compile_streaming_union(self, validator):
+        # Fields are already validated on assignment
+        validate = validator.validate_type_only
+        definition = validator.definition
+        # Tag -> encoder, filled in as tags are encountered.
+        tags = {}  # type: typing.Dict[str, typing.Callable[[typing.Any], typing.Iterator[str]]]
+
+        def iterencode_union(value):
+            validate(value)
+            tag = value._tag
+            if tag is None:
+                raise bv.ValidationError('no tag set')
+            try:
+                iterencode_tag = tags[tag]
+            except KeyError:
+                iterencode_tag = tags[tag] = self._compile_streaming_union_tag(definition, tag)
+            return iterencode_tag(value)
+
+        self._memo[('streaming_union', definition)] = iterencode_union
+        return iterencode_union
+
+
+@functools.lru_cache(maxsize=_PLAN_CACHE_SIZE)
+def _compile_cached_encode_plan(validator, permissions, aliases, for_msgpack, old_style,
+                                should_redact, streaming, field_mask):
+    compiler = _EncodePlanCompiler(
+        _FrozenCallerPermissions(permissions), dict(aliases), for_msgpack, old_style,
+        should_redact, field_mask)
+    _check_field_mask(validator, field_mask, compiler.caller_permissions)
+    return compiler.compile_streaming(validator) if streaming else compiler.compile(validator)
+
+
+def _get_encode_plan(validator, caller_permissions, alias_validators, for_msgpack, old_style,
+                     should_redact, streaming=False, field_mask=None):
+    """
+    Returns the (possibly cached) encode plan for ``validator`` and the given options. See
+    ``json_compat_obj_encode`` for argument descriptions. If ``streaming`` is set, the plan
+    is a streaming one (see ``_EncodePlanCompiler.compile_streaming``). ``field_mask`` is the
+    tree of a field mask (see ``_field_mask_tree``).
+    """
+    key = _plan_cache_key(caller_permissions, alias_validators)
+    if key is None:
+        compiler = _EncodePlanCompiler(
+            _FrozenCallerPermissions(caller_permissions.permissions if caller_permissions
+                                     else ()),
+            alias_validators, for_msgpack, old_style, should_redact, field_mask)
+        _check_field_mask(validator, field_mask, compiler.caller_permissions)
+        return compiler.compile_streaming(validator) if streaming else compiler.compile(validator)
+    permissions, aliases = key
+    return _compile_cached_encode_plan(
+        validator, permissions, aliases, bool(for_msgpack), bool(old_style),
+        bool(should_redact), bool(streaming), field_mask)
+
+# --------------------------------------------------------------
+# JSON Engines
+#
+# The JSON implementation behind json_encode(), json_decode() and their bytes variants is
+# pluggable. The standard library's json module is always available; faster optional ones are
+# registered at import if installed.
+
+class JsonEngine:
+    """
+    A JSON implementation.
+
+    Args:
+        name (str): Name the engine is registered under.
+        dumps (Callable[[typing.Any], str]): Serializes a JSON-compatible object.
+        loads (Callable[[str], typing.Any]): Deserializes a JSON document, raising
+            ValueError if it's malformed.
+        dumps_bytes (Callable[[typing.Any], bytes]): Like dumps, but returns UTF-8 bytes.
+            Defaults to encoding the output of dumps.
+        loads_bytes (Callable[[bytes], typing.Any]): Like loads, but takes UTF-8 bytes.
+            Defaults to loads.
+    """
+    __slots__ = ('name', 'dumps', 'loads', 'dumps_bytes', 'loads_bytes')
+
+    def __init__(self, name, dumps, loads, dumps_bytes=None, loads_bytes=None):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.dumps_bytes = dumps_bytes or (lambda obj: dumps(obj).encode('utf-8'))
+        self.loads_bytes = loads_bytes or loads
+
+    def __repr__(self):
+        return 'JsonEngine({!r})'.format(self.name)
+
+
+_json_engines = collections.OrderedDict()  # type: typing.Dict[str, JsonEngine]
+
+# Optional engines, fastest first
+_FAST_JSON_ENGINES = ('orjson', 'ujson')
+
+def register_json_engine(engine):
+    """
+    Makes a JsonEngine available to set_json_engine(), replacing any engine registered under
+    the same name.
+    """
+    _json_engines[engine.name] = engine
+
+def get_json_engine(name=None):
+    """
+    Returns the engine registered as ``name``, or if not given, the one that json_encode()
+    and json_decode() currently use.
+    """
+    if name is None:
+        return _json_engine
+    try:
+        return _json_engines[name]
+    except KeyError:
+        raise ValueError('Unknown JSON engine %r, expected one of %s.' %
+                         (name, ', '.join(_json_engines)))
+
+def set_json_engine(name):
+    """
+    Makes json_encode(), json_decode() and their bytes variants use the engine registered as
+    ``name``. If ``name`` is None, the defaults are restored: json_encode() and json_decode()
+    keep the stdlib's output format, while the bytes variants use the fastest engine
+    available.
+
+    Engines differ in their output formatting, e.g. whether separators are followed by a
+    space, but all produce equivalent JSON.
+    """
+    global _json_engine, _json_bytes_engine
+    if name is None:
+        _json_engine = _json_engines['json']
+        _json_bytes_engine = next(
+            (_json_engines[n] for n in _FAST_JSON_ENGINES if n in _json_engines), _json_engine)
+    else:
+        _json_engine = _json_bytes_engine = get_json_engine(name)
+
+def _json_dumps_bytes(obj):
+    # The stdlib encoder escapes non-ASCII characters by default.
+    return json.dumps(obj).encode('ascii')
+
+register_json_engine(JsonEngine('json', json.dumps, json.loads, _json_dumps_bytes))
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    register_json_engine(JsonEngine('ujson', ujson.dumps, ujson.loads))
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    register_json_engine(JsonEngine(
+        'orjson', lambda obj: orjson.dumps(obj).decode('utf-8'), orjson.loads, orjson.dumps,
+        orjson.loads))
+
+_json_engine = _json_bytes_engine = _json_engines['json']
+set_json_engine(None)
+
+# --------------------------------------------------------------
+# JSON Encoder
+#
+# These interfaces are preserved for backward compatibility and symmetry with deserialization
+# functions.
+
+def json_encode(data_type, obj, caller_permissions=None, alias_validators=None, old_style=False,
+                should_redact=False, field_mask=None):
+    """Encodes an object into JSON based on its type.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+        caller_permissions (list): The list of raw-string caller permissions with which
+                to serialize.
+        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
+            Custom validation functions. These must raise bv.ValidationError on
+            failure.
+        field_mask (Optional[Iterable[str]]): Paths of the struct fields to
+            encode, such as ``['entries[*].name', 'cursor']``. Paths are
+            field names separated by dots; lists, maps, nullables, unions and
+            struct subtypes are traversed implicitly, and a ``[*]`` suffix may
+            be added to a name to make that explicit. Other fields are
+            skipped at every depth, and needn't be present even if they're
+            required. A ValueError is raised if a name in a path is not
+            that of a field. By default, all fields are encoded.
+
+    Returns:
+        str: JSON-encoded object.
+
+    This function will also do additional validation that wasn't done by the
+    objects themselves:
+
+    1. The passed in obj may not have been validated with data_type yet.
+    2. If an object that should be a Struct was assigned to a field, its
+       type has been validated, but the presence of all required fields
+       hasn't been.
+    3. If an object that should be a Union was assigned to a field, whether
+       or not a tag has been set has not been validated.
+    4. A list may have passed validation initially, but been mutated since.
+
+    Example of serializing a struct to JSON:
+
+    struct FileRef
+       path String
+       rev String
+
+    > fr = FileRef()
+    > fr.path = 'a/b/c'
+    > fr.rev = '1234'
+    > JsonEncoder.encode(fr)
+    "{'path': 'a/b/c', 'rev': '1234'}"
+
+    Example of serializing a union to JSON:
+
+    union UploadMode
+        add
+        overwrite
+        update FileRef
+
+    > um = UploadMode()
+    > um.set_add()
+    > JsonEncoder.encode(um)
+    '"add"'
+    > um.update = fr
+    > JsonEncoder.encode(um)
+    "{'update': {'path': 'a/b/c', 'rev': '1234'}}"
+    """
+    for_msgpack = False
+    encode = _get_encode_plan(
+        data_type, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+        field_mask=_field_mask_tree(field_mask))
+    return _json_engine.dumps(encode(obj))
+
+def json_encode_bytes(data_type, obj, caller_permissions=None, alias_validators=None,
+                      old_style=False, should_redact=False, field_mask=None):
+    """Encodes an object into UTF-8 encoded JSON based on its type.
+
+    Unless set_json_engine() was called, the fastest JSON engine available is used, so the
+    output may be formatted differently from json_encode(). See json_encode() for argument
+    descriptions.
+
+    Returns:
+        bytes: JSON-encoded object.
+    """
+    for_msgpack = False
+    encode = _get_encode_plan(
+        data_type, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+        field_mask=_field_mask_tree(field_mask))
+    return _json_bytes_engine.dumps_bytes(encode(obj))
+
+def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_validators=None,
+                           old_style=False, for_msgpack=False, should_redact=False,
+                           field_mask=None):
+    """Encodes an object into a JSON-compatible dict based on its type.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+        caller_permissions (list): The list of raw-string caller permissions
+            with which to serialize.
+        field_mask (Optional[Iterable[str]]): Paths of the fields to encode.
+            See json_encode().
+
+    Returns:
+        An object that when passed to json.dumps() will produce a string
+        giving the JSON-encoded object.
+
+    See json_encode() for additional information about validation.
+    """
+    encode = _get_encode_plan(
+        data_type, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+        field_mask=_field_mask_tree(field_mask))
+    return encode(obj)
+
+# Default size, in characters, of the chunks produced by json_iterencode()
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+def json_iterencode(data_type, obj, caller_permissions=None, alias_validators=None,
+                    old_style=False, should_redact=False, chunk_size=_STREAM_CHUNK_SIZE):
+    """Encodes an object into JSON based on its type, as an iterator of string chunks.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+        chunk_size (int): Chunks are at least this many characters long, except for the
+            last one.
+
+    Returns:
+        Iterator[str]: Chunks that concatenate to the output of json_encode() for the same
+        arguments.
+
+    Unlike json_encode(), the encoded object is never held in memory in full. Structs,
+    unions, lists and maps are encoded member by member as the iterator is consumed, so
+    memory use stays flat for large lists. Because validation happens along the way, a
+    bv.ValidationError may be raised after some chunks have been produced.
+
+    See json_encode() for the other arguments and additional information about validation.
+    """
+    for_msgpack = False
+    iterencode = _get_encode_plan(
+        data_type, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+        streaming=True)
+    pieces = []  # type: typing.List[str]
+    size = 0
+    for piece in iterencode(obj):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+    if pieces:
+        yield ''.join(pieces)
+
+def json_encode_stream(data_type, obj, fp, caller_permissions=None, alias_validators=None,
+                       old_style=False, should_redact=False, chunk_size=_STREAM_CHUNK_SIZE):
+    """Encodes an object into JSON based on its type and writes it to a file object.
+
+    Args:
+        fp: A file-like object with a write() method accepting str.
+
+    The chunks of json_iterencode() are written as they are produced. See json_iterencode()
+    for the other arguments.
+    """
+    for chunk in json_iterencode(data_type, obj, caller_permissions=caller_permissions,
+                                 alias_validators=alias_validators, old_style=old_style,
+                                 should_redact=should_redact, chunk_size=chunk_size):
+        fp.write(chunk)
+
+# Default number of objects handed to an executor at a time by json_encode_many() and
+# json_decode_many()
+_BATCH_SIZE = 1000
+
+def json_encode_many(data_type, objs, caller_permissions=None, alias_validators=None,
+                     old_style=False, should_redact=False, executor=None,
+                     batch_size=_BATCH_SIZE, return_exceptions=False):
+    """Encodes many objects of the same type into JSON.
+
+    Args:
+        data_type (Validator): Validator for each of objs.
+        objs (Iterable): Objects to be serialized.
+        executor (Optional[concurrent.futures.Executor]): If set, objs are split into
+            batches that are encoded by the executor. With a ProcessPoolExecutor, the
+            arguments must be picklable and the types importable by the workers.
+        batch_size (int): Number of objects in each batch given to executor.
+        return_exceptions (bool): If set, a bv.ValidationError is returned in place of the
+            encoding of each invalid object, instead of being raised.
+
+    Returns:
+        List[str]: JSON-encoded objects, in the order of objs.
+
+    This is equivalent to calling json_encode() for each object, but the setup is only done
+    once per batch. A bv.ValidationError for an object has the object's index in objs,
+    such as '[3]', as its outermost parent.
+
+    See json_encode() for the other arguments and additional information about validation.
+    """
+    return _run_batches(
+        _json_encode_batch, objs, executor, batch_size,
+        (data_type, _freeze_caller_permissions(caller_permissions), alias_validators,
+         old_style, should_redact, return_exceptions))
+
+def _json_encode_batch(start, objs, data_type, caller_permissions, alias_validators, old_style,
+                       should_redact, return_exceptions):
+    for_msgpack = False
+    encode = _get_encode_plan(
+        data_type, caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
+    dumps = _json_engine.dumps
+    results = []
+    for i, obj in enumerate(objs, start):
+        try:
+            results.append(dumps(encode(obj)))
+        except bv.ValidationError as e:
+            e.add_parent('[%d]' % i)
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+def _freeze_caller_permissions(caller_permissions):
+    """
+    Returns a picklable equivalent of ``caller_permissions``, to be sent to an executor.
+    """
+    if caller_permissions is None:
+        return None
+    return _FrozenCallerPermissions(caller_permissions.permissions)
+
+def _run_batches(run_batch, items, executor, batch_size, args):
+    """
+    Calls ``run_batch(start, batch, *args)`` for consecutive batches of ``items``, where
+    ``start`` is the index of the batch in ``items``, and concatenates the results.
+
+    Without an executor, all items are run as one batch.
+    """
+    items = list(items)
+    if executor is None or len(items) <= batch_size:
+        return run_batch(0, items, *args)
+    futures = [executor.submit(run_batch, start, items[start:start + batch_size], *args)
+               for start in range(0, len(items), batch_size)]
+    results = []
+    try:
+        for future in futures:
+            results.extend(future.result())
+    finally:
+        for future in futures:
+            future.cancel()
+    return results
+
+# --------------------------------------------------------------
+# JSON Decoder
+class PythonPrimitiveToStoneDecoder:
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict):
+        self.caller_permissions = (caller_permissions if
+            caller_permissions else CallerPermissionsDefault())
+        self.alias_validators = alias_validators
+        self.strict = strict
+        self._old_style = old_style
+        self._for_msgpack = for_msgpack
+
+    @property
+    def for_msgpack(self):
+        """
+        EXPERIMENTAL: A flag associated with the serializer indicating
+        whether objects produced by the ``encode`` method should be
+        encoded for msgpack.
+        """
+        return self._for_msgpack
+
+    @property
+    def old_style(self):
+        """
+        A flag associated with the serializer indicating whether objects
+        produced by the ``encode`` method should be encoded according to
+        Dropbox's old or new API styles.
+        """
+        return self._old_style
+
+    def json_compat_obj_decode_helper(self, data_type, obj):
+        """
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if isinstance(data_type, bv.StructTree):
+            return self.decode_struct_tree(data_type, obj)
+        elif isinstance(data_type, bv.Struct):
+            return self.decode_struct(data_type, obj)
+        elif isinstance(data_type, bv.Union):
+            if self.old_style:
+                return self.decode_union_old(data_type, obj)
+            else:
+                return self.decode_union(data_type, obj)
+        elif isinstance(data_type, bv.List):
+            return self.decode_list(
+                data_type, obj)
+        elif isinstance(data_type, bv.Map):
+            return self.decode_map(
+                data_type, obj)
+        elif isinstance(data_type, bv.Nullable):
+            return self.decode_nullable(
+                data_type, obj)
+        elif isinstance(data_type, bv.Primitive):
+            # Set validate to false because validation will be done by the
+            # containing struct or union when the field is assigned.
+            return self.make_stone_friendly(data_type, obj, False)
+        else:
+            raise AssertionError('Cannot handle type %r.' % data_type)
+
+    def decode_struct(self, data_type, obj):
+        """
+        The data_type argument must be a Struct.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if obj is None and data_type.has_default():
+            return data_type.get_default()
+        elif not isinstance(obj, dict):
+            raise bv.ValidationError('expected object, got %s' %
+                                     bv.generic_type_name(obj))
+        all_fields = bv.permissioned_fields(data_type.definition, self.caller_permissions)
+
+        if self.strict:
+            all_field_names = bv.permissioned_field_names(
+                data_type.definition, self.caller_permissions)
+
+            for key in obj:
+                if (key not in all_field_names and
+                        not key.startswith('.tag')):
+                    raise bv.ValidationError("unknown field '%s'" % key)
+        ins = data_type.definition()
+        self.decode_struct_fields(ins, all_fields, obj)
+        # Check that all required fields have been set.
+        data_type.validate_fields_only_with_permissions(ins, self.caller_permissions)
+        return ins
+
+    def decode_struct_fields(self, ins, fields, obj):
+        """
+        Args:
+            ins: An instance of the class representing the data type being decoded.
+                The object will have its fields set.
+            fields: A tuple of (field_name: str, field_validator: Validator)
+            obj (dict): JSON-compatible dict that is being decoded.
+            strict (bool): See :func:`json_compat_obj_decode`.
+        Returns:
+            None: `ins` has its fields set based on the contents of `obj`.
+        """
+        for name, field_data_type in fields:
+            if name in obj:
+                try:
+                    v = self.json_compat_obj_decode_helper(field_data_type, obj[name])
+                    setattr(ins, name, v)
+                except bv.ValidationError as e:
+                    e.add_parent(name)
+                    raise
+            elif field_data_type.has_default():
+                setattr(ins, name, field_data_type.get_default())
+
+    def decode_union(self, data_type, obj):
+        """
+        The data_type argument must be a Union.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        val = None
+        if isinstance(obj, str):
+            # Handles the shorthand format where the union is serialized as only
             # the string of the tag.
             tag = obj
             if data_type.definition._is_tag_present(tag, self.caller_permissions):
-                val_data_type = data_type.definition._get_val_data_type(
-                    tag, self.caller_permissions)
+                val_data_type = data_type.definition._get_val_data_type(
+                    tag, self.caller_permissions)
+                if not isinstance(val_data_type, (bv.Void, bv.Nullable)):
+                    raise bv.ValidationError(
+                        "expected object for '%s', got symbol" % tag)
+                if tag == data_type.definition._catch_all:
+                    raise bv.ValidationError(
+                        "unexpected use of the catch-all tag '%s'" % tag)
+            elif not self.strict and data_type.definition._catch_all:
+                tag = data_type.definition._catch_all
+            else:
+                raise bv.ValidationError("unknown tag '%s'" % tag)
+        elif isinstance(obj, dict):
+            tag, val = self.decode_union_dict(data_type, obj)
+        else:
+            raise bv.ValidationError("expected string or object, got %s" %
+                                     bv.generic_type_name(obj))
+        return _make_union(data_type.definition, six.ensure_str(tag), val)
+
+    def decode_union_dict(self, data_type, obj):
+        if '.tag' not in obj:
+            raise bv.ValidationError("missing '.tag' key")
+        tag = obj['.tag']
+        if not isinstance(tag, str):
+            raise bv.ValidationError(
+                'tag must be string, got %s' % bv.generic_type_name(tag))
+
+        if not data_type.definition._is_tag_present(tag, self.caller_permissions):
+            if not self.strict and data_type.definition._catch_all:
+                return data_type.definition._catch_all, None
+            else:
+                raise bv.ValidationError("unknown tag '%s'" % tag)
+        if tag == data_type.definition._catch_all:
+            raise bv.ValidationError(
+                "unexpected use of the catch-all tag '%s'" % tag)
+
+        val_data_type = data_type.definition._get_val_data_type(tag, self.caller_permissions)
+        if isinstance(val_data_type, bv.Nullable):
+            val_data_type = val_data_type.validator
+            nullable = True
+        else:
+            nullable = False
+
+        if isinstance(val_data_type, bv.Void):
+            if self.strict:
+                # In strict mode, ensure there are no extraneous keys set. In
+                # non-strict mode, we accept that other keys may be set due to a
+                # change of the void type to another.
+                if tag in obj:
+                    if obj[tag] is not None:
+                        raise bv.ValidationError('expected null, got %s' %
+                                                 bv.generic_type_name(obj[tag]))
+                for key in obj:
+                    if key != tag and key != '.tag':
+                        raise bv.ValidationError("unexpected key '%s'" % key)
+            val = None
+        elif isinstance(val_data_type,
+                        (bv.Primitive, bv.List, bv.StructTree, bv.Union, bv.Map)):
+            if tag in obj:
+                raw_val = obj[tag]
+                try:
+                    val = self.json_compat_obj_decode_helper(val_data_type, raw_val)
+                except bv.ValidationError as e:
+                    e.add_parent(tag)
+                    raise
+            else:
+                # Check no other keys
+                if nullable:
+                    val = None
+                else:
+                    raise bv.ValidationError("missing '%s' key" % tag)
+            for key in obj:
+                if key != tag and key != '.tag':
+                    raise bv.ValidationError("unexpected key '%s'" % key)
+        elif isinstance(val_data_type, bv.Struct):
+            if nullable and len(obj) == 1:  # only has a .tag key
+                val = None
+            else:
+                # assume it's not null
+                raw_val = obj
+                try:
+                    val = self.json_compat_obj_decode_helper(val_data_type, raw_val)
+                except bv.ValidationError as e:
+                    e.add_parent(tag)
+                    raise
+        else:
+            assert False, type(val_data_type)
+        return tag, val
+
+    def decode_union_old(self, data_type, obj):
+        """
+        The data_type argument must be a Union.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        val = None
+        if isinstance(obj, str):
+            # Union member has no associated value
+            tag = obj
+            if data_type.definition._is_tag_present(tag, self.caller_permissions):
+                val_data_type = data_type.definition._get_val_data_type(tag,
+                                                                        self.caller_permissions)
                 if not isinstance(val_data_type, (bv.Void, bv.Nullable)):
                     raise bv.ValidationError(
-                        "expected object for '%s', got symbol" % tag)
-                if tag == data_type.definition._catch_all:
+                        "expected object for '%s', got symbol" % tag)
+            else:
+                if not self.strict and data_type.definition._catch_all:
+                    tag = data_type.definition._catch_all
+                else:
+                    raise bv.ValidationError("unknown tag '%s'" % tag)
+        elif isinstance(obj, dict):
+            # Union member has value
+            if len(obj) != 1:
+                raise bv.ValidationError('expected 1 key, got %s' % len(obj))
+            tag = list(obj)[0]
+            raw_val = obj[tag]
+            if data_type.definition._is_tag_present(tag, self.caller_permissions):
+                val_data_type = data_type.definition._get_val_data_type(tag,
+                                                                        self.caller_permissions)
+                if isinstance(val_data_type, bv.Nullable) and raw_val is None:
+                    val = None
+                elif isinstance(val_data_type, bv.Void):
+                    if raw_val is None or not self.strict:
+                        # If raw_val is None, then this is the more verbose
+                        # representation of a void union member. If raw_val isn't
+                        # None, then maybe the spec has changed, so check if we're
+                        # in strict mode.
+                        val = None
+                    else:
+                        raise bv.ValidationError('expected null, got %s' %
+                                                 bv.generic_type_name(raw_val))
+                else:
+                    try:
+                        val = self.json_compat_obj_decode_helper(val_data_type, raw_val)
+                    except bv.ValidationError as e:
+                        e.add_parent(tag)
+                        raise
+            else:
+                if not self.strict and data_type.definition._catch_all:
+                    tag = data_type.definition._catch_all
+                else:
+                    raise bv.ValidationError("unknown tag '%s'" % tag)
+        else:
+            raise bv.ValidationError("expected string or object, got %s" %
+                                     bv.generic_type_name(obj))
+        return _make_union(data_type.definition, six.ensure_str(tag), val)
+
+    def decode_struct_tree(self, data_type, obj):
+        """
+        The data_type argument must be a StructTree.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        subtype = self.determine_struct_tree_subtype(data_type, obj)
+        return self.decode_struct(subtype, obj)
+
+    def determine_struct_tree_subtype(self, data_type, obj):
+        """
+        Searches through the JSON-object-compatible dict using the data type
+        definition to determine which of the enumerated subtypes `obj` is.
+        """
+        if '.tag' not in obj:
+            raise bv.ValidationError("missing '.tag' key")
+        if not isinstance(obj['.tag'], str):
+            raise bv.ValidationError('expected string, got %s' %
+                                     bv.generic_type_name(obj['.tag']),
+                                     parent='.tag')
+
+        # Find the subtype the tags refer to
+        full_tags_tuple = (obj['.tag'],)
+        if full_tags_tuple in data_type.definition._tag_to_subtype_:
+            subtype = data_type.definition._tag_to_subtype_[full_tags_tuple]
+            if isinstance(subtype, bv.StructTree):
+                raise bv.ValidationError("tag '%s' refers to non-leaf subtype" %
+                                         ('.'.join(full_tags_tuple)))
+            return subtype
+        else:
+            if self.strict:
+                # In strict mode, the entirety of the tag hierarchy should
+                # point to a known subtype.
+                raise bv.ValidationError("unknown subtype '%s'" %
+                                         '.'.join(full_tags_tuple))
+            else:
+                # If subtype was not found, use the base.
+                if data_type.definition._is_catch_all_:
+                    return data_type
+                else:
+                    raise bv.ValidationError(
+                        "unknown subtype '%s' and '%s' is not a catch-all" %
+                        ('.'.join(full_tags_tuple), data_type.definition.__name__))
+
+    def decode_list(self, data_type, obj):
+        """
+        The data_type argument must be a List.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if not isinstance(obj, list):
+            raise bv.ValidationError(
+                'expected list, got %s' % bv.generic_type_name(obj))
+        return [
+            self.json_compat_obj_decode_helper(data_type.item_validator, item)
+            for item in obj]
+
+    def decode_map(self, data_type, obj):
+        """
+        The data_type argument must be a Map.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if not isinstance(obj, dict):
+            raise bv.ValidationError(
+                'expected dict, got %s' % bv.generic_type_name(obj))
+        return {
+            self.json_compat_obj_decode_helper(data_type.key_validator, key):
+            self.json_compat_obj_decode_helper(data_type.value_validator, value)
+            for key, value in obj.items()
+        }
+
+    def decode_nullable(self, data_type, obj):
+        """
+        The data_type argument must be a Nullable.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if obj is not None:
+            return self.json_compat_obj_decode_helper(data_type.validator, obj)
+        else:
+            return None
+
+    def make_stone_friendly(self, data_type, val, validate):
+        """
+        Convert a Python object to a type that will pass validation by its
+        validator.
+        Validation by ``alias_validators`` is performed even if ``validate`` is
+        false.
+        """
+        if isinstance(data_type, bv.Timestamp):
+            try:
+                ret = data_type.parse(val)
+            except (TypeError, ValueError) as e:
+                raise bv.ValidationError(e.args[0])
+        elif isinstance(data_type, bv.Bytes) and not self.for_msgpack:
+            try:
+                ret = base64.b64decode(val)
+            except (TypeError, binascii.Error):
+                raise bv.ValidationError('invalid base64-encoded bytes')
+        elif isinstance(data_type, bv.Void):
+            if self.strict and val is not None:
+                raise bv.ValidationError("expected null, got value")
+            return None
+        else:
+            if validate:
+                if self.caller_permissions.permissions:
+                    data_type.validate_with_permissions(val, self.caller_permissions)
+                else:
+                    data_type.validate(val)
+            ret = val
+        if self.alias_validators is not None and data_type in self.alias_validators:
+            self.alias_validators[data_type](ret)
+        return ret
+
+# ------------------------------------------------------------------------
+# Union construction
+#
+# Decoded unions whose tag has no value, such as void tags, are shared rather than created per
+# value. See ``bb.union_symbol``.
+
+def _has_default_union_init(definition):
+    return isinstance(definition, type) and issubclass(definition, bb.Union) and \
+        bb.wire(definition).__init__ is bb.Union.__init__
+
+def _make_union(definition, tag, val):
+    """
+    Returns ``definition(tag, val)``, sharing instances without a value where possible.
+    """
+    if val is None and _has_default_union_init(definition):
+        return bb.union_symbol(definition, tag)
+    return definition(tag, val)
+
+def _union_factory(definition, validate=True, masked=False):
+    """
+    Returns a faster equivalent of ``_make_union`` for ``definition``, for tags that the caller
+    knows to be valid. Values are validated as ``bb.Union.__init__`` would, except that
+    structs and unions are assumed to have the right type, as decoders guarantee. Values
+    aren't validated at all if ``validate`` is false, and structs in them are only checked for
+    their type if ``masked`` is (see ``_masked_validate_f``).
+    """
+    if not _has_default_union_init(definition):
+        return definition
+    new = definition.__new__
+    tagmap = bv.full_tagmap(definition)
+    validate_values = validate
+    symbols = {}  # type: typing.Dict[str, typing.Any]
+    # Per tag, the function validating its values, or None.
+    validators = {}  # type: typing.Dict[str, typing.Any]
+
+    def make_union(tag, val=None):
+        if val is None:
+            try:
+                return symbols[tag]
+            except KeyError:
+                symbol = symbols[tag] = bb.union_symbol(definition, tag)
+                return symbol
+        try:
+            validate = validators[tag]
+        except KeyError:
+            validator = tagmap[tag]
+            validate = validators[tag] = (
+                None if not validate_values or isinstance(validator, (bv.Struct, bv.Union))
+                else _masked_validate_f(validator) if masked else validator.validate)
+        if validate is not None:
+            validate(val)
+        union = new(definition)
+        union._tag = tag
+        union._value = val
+        return union
+
+    return make_union
+
+# ------------------------------------------------------------------------
+# Compiled decode plans
+#
+# The decoding counterpart of encode plans: the type dispatch of
+# ``PythonPrimitiveToStoneDecoder`` is resolved once per (validator, options) into a tree of
+# specialized decoder callables, with per-struct field tables, per-union tag tables and
+# per-StructTree subtype tables.
+
+def _decode_as_is(val):
+    return val
+
+def _decode_ignoring_path(decode):
+    def decode_with_path(obj, path):  # pylint: disable=unused-argument
+        return decode(obj)
+
+    return decode_with_path
+
+def _normalizes(data_type):
+    """
+    Returns whether ``data_type.validate`` may return a different value than the one it's
+    given, which happens for reals and containers of reals. Trusted decoding still assigns
+    such fields through their setter, so that it decodes the same values.
+    """
+    if isinstance(data_type, bv.Nullable):
+        return _normalizes(data_type.validator)
+    elif isinstance(data_type, bv.List):
+        return _normalizes(data_type.item_validator)
+    elif isinstance(data_type, bv.Map):
+        return _normalizes(data_type.key_validator) or _normalizes(data_type.value_validator)
+    return isinstance(data_type, bv.Real)
+
+def _nests_structs(data_type):
+    """
+    Returns whether ``data_type`` is a (nullable) list or map with structs among its members,
+    at any depth. Their ``validate`` checks that the structs have all their required fields.
+    """
+    if isinstance(data_type, bv.Nullable):
+        data_type = data_type.validator
+    if isinstance(data_type, bv.List):
+        member_data_type = data_type.item_validator
+    elif isinstance(data_type, bv.Map):
+        member_data_type = data_type.value_validator
+    else:
+        return False
+    if isinstance(member_data_type, bv.Nullable):
+        member_data_type = member_data_type.validator
+    return isinstance(member_data_type, bv.Struct) or _nests_structs(member_data_type)
+
+def _masked_validate_f(data_type):
+    """
+    Returns a function validating values of ``data_type`` like its ``validate``, except that
+    structs are only checked for their type. With a field mask, decoded structs may lack
+    required fields that are masked out, and decode plans report missing fields that aren't.
+    """
+    if isinstance(data_type, bv.Nullable):
+        validate_inner = _masked_validate_f(data_type.validator)
+
+        def validate_nullable(val):
+            return None if val is None else validate_inner(val)
+
+        return validate_nullable
+    elif isinstance(data_type, bv.Struct):
+        validate_type_only = data_type.validate_type_only
+
+        def validate_struct(val):
+            validate_type_only(val)
+            return val
+
+        return validate_struct
+    elif isinstance(data_type, bv.List) and _nests_structs(data_type):
+        validate_item = _masked_validate_f(data_type.item_validator)
+
+        def validate_list(val):
+            data_type.validate_type_only(val)
+            return [validate_item(item) for item in val]
+
+        return validate_list
+    elif isinstance(data_type, bv.Map) and _nests_structs(data_type):
+        validate_key = data_type.key_validator.validate
+        validate_value = _masked_validate_f(data_type.value_validator)
+
+        def validate_map(val):
+            data_type.validate_type_only(val)
+            return {validate_key(key): validate_value(value) for key, value in val.items()}
+
+        return validate_map
+    return data_type.validate
+
+def _compile_masked_field(compiler, field_data_type):
+    """
+    Returns the decoder of a struct field compiled with ``compiler``, and whether its values
+    are assigned to the field's slot rather than through its setter. They are for lists and
+    maps of structs with masked fields, which the setter would reject for lacking required
+    fields that are masked out; they're validated with ``_masked_validate_f`` instead.
+    """
+    decode = compiler.compile(field_data_type)
+    if compiler.field_mask is None or not _nests_structs(field_data_type):
+        return decode, False
+    validate = _masked_validate_f(field_data_type)
+
+    def decode_masked(obj):
+        return validate(decode(obj))
+
+    return decode_masked, True
+
+class _DecodePlanCompiler:
+    """
+    Compiles validators into decode plans.
+
+    A plan is a callable taking a single JSON-compatible object and returning the decoded
+    value, with the same validation and error reporting as ``PythonPrimitiveToStoneDecoder``.
+    Composite plans are memoized per definition, which also terminates recursive types.
+
+    With a field mask, only the fields it includes are decoded, and only those are required to
+    be present.
+    """
+
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict,
+                 trusted=False, lazy=False, field_mask=None):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool, bool, bool, typing.Any) -> None # noqa: E501
+        self.caller_permissions = caller_permissions
+        self.alias_validators = alias_validators or {}
+        self.for_msgpack = for_msgpack
+        self.old_style = old_style
+        self.strict = strict
+        self.trusted = trusted
+        self.lazy = lazy
+        # Tree of the field mask (see _parse_field_mask), or None to decode all fields
+        self.field_mask = field_mask
+        # Serializers generated with the python_types backend's --generate-serializers option
+        # only implement the default options without a field mask, and assign fields through
+        # their setters.
+        self.use_generated_options = not (
+            caller_permissions.permissions or self.alias_validators or for_msgpack or
+            old_style or trusted)
+        self.use_generated = self.use_generated_options and field_mask is None
+        self._compilers = {field_mask: self}
+        self._memo = {}  # type: typing.Dict[typing.Any, typing.Callable[[typing.Any], typing.Any]] # noqa: E501
+
+    def compile_top_level(self, data_type):
+        """
+        Like ``compile``, but primitives are fully validated since there is no containing
+        struct or union to do it on assignment, unless the input is trusted. In lazy mode,
+        structs are decoded lazily.
+        """
+        if isinstance(data_type, bv.Primitive):
+            return self._compile_primitive(data_type, validate=not self.trusted)
+        elif self.lazy and isinstance(data_type, bv.Struct) and \
+                not isinstance(data_type, bv.StructTree):
+            return self._compile_lazy_struct(data_type)
+        return self.compile(data_type)
+
+    def compile(self, data_type):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any], typing.Any]
+        if self.use_generated and isinstance(data_type, (bv.Struct, bv.Union)) \
+                and '_from_json_compat' in vars(data_type.definition):
+            return self._compile_generated(data_type)
+        elif isinstance(data_type, bv.StructTree):
+            return self._memoized(('struct_tree', data_type.definition),
+                                  self._compile_struct_tree, data_type)
+        elif isinstance(data_type, bv.Struct):
+            return self._memoized(('struct', data_type.definition),
+                                  self._compile_struct, data_type)
+        elif isinstance(data_type, bv.Union):
+            if self.old_style:
+                return self._memoized(('union', data_type.definition),
+                                      self._compile_union_old, data_type)
+            else:
+                return self._memoized(('union', data_type.definition),
+                                      self._compile_union, data_type)
+        elif isinstance(data_type, bv.List):
+            return self._compile_list(data_type)
+        elif isinstance(data_type, bv.Map):
+            return self._compile_map(data_type)
+        elif isinstance(data_type, bv.Nullable):
+            return self._compile_nullable(data_type)
+        elif isinstance(data_type, bv.Primitive):
+            # Set validate to false because validation will be done by the
+            # containing struct or union when the field is assigned.
+            return self._compile_primitive(data_type, validate=False)
+        else:
+            message = 'Cannot handle type %r.' % data_type
+
+            def decode_unsupported(obj):  # pylint: disable=unused-argument
+                raise AssertionError(message)
+
+            return decode_unsupported
+
+    def _memoized(self, key, compile_f, data_type):
+        plan = self._memo.get(key)
+        if plan is None:
+            plan = compile_f(data_type)
+        return plan
+
+    def _compile_generated(self, data_type):
+        strict = self.strict
+
+        if isinstance(data_type, bv.StructTree):
+            def decode_generated(obj):
+                return bb.json_compat_decode_struct_tree(data_type, obj, strict)
+        else:
+            from_json_compat = data_type.definition._from_json_compat
+
+            def decode_generated(obj):
+                return from_json_compat(obj, strict)
+
+        return decode_generated
+
+    def _compile_primitive(self, data_type, validate):
+        alias_validator = self.alias_validators.get(data_type)
+
+        if isinstance(data_type, bv.Void):
+            strict = self.strict
+
+            def decode_void(val):
+                if strict and val is not None:
+                    raise bv.ValidationError("expected null, got value")
+                return None
+
+            return decode_void
+        elif isinstance(data_type, bv.Timestamp):
+            parse = data_type.parse
+
+            def convert(val):
+                try:
+                    return parse(val)
+                except (TypeError, ValueError) as e:
+                    raise bv.ValidationError(e.args[0])
+        elif isinstance(data_type, bv.Bytes) and not self.for_msgpack:
+            def convert(val):
+                try:
+                    return base64.b64decode(val)
+                except (TypeError, binascii.Error):
+                    raise bv.ValidationError('invalid base64-encoded bytes')
+        elif validate:
+            convert_validate = data_type.validate
+
+            def convert(val):
+                convert_validate(val)
+                return val
+        else:
+            convert = None
+
+        if alias_validator is not None:
+            def decode_primitive(val):
+                ret = val if convert is None else convert(val)
+                alias_validator(ret)
+                return ret
+
+            return decode_primitive
+        elif convert is None:
+            return _decode_as_is
+        else:
+            return convert
+
+    def _compile_list(self, data_type):
+        decode_item = self.compile(data_type.item_validator)
+
+        if decode_item is _decode_as_is:
+            # The members are validated all at once by List.validate when the list is
+            # assigned to a field.
+            def decode_list(obj):
+                if not isinstance(obj, list):
+                    raise bv.ValidationError(
+                        'expected list, got %s' % bv.generic_type_name(obj))
+                return list(obj)
+        else:
+            def decode_list(obj):
+                if not isinstance(obj, list):
                     raise bv.ValidationError(
-                        "unexpected use of the catch-all tag '%s'" % tag)
-            elif not self.strict and data_type.definition._catch_all:
-                tag = data_type.definition._catch_all
+                        'expected list, got %s' % bv.generic_type_name(obj))
+                return [decode_item(item) for item in obj]
+
+        return decode_list
+
+    def _compile_map(self, data_type):
+        decode_key = self.compile(data_type.key_validator)
+        decode_value = self.compile(data_type.value_validator)
+
+        def decode_map(obj):
+            if not isinstance(obj, dict):
+                raise bv.ValidationError(
+                    'expected dict, got %s' % bv.generic_type_name(obj))
+            return {
+                decode_key(key): decode_value(value) for key, value in obj.items()
+            }
+
+        return decode_map
+
+    def _compile_nullable(self, data_type):
+        decode_inner = self.compile(data_type.validator)
+
+        def decode_nullable(obj):
+            if obj is not None:
+                return decode_inner(obj)
             else:
-                raise bv.ValidationError("unknown tag '%s'" % tag)
-        elif isinstance(obj, dict):
-            tag, val = self.decode_union_dict(data_type, obj)
+                return None
+
+        return decode_nullable
+
+    def _compile_struct(self, data_type):
+        if self.trusted:
+            return self._compile_trusted_struct(data_type)
+        definition = data_type.definition
+        caller_permissions = self.caller_permissions
+        strict = self.strict
+        validate_fields = data_type.validate_fields_only_with_permissions
+        not_set = bb.NOT_SET
+        # (field name, slot or None to use the setter, decoder, field validator), filled in
+        # below.
+        fields = []  # type: typing.List[typing.Tuple[str, typing.Optional[str], typing.Callable[[typing.Any], typing.Any], bv.Validator]] # noqa: E501
+
+        all_fields = bv.permissioned_fields(definition, caller_permissions)
+
+        if strict:
+            all_field_names = bv.permissioned_field_names(definition, caller_permissions)
         else:
-            raise bv.ValidationError("expected string or object, got %s" %
-                                     bv.generic_type_name(obj))
-        return data_type.definition(six.ensure_str(tag), val)
+            all_field_names = frozenset()
+
+        # Without a field mask, required fields are checked by validate_fields.
+        checked_fields = None if self.field_mask is None else self._checked_fields(definition)
+
+        def decode_struct(obj):
+            if obj is None and data_type.has_default():
+                return data_type.get_default()
+            elif not isinstance(obj, dict):
+                raise bv.ValidationError('expected object, got %s' %
+                                         bv.generic_type_name(obj))
+            if strict:
+                for key in obj:
+                    if (key not in all_field_names and
+                            not key.startswith('.tag')):
+                        raise bv.ValidationError("unknown field '%s'" % key)
 
-    def decode_union_dict(self, data_type, obj):
-        if '.tag' not in obj:
-            raise bv.ValidationError("missing '.tag' key")
-        tag = obj['.tag']
-        if not isinstance(tag, str):
-            raise bv.ValidationError(
-                'tag must be string, got %s' % bv.generic_type_name(tag))
+            ins = definition()
+            for name, slot, decode_field, field_data_type in fields:
+                if name in obj:
+                    try:
+                        if slot is None:
+                            setattr(ins, name, decode_field(obj[name]))
+                        else:
+                            val = decode_field(obj[name])
+                            if val is not None:
+                                setattr(ins, slot, val)
+                    except bv.ValidationError as e:
+                        e.add_parent(name)
+                        raise
+                elif field_data_type.has_default():
+                    setattr(ins, name, field_data_type.get_default())
+            # Check that all required fields have been set.
+            if checked_fields is None:
+                validate_fields(ins, caller_permissions)
+            else:
+                for name, slot in checked_fields:
+                    if getattr(ins, slot) is not_set and not hasattr(ins, name):
+                        raise bv.ValidationError("missing required field '%s'" % name)
+            return ins
+
+        # Register before compiling the fields so that recursive references resolve.
+        self._memo[('struct', definition)] = decode_struct
+        for name, field_data_type, compiler in _masked_fields(self, all_fields):
+            decode_field, assigns_slot = _compile_masked_field(compiler, field_data_type)
+            slot = '_%s_value' % name if assigns_slot else None
+            fields.append((name, slot, decode_field, field_data_type))
+        return decode_struct
+
+    def _compile_trusted_struct(self, data_type):
+        """
+        Like ``_compile_struct``, but decoded values are written directly to the
+        ``_<field>_value`` slots of the instance rather than validated again by the field
+        setters. Required fields are still checked for, in the same order as
+        ``validate_fields_only_with_permissions`` does.
+        """
+        definition = data_type.definition
+        caller_permissions = self.caller_permissions
+        strict = self.strict
+        not_set = bb.NOT_SET
+        # (field name, slot or None to use the setter, decoder, field validator), filled in
+        # below.
+        fields = []  # type: typing.List[typing.Tuple[str, typing.Optional[str], typing.Callable[[typing.Any], typing.Any], bv.Validator]] # noqa: E501
+
+        all_fields = bv.permissioned_fields(definition, caller_permissions)
+
+        if strict:
+            all_field_names = bv.permissioned_field_names(definition, caller_permissions)
+        else:
+            all_field_names = frozenset()
 
-        if not data_type.definition._is_tag_present(tag, self.caller_permissions):
-            if not self.strict and data_type.definition._catch_all:
-                return data_type.definition._catch_all, None
+        checked_fields = self._checked_fields(definition)
+
+        def decode_struct(obj):
+            if obj is None and data_type.has_default():
+                return data_type.get_default()
+            elif not isinstance(obj, dict):
+                raise bv.ValidationError('expected object, got %s' %
+                                         bv.generic_type_name(obj))
+            if strict:
+                for key in obj:
+                    if (key not in all_field_names and
+                            not key.startswith('.tag')):
+                        raise bv.ValidationError("unknown field '%s'" % key)
+
+            ins = definition()
+            for name, slot, decode_field, field_data_type in fields:
+                if name in obj:
+                    try:
+                        value = decode_field(obj[name])
+                        if slot is None:
+                            setattr(ins, name, value)
+                        elif value is not None:
+                            # None leaves a nullable field unset, as its setter would.
+                            setattr(ins, slot, value)
+                    except bv.ValidationError as e:
+                        e.add_parent(name)
+                        raise
+                elif field_data_type.has_default():
+                    value = field_data_type.get_default()
+                    if slot is None:
+                        setattr(ins, name, value)
+                    elif value is not None:
+                        # The default of a nullable field is None, which leaves it unset.
+                        setattr(ins, slot, value)
+            for name, slot in checked_fields:
+                if getattr(ins, slot) is not_set and not hasattr(ins, name):
+                    raise bv.ValidationError("missing required field '%s'" % name)
+            return ins
+
+        # Register before compiling the fields so that recursive references resolve.
+        self._memo[('struct', definition)] = decode_struct
+        for name, field_data_type, compiler in _masked_fields(self, all_fields):
+            slot = None if _normalizes(field_data_type) else '_%s_value' % name
+            fields.append((name, slot, compiler.compile(field_data_type), field_data_type))
+        return decode_struct
+
+    def _checked_fields(self, definition):
+        """
+        Returns the (field name, slot) pairs of the fields of ``definition`` that
+        ``validate_fields_only_with_permissions`` checks the presence of, in the same order,
+        leaving out fields excluded by the field mask.
+        """
+        field_names = list(definition._all_field_names_)
+        if self.caller_permissions.permissions:
+            field_names.extend(bv.extra_permissioned_field_names(
+                definition, tuple(self.caller_permissions.permissions)))
+        if self.field_mask is not None:
+            mask = dict(self.field_mask)
+            field_names = [name for name in field_names if name in mask]
+        return [(name, '_%s_value' % name) for name in field_names]
+
+    def _compile_lazy_struct(self, data_type):
+        """
+        Returns a function decoding an instance of the struct ``data_type`` from an object and
+        the path to it. Fields that are structs are decoded lazily in turn, and fields that are
+        unions, lists, maps, timestamps or bytes are decoded in full, when they're first read;
+        until then, their slot holds a ``bb.LazyValue``. Other fields are decoded right away.
+        """
+        definition = data_type.definition
+        key = ('lazy_struct', definition)
+        decode_lazy_struct = self._memo.get(key)
+        if decode_lazy_struct is not None:
+            return decode_lazy_struct
+
+        caller_permissions = self.caller_permissions
+        strict = self.strict
+        not_set = bb.NOT_SET
+        lazy_value = bb.LazyValue
+        # (field name, slot, decoder, lazy decoder or None, whether values are assigned to the
+        # slot, field validator), filled in below.
+        fields = []  # type: typing.List[typing.Tuple[str, str, typing.Callable[[typing.Any], typing.Any], typing.Optional[typing.Callable[[typing.Any, typing.Tuple[str, ...]], typing.Any]], bool, bv.Validator]] # noqa: E501
+
+        all_fields = bv.permissioned_fields(definition, caller_permissions)
+
+        if strict:
+            all_field_names = bv.permissioned_field_names(definition, caller_permissions)
+        else:
+            all_field_names = frozenset()
+
+        checked_fields = self._checked_fields(definition)
+
+        def decode_lazy_struct(obj, path=()):
+            if obj is None and data_type.has_default():
+                return data_type.get_default()
+            elif not isinstance(obj, dict):
+                raise bv.ValidationError('expected object, got %s' %
+                                         bv.generic_type_name(obj))
+            if strict:
+                for key in obj:
+                    if (key not in all_field_names and
+                            not key.startswith('.tag')):
+                        raise bv.ValidationError("unknown field '%s'" % key)
+
+            ins = definition()
+            for name, slot, decode_field, decode_lazy, assigns_slot, field_data_type in fields:
+                if name in obj:
+                    raw = obj[name]
+                    if decode_lazy is not None and raw is not None:
+                        setattr(ins, slot, lazy_value(decode_lazy, raw, path))
+                        continue
+                    try:
+                        if assigns_slot:
+                            val = decode_field(raw)
+                            if val is not None:
+                                setattr(ins, slot, val)
+                        else:
+                            setattr(ins, name, decode_field(raw))
+                    except bv.ValidationError as e:
+                        e.add_parent(name)
+                        raise
+                elif field_data_type.has_default():
+                    setattr(ins, name, field_data_type.get_default())
+            # Check that all required fields have been set, without decoding lazy ones.
+            for name, slot in checked_fields:
+                if getattr(ins, slot) is not_set and not hasattr(ins, name):
+                    raise bv.ValidationError("missing required field '%s'" % name)
+            return ins
+
+        # Register before compiling the fields so that recursive references resolve.
+        self._memo[key] = decode_lazy_struct
+        # Fields only visible to callers with extra permissions are decoded right away, since
+        # bb.validate_all() doesn't know about them.
+        public_field_names = frozenset(name for name, _ in definition._all_fields_)
+        for name, field_data_type, compiler in _masked_fields(self, all_fields):
+            decode_field, assigns_slot = _compile_masked_field(compiler, field_data_type)
+            inner_data_type = field_data_type
+            if isinstance(inner_data_type, bv.Nullable):
+                inner_data_type = inner_data_type.validator
+            # Materializing a lazy value goes through the setter, see _compile_masked_field.
+            # Fields with a bb.SlotAttribute read their slot directly, so they can't hold one.
+            if name not in public_field_names or assigns_slot or \
+                    isinstance(getattr(definition, name, None), bb.SlotAttribute):
+                decode_lazy = None
+            elif isinstance(inner_data_type, bv.Struct) and \
+                    not isinstance(inner_data_type, bv.StructTree):
+                decode_lazy = compiler._compile_lazy_struct(inner_data_type)
+            elif isinstance(inner_data_type, (bv.Struct, bv.Union, bv.List, bv.Map,
+                                              bv.Timestamp, bv.Bytes)):
+                decode_lazy = _decode_ignoring_path(decode_field)
             else:
-                raise bv.ValidationError("unknown tag '%s'" % tag)
-        if tag == data_type.definition._catch_all:
-            raise bv.ValidationError(
-                "unexpected use of the catch-all tag '%s'" % tag)
+                decode_lazy = None
+            fields.append((name, '_%s_value' % name, decode_field, decode_lazy, assigns_slot,
+                           field_data_type))
+        return decode_lazy_struct
+
+    def _compile_struct_tree(self, data_type):
+        definition = data_type.definition
+        strict = self.strict
+        # Tag -> decoder of the (leaf) subtype it refers to.
+        subtypes = {}  # type: typing.Dict[str, typing.Callable[[typing.Any], typing.Any]]
+
+        def resolve_subtype(tag):
+            full_tags_tuple = (tag,)
+            if full_tags_tuple in definition._tag_to_subtype_:
+                subtype = definition._tag_to_subtype_[full_tags_tuple]
+                if isinstance(subtype, bv.StructTree):
+                    raise bv.ValidationError("tag '%s' refers to non-leaf subtype" %
+                                             ('.'.join(full_tags_tuple)))
+                decode_subtype = subtypes[tag] = self._memoized(
+                    ('struct', subtype.definition), self._compile_struct, subtype)
+                return decode_subtype
+            elif strict:
+                # In strict mode, the entirety of the tag hierarchy should
+                # point to a known subtype.
+                raise bv.ValidationError("unknown subtype '%s'" %
+                                         '.'.join(full_tags_tuple))
+            elif definition._is_catch_all_:
+                # If subtype was not found, use the base. Unknown tags aren't cached since
+                # they come from the input.
+                return self._memoized(('struct', definition), self._compile_struct, data_type)
+            else:
+                raise bv.ValidationError(
+                    "unknown subtype '%s' and '%s' is not a catch-all" %
+                    ('.'.join(full_tags_tuple), definition.__name__))
+
+        def decode_struct_tree(obj):
+            if '.tag' not in obj:
+                raise bv.ValidationError("missing '.tag' key")
+            tag = obj['.tag']
+            if not isinstance(tag, str):
+                raise bv.ValidationError('expected string, got %s' %
+                                         bv.generic_type_name(tag),
+                                         parent='.tag')
+            try:
+                decode_subtype = subtypes[tag]
+            except KeyError:
+                decode_subtype = resolve_subtype(tag)
+            return decode_subtype(obj)
+
+        self._memo[('struct_tree', definition)] = decode_struct_tree
+        return decode_struct_tree
+
+    def _union_maker(self, definition):
+        """
+        Returns the function creating an instance of the union ``definition`` from a valid tag
+        and its decoded value.
+        """
+        return _union_factory(definition, validate=not self.trusted,
+                              masked=self.field_mask is not None)
+
+    def _union_tag_table(self, data_type, compile_tag):
+        """
+        Returns a function looking up the compiled entry for a tag of ``data_type``, or
+        ``None`` if the tag isn't visible to the caller. Entries are compiled on first use
+        and only known tags are cached, since tags come from the input.
+        """
+        definition = data_type.definition
+        caller_permissions = self.caller_permissions
+        tags = {}  # type: typing.Dict[str, typing.Any]
+
+        def lookup(tag):
+            try:
+                return tags[tag]
+            except KeyError:
+                pass
+            except TypeError:
+                # Unhashable, so certainly not a tag.
+                return None
+            if not definition._is_tag_present(tag, caller_permissions):
+                return None
+            entry = tags[tag] = compile_tag(
+                tag, definition._get_val_data_type(tag, caller_permissions))
+            return entry
+
+        return lookup
+
+    def _compile_union_tag(self, definition, tag, val_data_type):
+        """
+        Returns ``(symbol_error, decode_dict)`` for a tag of a union decoded in the new style.
+        ``symbol_error`` is the error message for the tag appearing as a bare symbol, if that
+        isn't allowed. ``decode_dict`` decodes the value of the tag from its object form.
+        """
+        strict = self.strict
+
+        if not isinstance(val_data_type, (bv.Void, bv.Nullable)):
+            symbol_error = "expected object for '%s', got symbol" % tag
+        elif tag == definition._catch_all:
+            symbol_error = "unexpected use of the catch-all tag '%s'" % tag
+        else:
+            symbol_error = None
 
-        val_data_type = data_type.definition._get_val_data_type(tag, self.caller_permissions)
         if isinstance(val_data_type, bv.Nullable):
             val_data_type = val_data_type.validator
             nullable = True
@@ -685,227 +2854,612 @@ class PythonPrimitiveToStoneDecoder:
             nullable = False
 
         if isinstance(val_data_type, bv.Void):
-            if self.strict:
-                # In strict mode, ensure there are no extraneous keys set. In
-                # non-strict mode, we accept that other keys may be set due to a
-                # change of the void type to another.
+            def decode_dict(obj):
+                if strict:
+                    # In strict mode, ensure there are no extraneous keys set. In
+                    # non-strict mode, we accept that other keys may be set due to a
+                    # change of the void type to another.
+                    if tag in obj:
+                        if obj[tag] is not None:
+                            raise bv.ValidationError('expected null, got %s' %
+                                                     bv.generic_type_name(obj[tag]))
+                    for key in obj:
+                        if key != tag and key != '.tag':
+                            raise bv.ValidationError("unexpected key '%s'" % key)
+                return None
+        elif isinstance(val_data_type,
+                        (bv.Primitive, bv.List, bv.StructTree, bv.Union, bv.Map)):
+            decode_val = self.compile(val_data_type)
+
+            def decode_dict(obj):
                 if tag in obj:
-                    if obj[tag] is not None:
-                        raise bv.ValidationError('expected null, got %s' %
-                                                 bv.generic_type_name(obj[tag]))
+                    raw_val = obj[tag]
+                    try:
+                        val = decode_val(raw_val)
+                    except bv.ValidationError as e:
+                        e.add_parent(tag)
+                        raise
+                else:
+                    # Check no other keys
+                    if nullable:
+                        val = None
+                    else:
+                        raise bv.ValidationError("missing '%s' key" % tag)
                 for key in obj:
                     if key != tag and key != '.tag':
                         raise bv.ValidationError("unexpected key '%s'" % key)
-            val = None
-        elif isinstance(val_data_type,
-                        (bv.Primitive, bv.List, bv.StructTree, bv.Union, bv.Map)):
-            if tag in obj:
-                raw_val = obj[tag]
-                try:
-                    val = self.json_compat_obj_decode_helper(val_data_type, raw_val)
-                except bv.ValidationError as e:
-                    e.add_parent(tag)
-                    raise
-            else:
-                # Check no other keys
-                if nullable:
-                    val = None
-                else:
-                    raise bv.ValidationError("missing '%s' key" % tag)
-            for key in obj:
-                if key != tag and key != '.tag':
-                    raise bv.ValidationError("unexpected key '%s'" % key)
+                return val
         elif isinstance(val_data_type, bv.Struct):
-            if nullable and len(obj) == 1:  # only has a .tag key
-                val = None
-            else:
+            decode_val = self.compile(val_data_type)
+
+            def decode_dict(obj):
+                if nullable and len(obj) == 1:  # only has a .tag key
+                    return None
                 # assume it's not null
-                raw_val = obj
                 try:
-                    val = self.json_compat_obj_decode_helper(val_data_type, raw_val)
+                    return decode_val(obj)
                 except bv.ValidationError as e:
                     e.add_parent(tag)
                     raise
         else:
             assert False, type(val_data_type)
-        return tag, val
 
-    def decode_union_old(self, data_type, obj):
-        """
-        The data_type argument must be a Union.
-        See json_compat_obj_decode() for argument descriptions.
-        """
-        val = None
-        if isinstance(obj, str):
-            # Union member has no associated value
-            tag = obj
-            if data_type.definition._is_tag_present(tag, self.caller_permissions):
-                val_data_type = data_type.definition._get_val_data_type(tag,
-                                                                        self.caller_permissions)
-                if not isinstance(val_data_type, (bv.Void, bv.Nullable)):
-                    raise bv.ValidationError(
-                        "expected object for '%s', got symbol" % tag)
-            else:
-                if not self.strict and data_type.definition._catch_all:
-                    tag = data_type.definition._catch_all
+        return symbol_error, decode_dict
+
+    def _compile_union(self, data_type):
+        definition = data_type.definition
+        strict = self.strict
+        catch_all = definition._catch_all
+        lookup = self._union_tag_table(
+            data_type, functools.partial(self._compile_union_tag, definition))
+        make_union = self._union_maker(definition)
+
+        def decode_union(obj):
+            val = None
+            if isinstance(obj, str):
+                # Handles the shorthand format where the union is serialized as only
+                # the string of the tag.
+                tag = obj
+                entry = lookup(tag)
+                if entry is not None:
+                    symbol_error = entry[0]
+                    if symbol_error is not None:
+                        raise bv.ValidationError(symbol_error)
+                elif not strict and catch_all:
+                    tag = catch_all
                 else:
                     raise bv.ValidationError("unknown tag '%s'" % tag)
-        elif isinstance(obj, dict):
-            # Union member has value
-            if len(obj) != 1:
-                raise bv.ValidationError('expected 1 key, got %s' % len(obj))
-            tag = list(obj)[0]
-            raw_val = obj[tag]
-            if data_type.definition._is_tag_present(tag, self.caller_permissions):
-                val_data_type = data_type.definition._get_val_data_type(tag,
-                                                                        self.caller_permissions)
-                if isinstance(val_data_type, bv.Nullable) and raw_val is None:
-                    val = None
-                elif isinstance(val_data_type, bv.Void):
-                    if raw_val is None or not self.strict:
-                        # If raw_val is None, then this is the more verbose
-                        # representation of a void union member. If raw_val isn't
-                        # None, then maybe the spec has changed, so check if we're
-                        # in strict mode.
-                        val = None
+            elif isinstance(obj, dict):
+                if '.tag' not in obj:
+                    raise bv.ValidationError("missing '.tag' key")
+                tag = obj['.tag']
+                if not isinstance(tag, str):
+                    raise bv.ValidationError(
+                        'tag must be string, got %s' % bv.generic_type_name(tag))
+                entry = lookup(tag)
+                if entry is None:
+                    if not strict and catch_all:
+                        tag = catch_all
                     else:
-                        raise bv.ValidationError('expected null, got %s' %
-                                                 bv.generic_type_name(raw_val))
+                        raise bv.ValidationError("unknown tag '%s'" % tag)
+                elif tag == catch_all:
+                    raise bv.ValidationError(
+                        "unexpected use of the catch-all tag '%s'" % tag)
                 else:
-                    try:
-                        val = self.json_compat_obj_decode_helper(val_data_type, raw_val)
-                    except bv.ValidationError as e:
-                        e.add_parent(tag)
-                        raise
+                    val = entry[1](obj)
             else:
-                if not self.strict and data_type.definition._catch_all:
-                    tag = data_type.definition._catch_all
-                else:
-                    raise bv.ValidationError("unknown tag '%s'" % tag)
-        else:
-            raise bv.ValidationError("expected string or object, got %s" %
-                                     bv.generic_type_name(obj))
-        return data_type.definition(six.ensure_str(tag), val)
+                raise bv.ValidationError("expected string or object, got %s" %
+                                         bv.generic_type_name(obj))
+            return make_union(tag, val)
 
-    def decode_struct_tree(self, data_type, obj):
-        """
-        The data_type argument must be a StructTree.
-        See json_compat_obj_decode() for argument descriptions.
-        """
-        subtype = self.determine_struct_tree_subtype(data_type, obj)
-        return self.decode_struct(subtype, obj)
+        self._memo[('union', definition)] = decode_union
+        return decode_union
 
-    def determine_struct_tree_subtype(self, data_type, obj):
+    def _compile_union_tag_old(self, tag, val_data_type):
         """
-        Searches through the JSON-object-compatible dict using the data type
-        definition to determine which of the enumerated subtypes `obj` is.
+        Returns ``(is_symbol, decode_val)`` for a tag of a union decoded in the old style.
         """
-        if '.tag' not in obj:
-            raise bv.ValidationError("missing '.tag' key")
-        if not isinstance(obj['.tag'], str):
-            raise bv.ValidationError('expected string, got %s' %
-                                     bv.generic_type_name(obj['.tag']),
-                                     parent='.tag')
+        strict = self.strict
+        is_symbol = isinstance(val_data_type, (bv.Void, bv.Nullable))
 
-        # Find the subtype the tags refer to
-        full_tags_tuple = (obj['.tag'],)
-        if full_tags_tuple in data_type.definition._tag_to_subtype_:
-            subtype = data_type.definition._tag_to_subtype_[full_tags_tuple]
-            if isinstance(subtype, bv.StructTree):
-                raise bv.ValidationError("tag '%s' refers to non-leaf subtype" %
-                                         ('.'.join(full_tags_tuple)))
-            return subtype
+        if isinstance(val_data_type, bv.Nullable):
+            decode_inner = self.compile(val_data_type)
+
+            def decode_val(raw_val):
+                if raw_val is None:
+                    return None
+                try:
+                    return decode_inner(raw_val)
+                except bv.ValidationError as e:
+                    e.add_parent(tag)
+                    raise
+        elif isinstance(val_data_type, bv.Void):
+            def decode_val(raw_val):
+                if raw_val is None or not strict:
+                    # If raw_val is None, then this is the more verbose
+                    # representation of a void union member. If raw_val isn't
+                    # None, then maybe the spec has changed, so check if we're
+                    # in strict mode.
+                    return None
+                else:
+                    raise bv.ValidationError('expected null, got %s' %
+                                             bv.generic_type_name(raw_val))
         else:
-            if self.strict:
-                # In strict mode, the entirety of the tag hierarchy should
-                # point to a known subtype.
-                raise bv.ValidationError("unknown subtype '%s'" %
-                                         '.'.join(full_tags_tuple))
-            else:
-                # If subtype was not found, use the base.
-                if data_type.definition._is_catch_all_:
-                    return data_type
+            decode_inner = self.compile(val_data_type)
+
+            def decode_val(raw_val):
+                try:
+                    return decode_inner(raw_val)
+                except bv.ValidationError as e:
+                    e.add_parent(tag)
+                    raise
+
+        return is_symbol, decode_val
+
+    def _compile_union_old(self, data_type):
+        definition = data_type.definition
+        strict = self.strict
+        catch_all = definition._catch_all
+        lookup = self._union_tag_table(data_type, self._compile_union_tag_old)
+        make_union = self._union_maker(definition)
+
+        def decode_union_old(obj):
+            val = None
+            if isinstance(obj, str):
+                # Union member has no associated value
+                tag = obj
+                entry = lookup(tag)
+                if entry is not None:
+                    if not entry[0]:
+                        raise bv.ValidationError(
+                            "expected object for '%s', got symbol" % tag)
+                elif not strict and catch_all:
+                    tag = catch_all
                 else:
-                    raise bv.ValidationError(
-                        "unknown subtype '%s' and '%s' is not a catch-all" %
-                        ('.'.join(full_tags_tuple), data_type.definition.__name__))
+                    raise bv.ValidationError("unknown tag '%s'" % tag)
+            elif isinstance(obj, dict):
+                # Union member has value
+                if len(obj) != 1:
+                    raise bv.ValidationError('expected 1 key, got %s' % len(obj))
+                tag = list(obj)[0]
+                entry = lookup(tag)
+                if entry is not None:
+                    val = entry[1](obj[tag])
+                elif not strict and catch_all:
+                    tag = catch_all
+                else:
+                    raise bv.ValidationError("unknown tag '%s'" % tag)
+            else:
+                raise bv.ValidationError("expected string or object, got %s" %
+                                         bv.generic_type_name(obj))
+            return make_union(tag, val)
+
+        self._memo[('union', definition)] = decode_union_old
+        return decode_union_old
+
+def _nests_composites(data_type):
+    """
+    Returns whether ``data_type`` is a struct or union, or has them among its members.
+    """
+    if isinstance(data_type, bv.Nullable):
+        return _nests_composites(data_type.validator)
+    elif isinstance(data_type, bv.List):
+        return _nests_composites(data_type.item_validator)
+    elif isinstance(data_type, bv.Map):
+        return _nests_composites(data_type.value_validator)
+    return isinstance(data_type, (bv.Struct, bv.Union))
+
+def _validate_decoded_f(data_type):
+    """
+    Returns a function validating a value returned by a validation plan for ``data_type`` like
+    ``data_type.validate``, where structs and unions are replaced by ``None`` since their
+    plans already validated them.
+    """
+    if not _nests_composites(data_type):
+        return data_type.validate
+    elif isinstance(data_type, (bv.Struct, bv.Union)):
+        return _decode_as_is
+    elif isinstance(data_type, bv.Nullable):
+        validate_inner = _validate_decoded_f(data_type.validator)
+        if validate_inner is _decode_as_is:
+            return validate_inner
+
+        def validate_nullable(val):
+            if val is not None:
+                validate_inner(val)
+
+        return validate_nullable
+    elif isinstance(data_type, bv.List):
+        validate_item = _validate_decoded_f(data_type.item_validator)
+
+        def validate_list(val):
+            data_type.validate_type_only(val)
+            for item in val:
+                validate_item(item)
+
+        return validate_list
+    else:
+        validate_key = data_type.key_validator.validate
+        validate_value = _validate_decoded_f(data_type.value_validator)
 
-    def decode_list(self, data_type, obj):
-        """
-        The data_type argument must be a List.
-        See json_compat_obj_decode() for argument descriptions.
-        """
-        if not isinstance(obj, list):
-            raise bv.ValidationError(
-                'expected list, got %s' % bv.generic_type_name(obj))
-        return [
-            self.json_compat_obj_decode_helper(data_type.item_validator, item)
-            for item in obj]
+        def validate_map(val):
+            data_type.validate_type_only(val)
+            for key, value in val.items():
+                validate_key(key)
+                validate_value(value)
 
-    def decode_map(self, data_type, obj):
-        """
-        The data_type argument must be a Map.
-        See json_compat_obj_decode() for argument descriptions.
-        """
-        if not isinstance(obj, dict):
-            raise bv.ValidationError(
-                'expected dict, got %s' % bv.generic_type_name(obj))
-        return {
-            self.json_compat_obj_decode_helper(data_type.key_validator, key):
-            self.json_compat_obj_decode_helper(data_type.value_validator, value)
-            for key, value in obj.items()
-        }
+        return validate_map
 
-    def decode_nullable(self, data_type, obj):
+class _ValidatePlanCompiler(_DecodePlanCompiler):
+    """
+    Compiles validators into validation plans: decode plans that return ``None`` instead of
+    instances of structs and unions, and only check what the instances would be created
+    from. Values are checked as the field setters and constructors of the instances would, so
+    errors are the same as when decoding.
+    """
+
+    def __init__(self, caller_permissions, alias_validators, strict, old_style=False):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool) -> None # noqa: E501
+        super().__init__(caller_permissions, alias_validators, for_msgpack=False,
+                         old_style=old_style, strict=strict)
+        self.use_generated = False
+
+    def compile_top_level(self, data_type):
         """
-        The data_type argument must be a Nullable.
-        See json_compat_obj_decode() for argument descriptions.
+        Like ``_DecodePlanCompiler.compile_top_level``, but the members of lists and maps are
+        also validated, as if they were assigned to a field.
         """
-        if obj is not None:
-            return self.json_compat_obj_decode_helper(data_type.validator, obj)
+        validate = super().compile_top_level(data_type)
+        if isinstance(data_type, (bv.Primitive, bv.Struct, bv.Union)):
+            return validate
+        validate_decoded = _validate_decoded_f(data_type)
+
+        def validate_top_level(obj):
+            validate_decoded(validate(obj))
+
+        return validate_top_level
+
+    def _compile_struct(self, data_type):
+        definition = data_type.definition
+        strict = self.strict
+        # (field name, validation plan, check of its result), filled in below.
+        fields = []  # type: typing.List[typing.Tuple[str, typing.Callable[[typing.Any], typing.Any], typing.Callable[[typing.Any], typing.Any]]] # noqa: E501
+
+        all_fields = bv.permissioned_fields(definition, self.caller_permissions)
+        field_data_types = dict(all_fields)
+
+        if strict:
+            all_field_names = bv.permissioned_field_names(definition, self.caller_permissions)
         else:
+            all_field_names = frozenset()
+
+        # Fields that an instance would be missing if they weren't in the object, in the order
+        # validate_fields_only_with_permissions checks them.
+        required_field_names = [
+            name for name, _ in self._checked_fields(definition)
+            if not _has_fallback(definition, name, field_data_types.get(name))]
+
+        def validate_struct(obj):
+            if obj is None and data_type.has_default():
+                return None
+            elif not isinstance(obj, dict):
+                raise bv.ValidationError('expected object, got %s' %
+                                         bv.generic_type_name(obj))
+            if strict:
+                for key in obj:
+                    if (key not in all_field_names and
+                            not key.startswith('.tag')):
+                        raise bv.ValidationError("unknown field '%s'" % key)
+
+            for name, validate_field, validate_decoded in fields:
+                if name in obj:
+                    try:
+                        validate_decoded(validate_field(obj[name]))
+                    except bv.ValidationError as e:
+                        e.add_parent(name)
+                        raise
+            for name in required_field_names:
+                if name not in obj:
+                    raise bv.ValidationError("missing required field '%s'" % name)
             return None
 
-    def make_stone_friendly(self, data_type, val, validate):
+        # Register before compiling the fields so that recursive references resolve.
+        self._memo[('struct', definition)] = validate_struct
+        for name, field_data_type in all_fields:
+            fields.append(
+                (name, self.compile(field_data_type), _validate_decoded_f(field_data_type)))
+        return validate_struct
+
+    def _union_maker(self, definition):
+        tagmap = bv.full_tagmap(definition)
+        # Per tag, the function validating its values, as in _union_factory.
+        validators = {}  # type: typing.Dict[str, typing.Callable[[typing.Any], typing.Any]]
+
+        def validate_union(tag, val=None):
+            try:
+                validate = validators[tag]
+            except KeyError:
+                validator = tagmap[tag]
+                # None is checked against the validator too, as bb.Union.__init__ does.
+                validate = validators[tag] = (
+                    None if isinstance(validator, bv.Void) else _validate_decoded_f(validator))
+            if validate is not None:
+                validate(val)
+            return None
+
+        return validate_union
+
+class _TranscodePlanCompiler(_DecodePlanCompiler):
+    """
+    Compiles validators into transcode plans, which take a valid JSON-compatible object and
+    return its encoding with the output options, as if it were decoded and encoded again.
+    Input is parsed like the decode plans do, and output follows the encode plans.
+    """
+
+    def __init__(self, caller_permissions, strict, old_style, output_caller_permissions,
+                 output_old_style, should_redact):
+        # type: (CallerPermissionsInterface, bool, bool, CallerPermissionsInterface, bool, bool) -> None # noqa: E501
+        super().__init__(caller_permissions, None, for_msgpack=False, old_style=old_style,
+                         strict=strict, trusted=True)
+        self.use_generated = False
+        self.output_caller_permissions = output_caller_permissions
+        self.output_old_style = output_old_style
+        self.should_redact = should_redact
+        self._encoder = _EncodePlanCompiler(
+            output_caller_permissions, None, for_msgpack=False, old_style=output_old_style,
+            should_redact=should_redact)
+        self._decoder = _DecodePlanCompiler(
+            caller_permissions, None, for_msgpack=False, old_style=old_style, strict=strict,
+            trusted=True)
+
+    def compile(self, data_type):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any], typing.Any]
+        if self.should_redact and hasattr(data_type, '_redact'):
+            # Redactors apply to decoded values.
+            decode = self._decoder.compile(data_type)
+            encode = self._encoder.compile(data_type)
+
+            def transcode_redacted(obj):
+                return encode(decode(obj))
+
+            return transcode_redacted
+        return super().compile(data_type)
+
+    def _compile_primitive(self, data_type, validate):
+        decode = super()._compile_primitive(data_type, validate=False)
+        if isinstance(data_type, bv.Real):
+            # Reals are converted to floats by their validator.
+            convert = float  # type: typing.Optional[typing.Callable[[typing.Any], typing.Any]]
+        else:
+            convert = self._encoder._primitive_converter(data_type)
+
+        if convert is None:
+            return decode
+        elif decode is _decode_as_is:
+            return convert
+        else:
+            def transcode_primitive(obj):
+                return convert(decode(obj))
+
+            return transcode_primitive
+
+    def _compile_struct(self, data_type):
+        definition = data_type.definition
+        # (field name, plan or None if the field isn't decoded, encoder of its default or None,
+        # whether it's required), filled in below.
+        fields = []  # type: typing.List[typing.Tuple[str, typing.Optional[typing.Callable[[typing.Any], typing.Any]], typing.Optional[typing.Callable[[typing.Any], typing.Any]], bool]] # noqa: E501
+
+        if data_type.has_default():
+            encode_default = self._encoder.compile(data_type)
+        else:
+            encode_default = None
+
+        def transcode_struct(obj):
+            if obj is None and encode_default is not None:
+                return encode_default(data_type.get_default())
+            d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+            for name, transcode_field, encode_field_default, required in fields:
+                if transcode_field is not None and name in obj:
+                    val = obj[name]
+                    if val is not None:
+                        try:
+                            d[name] = transcode_field(val)
+                        except bv.ValidationError as e:
+                            e.add_parent(name)
+                            raise
+                elif encode_field_default is not None:
+                    d[name] = encode_field_default(
+                        field_data_types[name].get_default())
+                elif required:
+                    raise bv.ValidationError("missing required field '%s'" % name)
+            return d
+
+        # Register before compiling the fields so that recursive references resolve.
+        self._memo[('struct', definition)] = transcode_struct
+        input_fields = dict(bv.permissioned_fields(definition, self.caller_permissions))
+        output_fields = bv.permissioned_fields(definition, self.output_caller_permissions)
+        field_data_types = dict(output_fields)
+        for name, field_data_type in output_fields:
+            # Fields set to None, like nullable fields by default, aren't encoded.
+            if field_data_type.has_default() and field_data_type.get_default() is not None:
+                encode_field_default = self._encoder.compile(field_data_type)
+            else:
+                encode_field_default = None
+            fields.append((
+                name,
+                self.compile(input_fields[name]) if name in input_fields else None,
+                encode_field_default,
+                not _has_fallback(definition, name, field_data_type),
+            ))
+        return transcode_struct
+
+    def _compile_struct_tree(self, data_type):
+        definition = data_type.definition
+        output_old_style = self.output_old_style
+        # Tag -> (output tag, plan of the subtype's fields), filled in as tags are encountered.
+        subtypes = {}  # type: typing.Dict[str, typing.Tuple[str, typing.Callable[[typing.Any], typing.Any]]] # noqa: E501
+
+        def resolve_subtype(tag):
+            subtype = definition._tag_to_subtype_.get((tag,))
+            if subtype is None:
+                # An unknown subtype decodes to the catch-all base type.
+                subtype = data_type
+            pytype = subtype.definition
+            assert pytype in definition._pytype_to_tag_and_subtype_, \
+                '{!r} is not a serializable subtype of {!r}.'.format(pytype, definition)
+            output_tags, _ = definition._pytype_to_tag_and_subtype_[pytype]
+            resolved = subtypes[tag] = (output_tags[0], self._memoized(
+                ('struct', pytype), self._compile_struct, subtype))
+            return resolved
+
+        def transcode_struct_tree(obj):
+            tag = obj['.tag']
+            try:
+                output_tag, transcode_fields = subtypes[tag]
+            except KeyError:
+                output_tag, transcode_fields = resolve_subtype(tag)
+            if output_old_style:
+                return {output_tag: transcode_fields(obj)}
+            d = collections.OrderedDict()
+            d['.tag'] = output_tag
+            d.update(transcode_fields(obj))
+            return d
+
+        self._memo[('struct_tree', definition)] = transcode_struct_tree
+        return transcode_struct_tree
+
+    def _union_maker(self, definition):
         """
-        Convert a Python object to a type that will pass validation by its
-        validator.
-        Validation by ``alias_validators`` is performed even if ``validate`` is
-        false.
+        Returns a function encoding a union from a valid tag and its transcoded value, as
+        ``_EncodePlanCompiler._compile_union_tag`` does.
         """
-        if isinstance(data_type, bv.Timestamp):
+        output_caller_permissions = self.output_caller_permissions
+        output_old_style = self.output_old_style
+        # Tag -> (whether the value is inlined, or None for symbols), filled in as tags are
+        # encountered.
+        tags = {}  # type: typing.Dict[str, typing.Optional[bool]]
+
+        def resolve_tag(tag):
+            if not definition._is_tag_present(tag, output_caller_permissions):
+                raise bv.ValidationError(
+                    "caller does not have access to '{}' tag".format(tag))
+            val_data_type = definition._get_val_data_type(tag, output_caller_permissions)
+            if val_data_type is None or isinstance(val_data_type, bv.Void):
+                inline = tags[tag] = None
+                return inline
+            if isinstance(val_data_type, bv.Nullable):
+                val_data_type = val_data_type.validator
+            inline = tags[tag] = isinstance(val_data_type, bv.Struct) and \
+                not isinstance(val_data_type, bv.StructTree)
+            return inline
+
+        def transcode_union(tag, val=None):
             try:
-                ret = datetime.datetime.strptime(val, data_type.format)
-            except (TypeError, ValueError) as e:
-                raise bv.ValidationError(e.args[0])
-        elif isinstance(data_type, bv.Bytes):
-            if self.for_msgpack:
-                if isinstance(val, str):
-                    ret = val.encode('utf-8')
-                else:
-                    ret = val
+                inline = tags[tag]
+            except KeyError:
+                inline = resolve_tag(tag)
+            if inline is None or val is None:
+                return tag if output_old_style else {'.tag': tag}
+            elif output_old_style:
+                return {tag: val}
+            d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+            d['.tag'] = tag
+            if inline:
+                d.update(val)
             else:
-                try:
-                    ret = base64.b64decode(val)
-                except (TypeError, binascii.Error):
-                    raise bv.ValidationError('invalid base64-encoded bytes')
-        elif isinstance(data_type, bv.Void):
-            if self.strict and val is not None:
-                raise bv.ValidationError("expected null, got value")
-            return None
-        else:
-            if validate:
-                if self.caller_permissions.permissions:
-                    data_type.validate_with_permissions(val, self.caller_permissions)
-                else:
-                    data_type.validate(val)
-            ret = val
-        if self.alias_validators is not None and data_type in self.alias_validators:
-            self.alias_validators[data_type](ret)
-        return ret
+                d[tag] = val
+            return d
+
+        return transcode_union
+
+def _has_fallback(definition, name, field_data_type):
+    """
+    Returns whether the field ``name`` of the struct ``definition`` has a value when it isn't
+    set: it's nullable, or it has a default.
+    """
+    if field_data_type is None:
+        return False
+    if isinstance(field_data_type, bv.Nullable) or field_data_type.has_default():
+        return True
+    attribute = vars(definition).get(name)
+    if attribute is None:
+        # Inherited from a parent struct
+        attribute = getattr(definition, name, None)
+    return isinstance(attribute, (bb.Attribute, bb.SlotAttribute)) and \
+        attribute.default is not bb.NO_DEFAULT
+
+
+@functools.lru_cache(maxsize=_PLAN_CACHE_SIZE)
+def _compile_cached_decode_plan(data_type, permissions, aliases, for_msgpack, old_style,
+                                strict, top_level, trusted, lazy, field_mask):
+    compiler = _DecodePlanCompiler(
+        _FrozenCallerPermissions(permissions), dict(aliases), for_msgpack, old_style, strict,
+        trusted, lazy, field_mask)
+    _check_field_mask(data_type, field_mask, compiler.caller_permissions)
+    return compiler.compile_top_level(data_type) if top_level else compiler.compile(data_type)
+
+
+def _get_decode_plan(data_type, caller_permissions, alias_validators, for_msgpack, old_style,
+                     strict, top_level=True, trusted=False, lazy=False, field_mask=None):
+    """
+    Returns the (possibly cached) decode plan for ``data_type`` and the given options. See
+    ``json_compat_obj_decode`` for argument descriptions. Unless ``top_level`` is set,
+    primitives are not validated, like members of a struct or union. ``field_mask`` is the
+    tree of a field mask (see ``_field_mask_tree``).
+    """
+    key = _plan_cache_key(caller_permissions, alias_validators)
+    if key is None:
+        compiler = _DecodePlanCompiler(
+            _FrozenCallerPermissions(caller_permissions.permissions if caller_permissions
+                                     else ()),
+            alias_validators, for_msgpack, old_style, strict, trusted, lazy, field_mask)
+        _check_field_mask(data_type, field_mask, compiler.caller_permissions)
+        return compiler.compile_top_level(data_type) if top_level else compiler.compile(data_type)
+    permissions, aliases = key
+    return _compile_cached_decode_plan(
+        data_type, permissions, aliases, bool(for_msgpack), bool(old_style), bool(strict),
+        bool(top_level), bool(trusted), bool(lazy), field_mask)
+
+@functools.lru_cache(maxsize=_PLAN_CACHE_SIZE)
+def _compile_cached_validate_plan(data_type, permissions, aliases, strict, old_style):
+    compiler = _ValidatePlanCompiler(
+        _FrozenCallerPermissions(permissions), dict(aliases), strict, old_style)
+    return compiler.compile_top_level(data_type)
+
+
+def _get_validate_plan(data_type, caller_permissions, alias_validators, strict,
+                       old_style=False):
+    """
+    Returns the (possibly cached) validation plan for ``data_type`` and the given options. See
+    ``json_compat_obj_validate`` for argument descriptions.
+    """
+    key = _plan_cache_key(caller_permissions, alias_validators)
+    if key is None:
+        compiler = _ValidatePlanCompiler(
+            _FrozenCallerPermissions(caller_permissions.permissions if caller_permissions
+                                     else ()),
+            alias_validators, strict, old_style)
+        return compiler.compile_top_level(data_type)
+    permissions, aliases = key
+    return _compile_cached_validate_plan(
+        data_type, permissions, aliases, bool(strict), bool(old_style))
+
+@functools.lru_cache(maxsize=_PLAN_CACHE_SIZE)
+def _get_transcode_plan(data_type, permissions, strict, old_style, output_permissions,
+                        output_old_style, should_redact):
+    """
+    Returns the cached transcode plan for ``data_type`` and the given options, where
+    ``permissions`` and ``output_permissions`` are tuples of caller permissions. See
+    ``json_compat_obj_transcode`` for the other argument descriptions.
+    """
+    compiler = _TranscodePlanCompiler(
+        _FrozenCallerPermissions(permissions), strict, old_style,
+        _FrozenCallerPermissions(output_permissions), output_old_style, should_redact)
+    return compiler.compile_top_level(data_type)
 
 def json_decode(data_type, serialized_obj, caller_permissions=None,
-                alias_validators=None, strict=True, old_style=False):
+                alias_validators=None, strict=True, old_style=False, trusted=False,
+                lazy=False, field_mask=None):
     """Performs the reverse operation of json_encode.
 
     Args:
@@ -922,6 +3476,25 @@ def json_decode(data_type, serialized_obj, caller_permissions=None,
             recipient of serialized JSON if it's guaranteed that its Stone
             specs are at least as recent as the senders it receives messages
             from.
+        trusted (bool): If trusted, serialized_obj is assumed to come from a
+            trusted sender that already validated it, such as a server
+            responding to a client. Decoded values are converted to their
+            Python types (e.g. timestamps and bytes) and required fields are
+            checked for, but values aren't validated again as they're
+            assigned to struct fields and unions.
+        lazy (bool): If lazy and data_type is a Struct, fields that are
+            structs, unions, lists, maps, timestamps or bytes are only decoded
+            (and validated) when they're first read, recursively for fields
+            that are structs. Validation errors are raised when the field is
+            read, with the path to it; use bb.validate_all() to decode all the
+            remaining fields at once. Missing required fields are still
+            reported right away. Structs generated with --slot-fields are
+            decoded in full.
+        field_mask (Optional[Iterable[str]]): Paths of the struct fields to
+            decode. Other fields are skipped at every depth, and needn't be
+            present even if they're required, so they're left unset. See
+            json_encode() for the format of the paths. By default, all fields
+            are decoded.
 
     Returns:
         The returned object depends on the input data_type.
@@ -938,18 +3511,40 @@ def json_decode(data_type, serialized_obj, caller_permissions=None,
             - Union -> An instance of its definition attribute.
     """
     try:
-        deserialized_obj = json.loads(serialized_obj)
+        deserialized_obj = _json_engine.loads(serialized_obj)
+    except ValueError:
+        raise bv.ValidationError('could not decode input as JSON')
+    else:
+        return json_compat_obj_decode(
+            data_type, deserialized_obj, caller_permissions=caller_permissions,
+            alias_validators=alias_validators, strict=strict, old_style=old_style,
+            trusted=trusted, lazy=lazy, field_mask=field_mask)
+
+def json_decode_bytes(data_type, serialized_obj, caller_permissions=None,
+                      alias_validators=None, strict=True, old_style=False, trusted=False,
+                      lazy=False, field_mask=None):
+    """Performs the reverse operation of json_encode_bytes.
+
+    Args:
+        serialized_obj (bytes): The UTF-8 encoded JSON to deserialize.
+
+    See json_decode() for the other arguments and the return value.
+    """
+    try:
+        deserialized_obj = _json_bytes_engine.loads_bytes(serialized_obj)
     except ValueError:
         raise bv.ValidationError('could not decode input as JSON')
     else:
         return json_compat_obj_decode(
             data_type, deserialized_obj, caller_permissions=caller_permissions,
-            alias_validators=alias_validators, strict=strict, old_style=old_style)
+            alias_validators=alias_validators, strict=strict, old_style=old_style,
+            trusted=trusted, lazy=lazy, field_mask=field_mask)
 
 
 def json_compat_obj_decode(data_type, obj, caller_permissions=None,
                            alias_validators=None, strict=True,
-                           old_style=False, for_msgpack=False):
+                           old_style=False, for_msgpack=False, trusted=False, lazy=False,
+                           field_mask=None):
     """
     Decodes a JSON-compatible object based on its data type into a
     representative Python object.
@@ -962,19 +3557,579 @@ def json_compat_obj_decode(data_type, obj, caller_permissions=None,
         strict (bool): If strict, then unknown struct fields will raise an
             error, and unknown union variants will raise an error even if a
             catch all field is specified. See json_decode() for more.
+        trusted (bool): If trusted, obj isn't validated again as it's decoded.
+            See json_decode().
+        lazy (bool): If lazy, structs are decoded lazily. See json_decode().
+        field_mask (Optional[Iterable[str]]): Paths of the fields to decode.
+            See json_decode().
 
     Returns:
         See json_decode().
     """
-    decoder = PythonPrimitiveToStoneDecoder(caller_permissions,
-        alias_validators, for_msgpack, old_style, strict)
+    decode = _get_decode_plan(
+        data_type, caller_permissions, alias_validators, for_msgpack, old_style, strict,
+        trusted=trusted, lazy=lazy, field_mask=_field_mask_tree(field_mask))
+    return decode(obj)
 
-    if isinstance(data_type, bv.Primitive):
-        return decoder.make_stone_friendly(
-            data_type, obj, True)
-    else:
-        return decoder.json_compat_obj_decode_helper(
-            data_type, obj)
+def json_validate(data_type, serialized_obj, caller_permissions=None, alias_validators=None,
+                  strict=True, old_style=False):
+    """
+    Checks that serialized JSON would decode into a valid value of data_type, without decoding
+    it into Python objects.
+
+    Args:
+        data_type (Validator): Validator for serialized_obj.
+        serialized_obj (Union[bytes, str]): The JSON to validate, either as a
+            string or as UTF-8 encoded bytes.
+
+    Raises:
+        bv.ValidationError: serialized_obj isn't valid, with the same message
+            and path as json_decode() would raise.
+
+    See json_decode() for the other arguments.
+    """
+    try:
+        if isinstance(serialized_obj, bytes):
+            deserialized_obj = _json_bytes_engine.loads_bytes(serialized_obj)
+        else:
+            deserialized_obj = _json_engine.loads(serialized_obj)
+    except ValueError:
+        raise bv.ValidationError('could not decode input as JSON')
+    json_compat_obj_validate(
+        data_type, deserialized_obj, caller_permissions=caller_permissions,
+        alias_validators=alias_validators, strict=strict, old_style=old_style)
+
+def json_compat_obj_validate(data_type, obj, caller_permissions=None, alias_validators=None,
+                             strict=True, old_style=False):
+    """
+    Checks that a JSON-compatible object would decode into a valid value of data_type. No
+    instances of structs or unions are created, so this is cheaper than
+    json_compat_obj_decode() when only the outcome matters, e.g. to validate a request before
+    forwarding it as is.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj: The JSON-compatible object to validate based on data_type.
+
+    Raises:
+        bv.ValidationError: obj isn't valid, with the same message and path as
+            json_compat_obj_decode() would raise. Unlike when decoding, the
+            members of lists and maps are validated at the top level too.
+
+    See json_compat_obj_decode() for the other arguments.
+    """
+    validate = _get_validate_plan(
+        data_type, caller_permissions, alias_validators, strict, old_style)
+    validate(obj)
+
+def json_transcode(data_type, serialized_obj, caller_permissions=None, alias_validators=None,
+                   strict=True, old_style=False, output_caller_permissions=None,
+                   output_old_style=False, should_redact=False, trusted=False):
+    """
+    Re-encodes serialized JSON with different options. See json_compat_obj_transcode().
+
+    Args:
+        serialized_obj (Union[bytes, str]): The JSON to transcode, either as a
+            string or as UTF-8 encoded bytes.
+
+    Returns:
+        str: The transcoded JSON.
+    """
+    try:
+        if isinstance(serialized_obj, bytes):
+            deserialized_obj = _json_bytes_engine.loads_bytes(serialized_obj)
+        else:
+            deserialized_obj = _json_engine.loads(serialized_obj)
+    except ValueError:
+        raise bv.ValidationError('could not decode input as JSON')
+    return _json_engine.dumps(json_compat_obj_transcode(
+        data_type, deserialized_obj, caller_permissions=caller_permissions,
+        alias_validators=alias_validators, strict=strict, old_style=old_style,
+        output_caller_permissions=output_caller_permissions,
+        output_old_style=output_old_style, should_redact=should_redact, trusted=trusted))
+
+def json_compat_obj_transcode(data_type, obj, caller_permissions=None, alias_validators=None,
+                              strict=True, old_style=False, output_caller_permissions=None,
+                              output_old_style=False, should_redact=False, trusted=False):
+    """
+    Re-encodes a JSON-compatible object with different options, without decoding it into
+    instances of structs and unions. The result is the same as that of
+    json_compat_obj_encode() on the result of json_compat_obj_decode(), e.g. to convert
+    between old and new style unions, to strip fields that a caller doesn't have access to,
+    or to redact a message for logging.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj: The JSON-compatible object to transcode based on data_type.
+        caller_permissions (list): The caller permissions with which obj is
+            decoded.
+        alias_validators, strict, old_style: The options with which obj is
+            decoded. See json_compat_obj_decode().
+        output_caller_permissions (list): The caller permissions with which
+            the result is encoded. Fields and tags that the caller doesn't have
+            access to are left out.
+        output_old_style (bool): Whether unions are encoded in the old style.
+        should_redact (bool): Whether to redact the result. See json_encode().
+        trusted (bool): If trusted, obj isn't validated first. See
+            json_decode().
+
+    Returns:
+        The transcoded JSON-compatible object.
+
+    Raises:
+        bv.ValidationError: obj isn't valid, as raised by json_compat_obj_decode(),
+            or it lacks fields the output caller must see.
+    """
+    if not trusted:
+        validate = _get_validate_plan(
+            data_type, caller_permissions, alias_validators, strict, old_style)
+        validate(obj)
+    permissions = tuple(caller_permissions.permissions) if caller_permissions else ()
+    output_permissions = tuple(output_caller_permissions.permissions) \
+        if output_caller_permissions else ()
+    transcode = _get_transcode_plan(
+        data_type, permissions, bool(strict), bool(old_style), output_permissions,
+        bool(output_old_style), bool(should_redact))
+    return transcode(obj)
+
+def json_decode_many(data_type, serialized_objs, caller_permissions=None,
+                     alias_validators=None, strict=True, old_style=False, executor=None,
+                     batch_size=_BATCH_SIZE, return_exceptions=False):
+    """Decodes many JSON strings of the same type.
+
+    Args:
+        data_type (Validator): Validator for each of serialized_objs.
+        serialized_objs (Iterable[str]): The JSON strings to deserialize.
+
+    Returns:
+        list: Decoded objects, in the order of serialized_objs.
+
+    This is equivalent to calling json_decode() for each string, but the setup is only
+    done once per batch. See json_encode_many() for executor, batch_size, return_exceptions
+    and how errors are reported, and json_decode() for the other arguments.
+    """
+    return _run_batches(
+        _json_decode_batch, serialized_objs, executor, batch_size,
+        (data_type, _freeze_caller_permissions(caller_permissions), alias_validators, strict,
+         old_style, return_exceptions))
+
+def _json_decode_batch(start, serialized_objs, data_type, caller_permissions, alias_validators,
+                       strict, old_style, return_exceptions):
+    for_msgpack = False
+    decode = _get_decode_plan(
+        data_type, caller_permissions, alias_validators, for_msgpack, old_style, strict)
+    loads = _json_engine.loads
+    results = []
+    for i, serialized_obj in enumerate(serialized_objs, start):
+        try:
+            try:
+                deserialized_obj = loads(serialized_obj)
+            except ValueError:
+                raise bv.ValidationError('could not decode input as JSON')
+            results.append(decode(deserialized_obj))
+        except bv.ValidationError as e:
+            e.add_parent('[%d]' % i)
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+# --------------------------------------------------------------
+# Incremental JSON Decoder
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_COMPOSITE_SPECIAL = re.compile(r'["{}\[\]]')
+_JSON_STRING_SPECIAL = re.compile(r'["\\]')
+# What may follow the part of a number that has been received when the rest hasn't, e.g.
+# '.' after '1'
+_JSON_NUMBER_TAIL = re.compile(r'[-+.eE0-9]*\Z')
+
+class StreamingJsonDecoder:
+    """
+    Incrementally decodes a JSON document that is fed in chunks, producing the items of one
+    list in it as soon as each of them has been received.
+
+    The list is either the document itself, or is reached from it through ``list_path``, a
+    sequence of struct field names and union tags. For example, with a ``list_path`` of
+    ``['entries']`` and a struct validator, the items of the struct's ``entries`` field are
+    produced one by one. Only the item being decoded is held in memory. The fields of a struct
+    under a union tag are inlined in the object of the union, unless ``old_style`` is set; they
+    are streamed if the object has the tag in its '.tag' key before them, as encoded by
+    json_encode(), and are otherwise decoded into ``result``.
+
+    Items are decoded and validated as json_decode() would as part of the whole document, and
+    errors name the fields along ``list_path``. Once the document is complete, close() decodes
+    the rest of it into ``result``, with the streamed list left empty. If the list declares
+    ``min_items``, that many of its first items are kept in ``result`` so that it validates.
+
+    Example::
+
+        decoder = StreamingJsonDecoder(ListFolderResult_validator, ['entries'])
+        for chunk in response.iter_content(65536):
+            for entry in decoder.feed(chunk):
+                process(entry)
+        decoder.close()
+        cursor = decoder.result.cursor
+    """
+
+    def __init__(self, data_type, list_path=(), caller_permissions=None,
+                 alias_validators=None, strict=True, old_style=False):
+        """
+        Args:
+            data_type (Validator): Validator for the whole document.
+            list_path (Sequence[str]): Keys leading from the document to the list whose items
+                are produced. Empty if the document is the list.
+
+        See json_decode() for the other arguments.
+        """
+        self.list_path = tuple(list_path)
+        self.result = None
+        list_validator, self._inlined_tags = _streamed_list_validator(
+            data_type, self.list_path, caller_permissions, old_style)
+        self._min_items = list_validator.min_items or 0
+        self._max_items = list_validator.max_items
+        self._decode_document = _get_decode_plan(
+            data_type, caller_permissions, alias_validators, False, old_style, strict)
+        # Like json_decode(), items of a top-level list are not validated on their own, while
+        # items of a nested list are validated when the list is assigned to its field.
+        decode_item = _get_decode_plan(
+            list_validator.item_validator, caller_permissions, alias_validators, False,
+            old_style, strict, top_level=False)
+        if self.list_path:
+            validate_item = list_validator.item_validator.validate
+
+            def decode_and_validate_item(raw_item):
+                return validate_item(decode_item(raw_item))
+
+            self._decode_item = decode_and_validate_item
+        else:
+            self._decode_item = decode_item
+        self._scan = json.JSONDecoder().raw_decode
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._closed = False
+        self._count = 0
+        # Raw items kept for the document, see the class docstring.
+        self._kept = []  # type: typing.List[typing.Any]
+        self._items = []  # type: typing.List[typing.Any]
+        self._parser = self._parse_document()
+        next(self._parser)
+
+    def feed(self, data):
+        """
+        Feeds the next chunk of the document, as bytes (UTF-8) or str.
+
+        Returns:
+            list: Items of the list that were completed by this chunk.
+        """
+        assert not self._closed, 'Cannot feed a closed decoder.'
+        if isinstance(data, bytes):
+            try:
+                data = self._text_decoder.decode(data)
+            except UnicodeDecodeError:
+                raise bv.ValidationError('could not decode input as JSON')
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        self._resume()
+        items, self._items = self._items, []
+        return items
+
+    def close(self):
+        """
+        Signals the end of the document and decodes the rest of it into ``result``.
+
+        Returns:
+            list: The remaining items of the list.
+        """
+        assert not self._closed, 'Decoder is already closed.'
+        try:
+            rest = self._text_decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            raise bv.ValidationError('could not decode input as JSON')
+        self._buf = self._buf[self._pos:] + rest
+        self._pos = 0
+        self._eof = True
+        self._resume()
+        items, self._items = self._items, []
+        return items
+
+    def iter_decode(self, chunks):
+        """
+        Feeds all of ``chunks``, an iterable of bytes or str, and closes the decoder.
+
+        Returns:
+            Iterator: The items of the list.
+        """
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.close()
+
+    def aiter_decode(self, chunks):
+        """
+        Like iter_decode(), but for an asynchronous iterable of chunks, such as the body of
+        an aiohttp response or an asyncio.StreamReader.
+
+        Returns:
+            AsyncIterator: The items of the list.
+        """
+        return _AsyncStreamingDecode(self, chunks)
+
+    def _resume(self):
+        try:
+            next(self._parser)
+        except StopIteration as e:
+            self._closed = True
+            self.result = self._decode_document(e.value)
+
+    # The parser is a generator that yields whenever it needs more input.
+
+    def _invalid(self):
+        return bv.ValidationError('could not decode input as JSON')
+
+    def _peek(self):
+        """
+        Skips whitespace and returns the next character, or None at the end of the document.
+        """
+        while True:
+            self._pos = _JSON_WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if self._eof:
+                return None
+            yield
+
+    def _expect(self, char):
+        c = yield from self._peek()
+        if c != char:
+            raise self._invalid()
+        self._pos += 1
+
+    def _value(self):
+        """
+        Parses a complete JSON value.
+        """
+        c = yield from self._peek()
+        if c is None:
+            raise self._invalid()
+        if c in '{["':
+            yield from self._skip_composite()
+        while True:
+            try:
+                value, end = self._scan(self._buf, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise self._invalid()
+            else:
+                # A number may continue in the next chunk, including after a prefix that is a
+                # number itself, e.g. '1' of '1.5'.
+                if self._eof or c not in '-0123456789' or \
+                        not _JSON_NUMBER_TAIL.match(self._buf, end):
+                    self._pos = end
+                    return value
+            yield
+
+    def _skip_composite(self):
+        """
+        Waits until the object, array or string at the current position has been received
+        completely. Each character is only looked at once, however the value is split.
+        """
+        depth = 0
+        in_string = False
+        # Offset from self._pos, which moves when more input is fed.
+        offset = 0
+        while True:
+            pattern = _JSON_STRING_SPECIAL if in_string else _JSON_COMPOSITE_SPECIAL
+            m = pattern.search(self._buf, self._pos + offset)
+            if m is None:
+                offset = len(self._buf) - self._pos
+            elif m.group() == '\\':
+                if m.end() == len(self._buf):
+                    # The escaped character hasn't been received yet.
+                    offset = m.start() - self._pos
+                else:
+                    offset = m.end() + 1 - self._pos
+                    continue
+            else:
+                offset = m.end() - self._pos
+                if m.group() == '"':
+                    in_string = not in_string
+                elif m.group() in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                if depth <= 0 and not in_string:
+                    return
+                continue
+            if self._eof:
+                raise self._invalid()
+            yield
+
+    def _parse_document(self):
+        document = yield from self._parse_path(0)
+        c = yield from self._peek()
+        if c is not None:
+            raise self._invalid()
+        return document
+
+    def _parse_path(self, depth):
+        """
+        Parses the value at ``list_path[depth:]``, streaming the list at its end.
+        """
+        if depth == len(self.list_path):
+            return (yield from self._parse_list())
+        c = yield from self._peek()
+        if c != '{':
+            # The list can't be in here, so leave this value to the decoder.
+            return (yield from self._value())
+        self._pos += 1
+        obj = {}
+        c = yield from self._peek()
+        if c == '}':
+            self._pos += 1
+            return obj
+        # Key of the value the list is in, and the depth of that value
+        if depth in self._inlined_tags:
+            # The fields of the struct are inlined in the object of the union, and are only
+            # looked for once its '.tag' has been read.
+            path_key, next_depth = None, depth + 2
+        else:
+            path_key, next_depth = self.list_path[depth], depth + 1
+        while True:
+            c = yield from self._peek()
+            if c != '"':
+                raise self._invalid()
+            key = yield from self._value()
+            yield from self._expect(':')
+            if key == path_key:
+                obj[key] = yield from self._parse_path(next_depth)
+            else:
+                obj[key] = yield from self._value()
+                if (key == '.tag' and depth in self._inlined_tags and
+                        obj[key] == self.list_path[depth]):
+                    path_key = self.list_path[depth + 1]
+            c = yield from self._peek()
+            self._pos += 1
+            if c == '}':
+                return obj
+            elif c != ',':
+                raise self._invalid()
+
+    def _parse_list(self):
+        c = yield from self._peek()
+        if c != '[':
+            return (yield from self._value())
+        self._pos += 1
+        c = yield from self._peek()
+        if c == ']':
+            self._pos += 1
+            self._check_count()
+            return self._kept
+        while True:
+            raw_item = yield from self._value()
+            self._add_item(raw_item)
+            c = yield from self._peek()
+            self._pos += 1
+            if c == ']':
+                self._check_count()
+                return self._kept
+            elif c != ',':
+                raise self._invalid()
+
+    def _add_item(self, raw_item):
+        try:
+            self._count += 1
+            if self._max_items is not None and self._count > self._max_items:
+                raise bv.ValidationError('list has more than %s items' % self._max_items)
+            self._items.append(self._decode_item(raw_item))
+        except bv.ValidationError as e:
+            for key in reversed(self.list_path):
+                e.add_parent(key)
+            raise
+        if len(self._kept) < self._min_items:
+            self._kept.append(raw_item)
+
+    def _check_count(self):
+        if self._count < self._min_items:
+            e = bv.ValidationError('list has fewer than %s items' % self._min_items)
+            for key in reversed(self.list_path):
+                e.add_parent(key)
+            raise e
+
+
+class _AsyncStreamingDecode:
+    """
+    Asynchronous iterator returned by StreamingJsonDecoder.aiter_decode().
+    """
+
+    def __init__(self, decoder, chunks):
+        self._decoder = decoder
+        self._chunks = chunks.__aiter__()
+        self._items = collections.deque()  # type: typing.Deque[typing.Any]
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self._done:
+                raise StopAsyncIteration
+            try:
+                chunk = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._done = True
+                self._items.extend(self._decoder.close())
+            else:
+                self._items.extend(self._decoder.feed(chunk))
+        return self._items.popleft()
+
+
+def _streamed_list_validator(data_type, list_path, caller_permissions, old_style):
+    """
+    Returns the List validator reached from ``data_type`` through ``list_path``, and the
+    indexes in ``list_path`` of the union tags whose struct fields are inlined in the object
+    of the union, rather than in an object under the tag.
+    """
+    validator = data_type
+    caller_permissions = caller_permissions or CallerPermissionsDefault()
+    inlined_tags = set()
+    for i, key in enumerate(list_path):
+        if isinstance(validator, bv.Nullable):
+            validator = validator.validator
+        if isinstance(validator, bv.Struct):
+            validator = dict(
+                bv.permissioned_fields(validator.definition, caller_permissions)).get(key)
+        elif isinstance(validator, bv.Union):
+            validator = bv.permissioned_tagmap(validator.definition, caller_permissions).get(key)
+            value_validator = (validator.validator if isinstance(validator, bv.Nullable)
+                               else validator)
+            if (not old_style and isinstance(value_validator, bv.Struct) and
+                    not isinstance(value_validator, bv.StructTree)):
+                inlined_tags.add(i)
+        else:
+            validator = None
+        assert validator is not None, 'No field or tag %r in list path %r.' % (key, list_path)
+    if isinstance(validator, bv.Nullable):
+        validator = validator.validator
+    assert isinstance(validator, bv.List), \
+        'List path %r leads to %r, not a list.' % (list_path, validator)
+    return validator, frozenset(inlined_tags)
+
+
+def json_iterdecode(data_type, chunks, list_path=(), caller_permissions=None,
+                    alias_validators=None, strict=True, old_style=False):
+    """
+    Decodes the items of a list in a JSON document read from an iterable of chunks.
+
+    This is a shorthand for StreamingJsonDecoder(...).iter_decode(chunks); see
+    StreamingJsonDecoder for argument descriptions.
+    """
+    decoder = StreamingJsonDecoder(
+        data_type, list_path=list_path, caller_permissions=caller_permissions,
+        alias_validators=alias_validators, strict=strict, old_style=old_style)
+    return decoder.iter_decode(chunks)
 
 # Adapted from:
 # http://code.activestate.com/recipes/306860-proleptic-gregorian-dates-and-strftime-before-1900/
@@ -1049,23 +4204,89 @@ try:
 except ImportError:
     pass
 else:
+    # Payloads use the msgpack 1.0 spec: strings are str types and Bytes are bin types, so
+    # Bytes values are packed as given, bytes or memoryview, and unpacked as bytes.
+
     msgpack_compat_obj_encode = functools.partial(json_compat_obj_encode,
                                                   for_msgpack=True)
 
-    def msgpack_encode(data_type, obj):
-        return msgpack.dumps(
-            msgpack_compat_obj_encode(data_type, obj), encoding='utf-8')
+    def msgpack_encode(data_type, obj, caller_permissions=None, alias_validators=None,
+                       old_style=False, should_redact=False):
+        """Encodes an object into msgpack based on its type.
+
+        See json_encode() for argument descriptions and additional information about
+        validation.
+
+        Returns:
+            bytes: msgpack-encoded object.
+        """
+        encode = _get_encode_plan(
+            data_type, caller_permissions, alias_validators, True, old_style, should_redact)
+        return msgpack.packb(encode(obj), use_bin_type=True)
 
     msgpack_compat_obj_decode = functools.partial(json_compat_obj_decode,
                                                   for_msgpack=True)
 
-    def msgpack_decode(
-            data_type, serialized_obj, alias_validators=None, strict=True):
-        # We decode everything as utf-8 because we want all object keys to be
-        # unicode. Otherwise, we need to do a lot more refactoring to make
-        # json/msgpack share the same code. We expect byte arrays to fail
-        # decoding, but when they don't, we have to convert them to bytes.
-        deserialized_obj = msgpack.loads(
-            serialized_obj, encoding='utf-8', unicode_errors='ignore')
-        return msgpack_compat_obj_decode(
-            data_type, deserialized_obj, alias_validators, strict)
+    def msgpack_decode(data_type, serialized_obj, alias_validators=None, strict=True,
+                       caller_permissions=None, old_style=False, trusted=False):
+        """Performs the reverse operation of msgpack_encode.
+
+        Args:
+            serialized_obj (bytes): The msgpack-encoded object to deserialize.
+
+        See json_decode() for the other arguments and the return value.
+        """
+        try:
+            deserialized_obj = msgpack.unpackb(serialized_obj, raw=False)
+        except (ValueError, msgpack.UnpackException):
+            raise bv.ValidationError('could not decode input as msgpack')
+        decode = _get_decode_plan(
+            data_type, caller_permissions, alias_validators, True, old_style, strict,
+            trusted=trusted)
+        return decode(deserialized_obj)
+
+    # Default size, in bytes, of the reads made by msgpack_iterdecode() from file objects
+    _MSGPACK_READ_SIZE = 64 * 1024
+
+    def msgpack_iterdecode(data_type, source, alias_validators=None, strict=True,
+                           caller_permissions=None, old_style=False):
+        """Decodes a sequence of msgpack-encoded objects of the same type, such as the
+        concatenated outputs of msgpack_encode().
+
+        Args:
+            source: A binary file object, or an iterable of bytes chunks. Chunks don't need
+                to be aligned with the objects.
+
+        Returns:
+            Iterator: The decoded objects, each produced as soon as it has been read.
+
+        A bv.ValidationError for an object has the object's index in the sequence, such as
+        '[3]', as its outermost parent. See json_decode() for the other arguments.
+        """
+        if hasattr(source, 'read'):
+            source = iter(functools.partial(source.read, _MSGPACK_READ_SIZE), b'')
+        decode = _get_decode_plan(
+            data_type, caller_permissions, alias_validators, True, old_style, strict)
+        unpacker = msgpack.Unpacker(raw=False)
+        size = 0
+        index = 0
+        for chunk in source:
+            unpacker.feed(chunk)
+            size += len(chunk)
+            while True:
+                try:
+                    deserialized_obj = next(unpacker)
+                except StopIteration:
+                    break
+                except (ValueError, msgpack.UnpackException):
+                    raise bv.ValidationError('could not decode input as msgpack',
+                                             parent='[%d]' % index)
+                try:
+                    obj = decode(deserialized_obj)
+                except bv.ValidationError as e:
+                    e.add_parent('[%d]' % index)
+                    raise
+                index += 1
+                yield obj
+        if unpacker.tell() != size:
+            raise bv.ValidationError('could not decode input as msgpack', parent='[%d]' % index)
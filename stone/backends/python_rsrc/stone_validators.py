@@ -8,9 +8,11 @@ format.
 
 
 import datetime
+import functools
 import hashlib
 import math
 import numbers
+import operator
 import re
 from abc import ABCMeta, abstractmethod
 
@@ -23,6 +25,13 @@ if _MYPY:
 # See <http://python3porting.com/differences.html#buffer>
 _binary_types = (bytes, memoryview)  # noqa: E501,F821 # pylint: disable=undefined-variable,useless-suppression
 
+# Exact types whose values the validate_many fast paths can check in bulk. Values of any other
+# type, including subclasses, are validated one by one.
+_bulk_integer_types = frozenset((int, bool))
+_bulk_real_types = frozenset((float, int, bool))
+_bulk_string_types = frozenset((str,))
+_bulk_binary_types = frozenset(_binary_types)
+
 
 class ValidationError(Exception):
     """Raised when a value doesn't pass validation by its validator."""
@@ -114,6 +123,16 @@ class Validator(metaclass=ABCMeta):
         Raises: ValidationError
         """
 
+    def validate_many(self, vals):
+        """Validates that each item of the list or tuple vals is of this data
+        type.
+
+        Returns: A list of the normalized values if validation succeeds.
+        Raises: ValidationError for the first value that fails validation.
+        """
+        validate = self.validate
+        return [validate(val) for val in vals]
+
     def has_default(self):
         return False
 
@@ -178,6 +197,15 @@ class Integer(Primitive):
                                   % (val, self.minimum, self.maximum))
         return val
 
+    def validate_many(self, vals):
+        # Range check a list of plain ints with C loops, and otherwise (or if that fails)
+        # validate each value so that the error is the one for the first invalid value.
+        if vals and type(self).validate is Integer.validate \
+                and _bulk_integer_types.issuperset(map(type, vals)) \
+                and self.minimum <= min(vals) and max(vals) <= self.maximum:
+            return list(vals)
+        return super().validate_many(vals)
+
     def __repr__(self):
         return '%s()' % self.__class__.__name__
 
@@ -278,6 +306,23 @@ class Real(Primitive):
                                   (val, self.maximum))
         return val
 
+    def validate_many(self, vals):
+        # Like Integer.validate_many. A sum that isn't finite means that there's an infinite
+        # or nan value, or that the sum overflowed, in which case the values are validated
+        # one by one.
+        if vals and type(self).validate is Real.validate:
+            types = set(map(type, vals))
+            if _bulk_real_types.issuperset(types):
+                try:
+                    floats = list(vals) if types == {float} else list(map(float, vals))
+                except OverflowError:
+                    floats = None
+                if floats is not None and math.isfinite(sum(floats)) \
+                        and (self.minimum is None or min(floats) >= self.minimum) \
+                        and (self.maximum is None or max(floats) <= self.maximum):
+                    return floats
+        return super().validate_many(vals)
+
     def __repr__(self):
         return '%s()' % self.__class__.__name__
 
@@ -356,6 +401,16 @@ class String(Primitive):
                                   % (get_value_string(val), self.pattern))
         return val
 
+    def validate_many(self, vals):
+        # See Integer.validate_many.
+        if vals and type(self).validate is String.validate \
+                and _bulk_string_types.issuperset(map(type, vals)) \
+                and (self.max_length is None or max(map(len, vals)) <= self.max_length) \
+                and (self.min_length is None or min(map(len, vals)) >= self.min_length) \
+                and (not self.pattern or all(map(self.pattern_re.match, vals))):
+            return list(vals)
+        return super().validate_many(vals)
+
 
 class Bytes(Primitive):
     __slots__ = ("min_length", "max_length")
@@ -387,18 +442,125 @@ class Bytes(Primitive):
                                   % (get_value_string(val), self.min_length, len(val)))
         return val
 
+    def validate_many(self, vals):
+        # See Integer.validate_many.
+        if vals and type(self).validate is Bytes.validate \
+                and _bulk_binary_types.issuperset(map(type, vals)) \
+                and (self.max_length is None or max(map(len, vals)) <= self.max_length) \
+                and (self.min_length is None or min(map(len, vals)) >= self.min_length):
+            return list(vals)
+        return super().validate_many(vals)
+
+
+# The fixed-width format codes that timestamp_codec() compiles, mapped to the datetime
+# field each one sets, the pattern of the zero-padded values strptime() accepts for it and the
+# template strftime() renders it with.
+_TIMESTAMP_DIRECTIVES = {
+    'Y': ('year', '[0-9]{4}', '%04d'),
+    'm': ('month', '0[1-9]|1[0-2]', '%02d'),
+    'd': ('day', '0[1-9]|[12][0-9]|3[01]', '%02d'),
+    'H': ('hour', '[01][0-9]|2[0-3]', '%02d'),
+    'M': ('minute', '[0-5][0-9]', '%02d'),
+    'S': ('second', '[0-5][0-9]|6[01]', '%02d'),
+}
+
+# strptime() defaults for the fields a format leaves out.
+_TIMESTAMP_DEFAULTS = {'year': 1900, 'month': 1, 'day': 1}
+
+_ISO_8601_FIELDS = ['year', 'month', 'day', 'hour', 'minute', 'second']
+_ISO_8601_PREFIX = '%Y-%m-%dT%H:%M:%S'
+_ISO_8601_LENGTH = len('YYYY-MM-DDTHH:MM:SS')
+
+# Python 3.7+.
+_fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
+
+
+@functools.lru_cache(maxsize=None)
+def timestamp_codec(fmt):
+    """
+    Returns a (parse, render) pair of functions which convert strings in the format ``fmt`` to
+    datetimes and back, with the same results as datetime.strptime() and datetime.strftime().
+
+    Formats made up only of %Y, %m, %d, %H, %M and %S and literal text without whitespace are
+    compiled to a regular expression matching their zero-padded form and a %-template; ISO 8601
+    ones such as the default "%Y-%m-%dT%H:%M:%SZ" are parsed by datetime.fromisoformat() once
+    matched. Anything else these don't handle -- other formats, values that aren't zero-padded or
+    are out of range, years before 1000 -- goes to strptime() and strftime(), so the values they
+    accept and the errors they raise are unchanged.
+    """
+    def strptime(val):
+        return datetime.datetime.strptime(val, fmt)
+
+    def strftime(val):
+        return val.strftime(fmt)
+
+    pieces = re.split(r'(%.)', fmt)
+    literals, codes = pieces[::2], [piece[1] for piece in pieces[1::2]]
+    if (not codes or len(set(codes)) != len(codes)
+            or not all(code in _TIMESTAMP_DIRECTIVES for code in codes)
+            or any('%' in literal or re.search(r'\s', literal) for literal in literals)):
+        return strptime, strftime
+
+    fields = [_TIMESTAMP_DIRECTIVES[code][0] for code in codes]
+    match = re.compile(''.join(
+        re.escape(literal) + '(' + _TIMESTAMP_DIRECTIVES[code][1] + ')'
+        for literal, code in zip(literals, codes)) + re.escape(literals[-1])).fullmatch
+    template = ''.join(
+        literal + _TIMESTAMP_DIRECTIVES[code][2]
+        for literal, code in zip(literals, codes)) + literals[-1]
+    get_fields = operator.attrgetter(*fields)
+
+    if _fromisoformat is not None and fields == _ISO_8601_FIELDS \
+            and fmt.startswith(_ISO_8601_PREFIX):
+        def build(m):
+            return _fromisoformat(m.string[:_ISO_8601_LENGTH])
+    else:
+        def build(m):
+            args = dict(_TIMESTAMP_DEFAULTS)
+            args.update(zip(fields, map(int, m.groups())))
+            return datetime.datetime(**args)
+
+    def parse(val):
+        m = match(val) if isinstance(val, str) else None
+        if m is not None:
+            try:
+                return build(m)
+            except ValueError:
+                # E.g. February 30th: let strptime() raise its error.
+                pass
+        return strptime(val)
+
+    def render(val):
+        if val.year >= 1000:
+            return template % get_fields(val)
+        return strftime(val)
+
+    return parse, render
+
 
 class Timestamp(Primitive):
     """Note that while a format is specified, it isn't used in validation
     since a native Python datetime object is preferred. The format, however,
-    can and should be used by serializers."""
-    __slots__ = ("format",)
+    can and should be used by serializers, through parse() and render()."""
+    __slots__ = ("format", "parse", "render")
 
     def __init__(self, fmt):
         """fmt must be composed of format codes that the C standard (1989)
-        supports, most notably in its strftime() function."""
+        supports, most notably in its strftime() function.
+
+        parse(val) and render(val) are the format's codec: they convert a
+        string in the format to a datetime and back, compiled once per format
+        (see timestamp_codec)."""
         assert isinstance(fmt, str), 'format must be a string'
         self.format = fmt
+        self.parse, self.render = timestamp_codec(fmt)
+
+    def __reduce__(self):
+        # parse and render are closures, which can't be pickled: unpickling looks them up again
+        # from the format.
+        if hasattr(self, '_redact'):
+            return type(self), (self.format,), (None, {'_redact': self._redact})
+        return type(self), (self.format,)
 
     def validate(self, val):
         if not isinstance(val, datetime.datetime):
@@ -439,6 +601,14 @@ class List(Composite):
         self.max_items = max_items
 
     def validate(self, val):
+        self.validate_type_only(val)
+        return self.item_validator.validate_many(val)
+
+    def validate_type_only(self, val):
+        """
+        Use this when you only want to validate that val is a list with an
+        acceptable number of items, but not yet validate each item.
+        """
         if not isinstance(val, (tuple, list)):
             raise ValidationError('%r is not a valid list' % get_value_string(val))
         elif self.max_items is not None and len(val) > self.max_items:
@@ -447,7 +617,6 @@ class List(Composite):
         elif self.min_items is not None and len(val) < self.min_items:
             raise ValidationError('%r has fewer than %s items'
                                   % (get_value_string(val), self.min_items))
-        return [self.item_validator.validate(item) for item in val]
 
 
 class Map(Composite):
@@ -463,13 +632,20 @@ class Map(Composite):
         self.value_validator = value_validator
 
     def validate(self, val):
-        if not isinstance(val, dict):
-            raise ValidationError('%r is not a valid dict' % get_value_string(val))
+        self.validate_type_only(val)
         return {
             self.key_validator.validate(key):
                 self.value_validator.validate(value) for key, value in val.items()
         }
 
+    def validate_type_only(self, val):
+        """
+        Use this when you only want to validate that val is a dict, but not
+        yet validate each key and value.
+        """
+        if not isinstance(val, dict):
+            raise ValidationError('%r is not a valid dict' % get_value_string(val))
+
 
 class Struct(Composite):
     __slots__ = ("definition",)
@@ -534,9 +710,10 @@ class Struct(Composite):
         self.validate_fields_only(val)
 
         # check if type has been patched
-        for extra_permission in caller_permissions.permissions:
-            all_field_names = '_all_{}_field_names_'.format(extra_permission)
-            for field_name in getattr(self.definition, all_field_names, set()):
+        permissions = caller_permissions.permissions
+        if permissions:
+            for field_name in extra_permissioned_field_names(self.definition,
+                                                             tuple(permissions)):
                 if not hasattr(val, field_name):
                     raise ValidationError("missing required field '%s'" % field_name)
 
@@ -676,7 +853,7 @@ class Nullable(Validator):
 
 
 class Redactor:
-    __slots__ = ("regex",)
+    __slots__ = ("regex", "_search")
 
     def __init__(self, regex):
         """
@@ -684,6 +861,8 @@ class Redactor:
             regex: What parts of the field to redact.
         """
         self.regex = regex
+        # Compiled once here rather than looked up in re's cache for every value.
+        self._search = re.compile(regex).search if regex else None
 
     @abstractmethod
     def apply(self, val):
@@ -691,19 +870,59 @@ class Redactor:
         Returns: A redacted version of the string provided.
         """
 
+    def apply_many(self, vals):
+        """Redacts each of the values of the iterable vals, in one pass.
+        Returns: A list of the redacted versions of the values.
+        """
+        return list(map(self.apply, vals))
+
     def _get_matches(self, val):
-        if not self.regex:
+        if self._search is None:
             return None
         try:
-            return re.search(self.regex, val)
+            return self._search(val)
         except TypeError:
             return None
 
 
 class HashRedactor(Redactor):
-    __slots__ = ()
+    __slots__ = ("_memo",)
+
+    def __init__(self, regex, memo_size=None):
+        """
+        Args:
+            regex: What parts of the field to redact.
+            memo_size: If set, the redactions of up to this many distinct
+                values are memoized, for fields that often repeat the same
+                values.
+        """
+        super().__init__(regex)
+        if memo_size:
+            self._memo = functools.lru_cache(maxsize=memo_size, typed=True)(self._redact)
+        else:
+            self._memo = None
+
+    def __reduce__(self):
+        # The memo, which wraps a bound method, can't be pickled: unpickling starts an empty one
+        # of the same size.
+        memo_size = self._memo.cache_info().maxsize if self._memo is not None else None
+        return type(self), (self.regex, memo_size)
 
     def apply(self, val):
+        if self._memo is not None:
+            try:
+                return self._memo(val)
+            except TypeError:
+                # Not hashable
+                pass
+        return self._redact(val)
+
+    def apply_many(self, vals):
+        if self._memo is None:
+            return list(map(self._redact, vals))
+        return super().apply_many(vals)
+
+    def _redact(self, val):
         matches = self._get_matches(val)
 
         val_to_hash = str(val) if isinstance(val, int) or isinstance(val, float) else val
@@ -711,7 +930,7 @@ class HashRedactor(Redactor):
         try:
             # add string literal to ensure unicode
             hashed = hashlib.md5(val_to_hash.encode('utf-8')).hexdigest() + ''
-        except [AttributeError, ValueError]:
+        except (AttributeError, ValueError):
             hashed = None
 
         if matches:
@@ -730,3 +949,95 @@ class BlotRedactor(Redactor):
         if matches:
             return '***'.join(matches.groups())
         return '********'
+
+    def apply_many(self, vals):
+        if self._search is None:
+            return ['********' for _ in vals]
+        return super().apply_many(vals)
+
+
+# Upper bound on the number of (definition, permissions) combinations kept in each field table
+# cache.
+_FIELD_TABLE_CACHE_SIZE = 4096
+
+
+def permissioned_fields(definition, caller_permissions):
+    """
+    Returns the (name, validator) pairs of the fields of the struct class ``definition`` that
+    are visible to ``caller_permissions``: its public fields followed by the fields of each
+    extra permission, in order.
+    """
+    permissions = caller_permissions.permissions
+    if not permissions:
+        return definition._all_fields_
+    return _permissioned_fields(definition, tuple(permissions))
+
+
+@functools.lru_cache(maxsize=_FIELD_TABLE_CACHE_SIZE)
+def _permissioned_fields(definition, permissions):
+    all_fields = list(definition._all_fields_)
+    for extra_permission in permissions:
+        all_fields.extend(getattr(definition, '_all_{}_fields_'.format(extra_permission), []))
+    return tuple(all_fields)
+
+
+def permissioned_field_names(definition, caller_permissions):
+    """
+    Returns the set of names of the fields returned by ``permissioned_fields``.
+    """
+    permissions = caller_permissions.permissions
+    if not permissions:
+        return definition._all_field_names_
+    return _permissioned_field_names(definition, tuple(permissions))
+
+
+@functools.lru_cache(maxsize=_FIELD_TABLE_CACHE_SIZE)
+def _permissioned_field_names(definition, permissions):
+    all_field_names = set(definition._all_field_names_)
+    for extra_permission in permissions:
+        all_field_names.update(
+            getattr(definition, '_all_{}_field_names_'.format(extra_permission), ()))
+    return frozenset(all_field_names)
+
+
+@functools.lru_cache(maxsize=_FIELD_TABLE_CACHE_SIZE)
+def extra_permissioned_field_names(definition, permissions):
+    """
+    Returns the names of the fields that each of ``permissions``, a tuple, adds to the struct
+    class ``definition``, in order.
+    """
+    return tuple(field_name for extra_permission in permissions
+                 for field_name in getattr(
+                     definition, '_all_{}_field_names_'.format(extra_permission), ()))
+
+
+def permissioned_tagmap(definition, caller_permissions):
+    """
+    Returns a mapping of the tags of the union class ``definition`` that are visible to
+    ``caller_permissions`` to their validators. If several extra permissions define a tag,
+    the first one wins. The mapping is shared and must not be modified.
+    """
+    permissions = caller_permissions.permissions
+    if not permissions:
+        return definition._tagmap
+    return _permissioned_tagmap(definition, tuple(permissions))
+
+
+@functools.lru_cache(maxsize=_FIELD_TABLE_CACHE_SIZE)
+def _permissioned_tagmap(definition, permissions):
+    tagmap = dict(definition._tagmap)
+    for extra_permission in reversed(permissions):
+        tagmap.update(getattr(definition, '_{}_tagmap'.format(extra_permission), {}))
+    return tagmap
+
+
+@functools.lru_cache(maxsize=_FIELD_TABLE_CACHE_SIZE)
+def full_tagmap(definition):
+    """
+    Returns a mapping of all the tags of the union class ``definition``, whatever their
+    permissions, to their validators. The mapping is shared and must not be modified.
+    """
+    tagmap = dict(definition._tagmap)
+    for map_name in definition._permissioned_tagmaps:
+        tagmap.update(getattr(definition, '_{}_tagmap'.format(map_name)))
+    return tagmap
@@ -4,6 +4,7 @@ Backend for generating Python types that match the spec.
 
 
 import argparse
+import collections
 import itertools
 import re
 
@@ -17,6 +18,7 @@ from stone.ir import (
     is_boolean_type,
     is_composite_type,
     is_bytes_type,
+    is_integer_type,
     is_list_type,
     is_map_type,
     is_nullable_type,
@@ -58,6 +60,10 @@ from stone.backends.python_type_mapping import map_stone_type_to_python_type
 # Matches format of Stone doc tags
 doc_sub_tag_re = re.compile(':(?P<tag>[A-z]*):`(?P<val>.*?)`')
 
+# Module generated with --shared-validators. Namespace names can't start with
+# an underscore, so it can't clash with a namespace module.
+SHARED_VALIDATORS_MODULE = '_shared_validators'
+
 _cmdline_parser = argparse.ArgumentParser(prog='python-types-backend')
 _cmdline_parser.add_argument(
     '-r',
@@ -74,6 +80,53 @@ _cmdline_parser.add_argument(
     required=True,
     help='Package prefix for absolute imports in generated files.',
 )
+_cmdline_parser.add_argument(
+    '--generate-serializers',
+    action='store_true',
+    help=('Also generate _to_json_compat() and _from_json_compat() functions for '
+          'every struct and union. They read and write field slots directly and '
+          'are used by json_encode(), json_decode() and their JSON-compatible '
+          'object variants when called with default options.'),
+)
+_cmdline_parser.add_argument(
+    '--shared-validators',
+    action='store_true',
+    help=('Share the validators that don\'t refer to user-defined types or '
+          'aliases, such as bv.String() or bv.List(bv.Int64()), between all '
+          'namespaces through a generated {} module, rather than defining them '
+          'in each namespace module.'.format(SHARED_VALIDATORS_MODULE)),
+)
+_cmdline_parser.add_argument(
+    '--lazy-imports',
+    action='store_true',
+    help=('Generate an __init__.py that imports namespace modules when they '
+          'are first accessed as attributes of the package (PEP 562, Python '
+          '3.7+), and have namespace modules import the namespaces they refer '
+          'to through bb.lazy_import(), so that those only run when first used. '
+          'Validators and routes referring to other namespaces are created when '
+          'first used; with --deferred-wiring, so are the class attributes '
+          'referring to them, while classes extending a type of another '
+          'namespace, and aliases to one, still import it.'),
+)
+_cmdline_parser.add_argument(
+    '--deferred-wiring',
+    action='store_true',
+    help=('Assign the reflection attributes, field validators and defaults of '
+          'each class in a function that bb.defer_wiring() calls when the class '
+          'is first used, rather than when the module is imported. Validators '
+          'and routes are also created when first used. Classes are still '
+          'defined at import, which is most of its cost, so this moves work to '
+          'first use rather than making import time scale with the types used.'),
+)
+_cmdline_parser.add_argument(
+    '--slot-fields',
+    action='store_true',
+    help=('Generate struct fields as bb.SlotAttribute rather than bb.Attribute. '
+          'Reading a field that is set then fetches its slot without calling '
+          'into Python code. Unset fields leave their slot empty, which makes '
+          'reading them slower, and lazy decoding decodes them in full. See '
+          'scripts/bench_field_reads.py.'),
+)
 
 
 class PythonTypesBackend(CodeBackend):
@@ -86,6 +139,22 @@ class PythonTypesBackend(CodeBackend):
 
     preserve_aliases = True
 
+    def __init__(self, *args, **kwargs):
+        # type: (...) -> None
+        super().__init__(*args, **kwargs)
+        # Validator constructor expression -> name of the module-level constant it's assigned
+        # to, for the namespace being generated, in order of definition. The first
+        # _emitted_validator_constants of them have been emitted.
+        self._validator_constants = \
+            collections.OrderedDict()  # type: typing.Dict[typing.Text, typing.Text]
+        self._emitted_validator_constants = 0
+        # Names of the constants above that are defined with bb.lazy_constant(), and are
+        # referred to by calling them.
+        self._lazy_validator_constants = set()  # type: typing.Set[typing.Text]
+        # Same, for the validators shared between namespaces with --shared-validators.
+        self._shared_validator_constants = \
+            collections.OrderedDict()  # type: typing.Dict[typing.Text, typing.Text]
+
     def generate(self, api):
         """
         Generates a module for each namespace.
@@ -93,8 +162,12 @@ class PythonTypesBackend(CodeBackend):
         Each namespace will have Python classes to represent data types and
         routes in the Stone spec.
         """
-        with self.output_to_relative_path('__init__.py', mode='ab'):
-            pass
+        if self.args.lazy_imports:
+            with self.output_to_relative_path('__init__.py'):
+                self._generate_lazy_init_module(api)
+        else:
+            with self.output_to_relative_path('__init__.py', mode='ab'):
+                pass
         with self.output_to_relative_path('stone_base.py'):
             self.emit("from stone.backends.python_rsrc.stone_base import *")
         with self.output_to_relative_path('stone_serializers.py'):
@@ -108,12 +181,47 @@ class PythonTypesBackend(CodeBackend):
             if reserved_namespace_name != namespace.name:
                 with self.output_to_relative_path('{}.py'.format(namespace.name)):
                     self._generate_dummy_namespace_module(reserved_namespace_name)
+        if self.args.shared_validators:
+            with self.output_to_relative_path('{}.py'.format(SHARED_VALIDATORS_MODULE)):
+                self._generate_shared_validators_module()
+
+    def _generate_lazy_init_module(self, api):
+        """
+        Generates a package __init__ with a module __getattr__ that imports
+        namespace modules on first access.
+        """
+        generate_module_header(self)
+        self.emit('import importlib')
+        self.emit()
+        module_names = set()
+        for namespace in api.namespaces.values():
+            module_names.add(fmt_namespace(namespace.name))
+            module_names.add(namespace.name)
+        self.generate_multiline_list(
+            ["'{}'".format(name) for name in sorted(module_names)],
+            before='_NAMESPACE_MODULES = frozenset(', after=')', delim=('[', ']'),
+            compact=False)
+        self.emit()
+        self.emit('def __getattr__(name):')
+        with self.indent():
+            self.emit('if name in _NAMESPACE_MODULES:')
+            with self.indent():
+                self.emit("return importlib.import_module('.' + name, __name__)")
+            self.emit("raise AttributeError('module {!r} has no attribute {!r}'.format("
+                      "__name__, name))")
+        self.emit()
+        self.emit('def __dir__():')
+        with self.indent():
+            self.emit('return sorted(set(globals()) | _NAMESPACE_MODULES)')
 
     def _generate_base_namespace_module(self, api, namespace):
         """Creates a module for the namespace. All data types and routes are
         represented as Python classes."""
 
         self.cur_namespace = namespace
+        self._validator_constants = collections.OrderedDict()
+        self._emitted_validator_constants = 0
+        self._lazy_validator_constants = set()
         generate_module_header(self)
 
         if namespace.doc is not None:
@@ -125,9 +233,15 @@ class PythonTypesBackend(CodeBackend):
         self.emit("from __future__ import unicode_literals")
 
         self.emit_raw(validators_import)
+        if self.args.shared_validators:
+            self.emit('from {} import {}'.format(self.args.package, SHARED_VALIDATORS_MODULE))
+            self.emit()
 
         # Generate import statements for all referenced namespaces.
-        self._generate_imports_for_referenced_namespaces(namespace)
+        if self.args.lazy_imports:
+            self._generate_lazy_imports_for_referenced_namespaces(namespace)
+        else:
+            self._generate_imports_for_referenced_namespaces(namespace)
 
         for annotation_type in namespace.annotation_types:
             self._generate_annotation_type_class(namespace, annotation_type)
@@ -143,6 +257,24 @@ class PythonTypesBackend(CodeBackend):
         for alias in namespace.linearize_aliases():
             self._generate_alias_definition(namespace, alias)
 
+        # Define the validators of all the fields and routes up front, so that
+        # those used in several places are only created once.
+        for data_type in namespace.linearize_data_types():
+            for field in data_type.fields:
+                if not field.redactor:
+                    self._validator_constant(namespace, field.data_type)
+        for route in namespace.routes:
+            for data_type in (route.arg_data_type, route.result_data_type,
+                              route.error_data_type):
+                self._validator_constant(namespace, data_type)
+        self._emit_validator_constants()
+
+        if self.args.deferred_wiring:
+            for data_type in namespace.linearize_data_types():
+                self._generate_deferred_wiring(namespace, data_type)
+            self._generate_routes(api.route_schema, namespace)
+            return
+
         # Generate the struct->subtype tag mapping at the end so that
         # references to later-defined subtypes don't cause errors.
         for data_type in namespace.linearize_data_types():
@@ -164,6 +296,116 @@ class PythonTypesBackend(CodeBackend):
 
         self._generate_routes(api.route_schema, namespace)
 
+    def _generate_deferred_wiring(self, ns, data_type):
+        """
+        Generates a function assigning the reflection attributes, field
+        validators and defaults of the class for ``data_type``, and has
+        bb.defer_wiring() call it when the class is first used.
+        """
+        class_name = class_name_for_data_type(data_type)
+        wire_name = '_wire_{}'.format(class_name)
+        self.emit('def {}():'.format(wire_name))
+        with self.indent():
+            start = len(self.output)
+            if is_struct_type(data_type):
+                self._generate_struct_class_reflection_attributes(ns, data_type)
+                if data_type.has_enumerated_subtypes():
+                    self._generate_enumerated_subtypes_tag_mapping(ns, data_type)
+                self._generate_struct_attributes_defaults(ns, data_type)
+            else:
+                self._generate_union_class_reflection_attributes(ns, data_type)
+                self._generate_union_class_symbol_creators(data_type)
+            # The class attributes assigned above, and the fields whose
+            # validators and defaults are, which are stood in for until the
+            # class is wired.
+            assigned = re.findall(
+                r'^\s+{}\.(\w+)(?:\.validator|\.default)? = '.format(re.escape(class_name)),
+                ''.join(self.output[start:]), re.MULTILINE)
+            if not assigned:
+                self.emit('pass')
+        names = sorted(set(assigned))
+        self.generate_multiline_list(
+            ["'{}'".format(name) for name in names],
+            before='bb.defer_wiring({}, {}, '.format(class_name, wire_name), after=')',
+            delim=('[', ']'), compact=False)
+        self.emit()
+
+    def _generate_shared_validators_module(self):
+        generate_module_header(self)
+        self.emit('from stone.backends.python_rsrc import stone_validators as bv')
+        self.emit()
+        for expr, name in self._shared_validator_constants.items():
+            self.emit('{} = {}'.format(name, expr))
+
+    def _validator_constant(self, ns, data_type):
+        """
+        Returns the name of the module-level constant holding the validator of
+        ``data_type``, or of the validator of the user-defined type or alias
+        it refers to. Structurally identical validators, including nested
+        ones, are hash-consed into the same constant, which is emitted by the
+        next call to _emit_validator_constants(). Lazy constants (see
+        _is_lazy_validator()) are referred to with a call.
+        """
+        def intern(expr, dt):
+            if self.args.shared_validators and not _refers_to_user_defined_types(dt):
+                return '{}.{}'.format(SHARED_VALIDATORS_MODULE, generate_validator_constructor(
+                    ns, dt, self._intern_shared_validator))
+            name = self._validator_constants.get(expr)
+            if name is None:
+                name = '_v{}'.format(len(self._validator_constants))
+                self._validator_constants[expr] = name
+                if self._is_lazy_validator(ns, dt):
+                    self._lazy_validator_constants.add(name)
+            if name in self._lazy_validator_constants:
+                return name + '()'
+            return name
+
+        return generate_validator_constructor(ns, data_type, intern)
+
+    def _is_lazy_validator(self, ns, data_type):
+        """
+        Returns whether the validator of ``data_type`` is only created when
+        first used: with --deferred-wiring, all validators are, since only
+        the wired classes and routes use them, and with --lazy-imports,
+        validators referring to other namespaces are, so that those aren't
+        imported until then.
+        """
+        if self.args.deferred_wiring:
+            return True
+        return bool(self.args.lazy_imports) and _refers_to_other_namespaces(ns, data_type)
+
+    def _intern_shared_validator(self, expr, data_type):  # pylint: disable=unused-argument
+        name = self._shared_validator_constants.get(expr)
+        if name is None:
+            name = 'v{}'.format(len(self._shared_validator_constants))
+            self._shared_validator_constants[expr] = name
+        return name
+
+    def _emit_validator_constants(self):
+        """
+        Emits the constants returned by _validator_constant() that haven't
+        been emitted yet.
+        """
+        constants = list(self._validator_constants.items())
+        for expr, name in constants[self._emitted_validator_constants:]:
+            if name in self._lazy_validator_constants:
+                self.emit('{} = bb.lazy_constant(lambda: {})'.format(name, expr))
+            else:
+                self.emit('{} = {}'.format(name, expr))
+        if len(constants) > self._emitted_validator_constants:
+            self.emit()
+        self._emitted_validator_constants = len(constants)
+
+    def _field_validator(self, ns, field):
+        """
+        Returns the expression for the validator of ``field``. Fields with a
+        redactor get a validator of their own, since the redactor is set on
+        it.
+        """
+        if field.redactor:
+            return generate_validator_constructor(ns, field.data_type)
+        return self._validator_constant(ns, field.data_type)
+
     def _generate_dummy_namespace_module(self, reserved_namespace_name):
         generate_module_header(self)
         self.emit('# If you have issues importing this module because Python recognizes it as a '
@@ -197,6 +439,16 @@ class PythonTypesBackend(CodeBackend):
             package=self.args.package,
         )
 
+    def _generate_lazy_imports_for_referenced_namespaces(self, namespace):
+        # type: (ApiNamespace) -> None
+        imported_namespaces = namespace.get_imported_namespaces(consider_annotation_types=True)
+        if not imported_namespaces:
+            return
+        for ns in imported_namespaces:
+            self.emit("{0} = bb.lazy_import('{1}.{0}')".format(
+                fmt_namespace(ns.name), self.args.package))
+        self.emit()
+
     def _docf(self, tag, val):
         """
         Callback used as the handler argument to process_docs(). This converts
@@ -239,7 +491,7 @@ class PythonTypesBackend(CodeBackend):
         else:
             if is_struct_type(data_type):
                 # Use a handwritten base class
-                extends = 'bb.Struct'
+                extends = 'bb.SlotStruct' if self.args.slot_fields else 'bb.Struct'
             elif is_union_type(data_type):
                 extends = 'bb.Union'
             else:
@@ -354,6 +606,8 @@ class PythonTypesBackend(CodeBackend):
             self._generate_struct_class_init(data_type)
             self._generate_struct_class_properties(ns, data_type)
             self._generate_struct_class_custom_annotations(ns, data_type)
+            if self.args.generate_serializers:
+                self._generate_struct_class_serializers(ns, data_type)
         if data_type.has_enumerated_subtypes():
             validator = 'StructTree'
         else:
@@ -411,9 +665,10 @@ class PythonTypesBackend(CodeBackend):
         else:
             parent_type_class_name = None
 
-        for field in data_type.fields:
+        validator_names = [self._field_validator(ns, field) for field in data_type.fields]
+        self._emit_validator_constants()
+        for field, validator_name in zip(data_type.fields, validator_names):
             field_name = fmt_var(field.name)
-            validator_name = generate_validator_constructor(ns, field.data_type)
             full_validator_name = '{}.{}.validator'.format(class_name, field_name)
             self.emit('{} = {}'.format(full_validator_name, validator_name))
             if field.redactor:
@@ -517,6 +772,7 @@ class PythonTypesBackend(CodeBackend):
                 self.generate_multiline_list(
                     items, before=before, delim=('[', ']'), compact=False)
 
+        self._generate_custom_annotation_types(ns, data_type)
         self.emit()
 
     def _generate_struct_attributes_defaults(self, ns, data_type):
@@ -557,10 +813,11 @@ class PythonTypesBackend(CodeBackend):
                     all_parent_fields,
                     before='super({}, self).__init__'.format(class_name))
 
-            # initialize each field
-            for field in data_type.fields:
-                field_var_name = fmt_var(field.name)
-                self.emit('self._{}_value = bb.NOT_SET'.format(field_var_name))
+            # initialize each field; with --slot-fields, unset fields leave their slot empty
+            if not self.args.slot_fields:
+                for field in data_type.fields:
+                    field_var_name = fmt_var(field.name)
+                    self.emit('self._{}_value = bb.NOT_SET'.format(field_var_name))
 
             # handle arguments that were set
             for field in data_type.fields:
@@ -608,7 +865,8 @@ class PythonTypesBackend(CodeBackend):
                     self._python_type_mapping(ns, field_dt)
                 )
             )
-            self.emit("{} = bb.Attribute({})".format(field_name, args))
+            self.emit("{} = bb.{}({})".format(
+                field_name, 'SlotAttribute' if self.args.slot_fields else 'Attribute', args))
             self.emit()
 
     def _generate_custom_annotation_instance(self, ns, annotation):
@@ -644,7 +902,7 @@ class PythonTypesBackend(CodeBackend):
                 if annotation.annotation_type not in annotation_types_seen:
                     yield (annotation.annotation_type,
                            generate_func_call(
-                               'bb.make_struct_annotation_processor',
+                               'bb.make_pruning_struct_annotation_processor',
                                args=[class_name_for_annotation_type(annotation.annotation_type, ns),
                                      'processor']
                            ))
@@ -683,6 +941,53 @@ class PythonTypesBackend(CodeBackend):
                        args=['processor', self._generate_custom_annotation_instance(ns, annotation)]
                    ))
 
+    def _field_custom_annotation_processors(self, ns, field):
+        """
+        Returns the (annotation_type, code) pairs of the processors that
+        _process_custom_annotations runs on the value of a field, sorted by
+        annotation type.
+        """
+        return sorted(
+            self._generate_custom_annotation_processors(
+                ns, field.data_type, field.custom_annotations),
+            key=lambda x: x[0].name)
+
+    def _custom_annotation_types(self, ns, data_type):
+        """
+        Returns the annotation types that the _process_custom_annotations
+        method of a struct or union processes, including through its parent
+        types. This follows the processors that are generated rather than the
+        recursive_custom_annotations of the type, which only covers the type's
+        own fields.
+        """
+        annotation_types = set()
+        while data_type is not None:
+            for field in data_type.fields:
+                annotation_types.update(
+                    annotation_type for annotation_type, _ in
+                    self._field_custom_annotation_processors(ns, field))
+            data_type = data_type.parent_type
+        return sorted(annotation_types, key=lambda x: (x.namespace.name, x.name))
+
+    def _generate_custom_annotation_types(self, ns, data_type):
+        """
+        Generates the _custom_annotation_types_ class attribute of a struct or
+        union with annotated fields, through which the annotation processors
+        skip the values whose fields can't contain annotations of the type
+        being processed. Other classes inherit the empty set of bb.Struct or
+        bb.Union.
+        """
+        annotation_types = self._custom_annotation_types(ns, data_type)
+        if annotation_types:
+            self.generate_multiline_list(
+                [class_name_for_annotation_type(annotation_type, ns)
+                 for annotation_type in annotation_types],
+                before='{}._custom_annotation_types_ = frozenset('.format(
+                    class_name_for_data_type(data_type)),
+                after=')',
+                delim=('[', ']'),
+                compact=False)
+
     def _generate_struct_class_custom_annotations(self, ns, data_type):
         """
         The _process_custom_annotations function allows client code to access
@@ -699,15 +1004,19 @@ class PythonTypesBackend(CodeBackend):
             )
             self.emit()
 
+            # One test per annotation type, rather than per field and annotation type
+            field_processors = collections.OrderedDict()
             for field in data_type.fields:
-                field_name = fmt_var(field.name, check_reserved=True)
-                recursive_processors = list(self._generate_custom_annotation_processors(
-                    ns, field.data_type, field.custom_annotations))
-                recursive_processors = sorted(recursive_processors, key=lambda x: x[0].name)
-                for annotation_type, processor in recursive_processors:
-                    annotation_class = class_name_for_annotation_type(annotation_type, ns)
-                    self.emit('if annotation_type is {}:'.format(annotation_class))
-                    with self.indent():
+                for annotation_type, processor in self._field_custom_annotation_processors(
+                        ns, field):
+                    field_processors.setdefault(annotation_type, []).append((field, processor))
+
+            for annotation_type in sorted(field_processors, key=lambda x: x.name):
+                annotation_class = class_name_for_annotation_type(annotation_type, ns)
+                self.emit('if annotation_type is {}:'.format(annotation_class))
+                with self.indent():
+                    for field, processor in field_processors[annotation_type]:
+                        field_name = fmt_var(field.name, check_reserved=True)
                         self.emit('self.{} = {}'.format(
                             field_name,
                             generate_func_call(
@@ -717,7 +1026,211 @@ class PythonTypesBackend(CodeBackend):
                                     'self.{}'.format(field_name),
                                 ])
                         ))
-                    self.emit()
+                self.emit()
+
+    def _generate_struct_class_serializers(self, ns, data_type):
+        """
+        Generates _to_json_compat and _from_json_compat, which convert between
+        instances of the struct and their JSON-compatible representation by
+        reading and writing field slots directly. Only public fields are
+        handled, matching the generic serializers for callers without extra
+        permissions.
+        """
+        class_name = class_name_for_data_type(data_type)
+        fields = _public_fields_with_inherited(data_type)
+
+        self.emit('def _to_json_compat(self):')
+        with self.indent():
+            self.emit('d = {}')
+            for field in fields:
+                field_name = fmt_var(field.name)
+                field_dt, nullable, _ = unwrap(field.data_type)
+                # Nullable fields behind an alias store None rather than NOT_SET.
+                stores_none = nullable and not is_nullable_type(field.data_type)
+                self.emit('value = self._{}_value'.format(field_name))
+                if is_composite_type(field_dt) or is_timestamp_type(field_dt) or \
+                        is_bytes_type(field_dt):
+                    # Fields that lazy decoders haven't decoded yet
+                    self.emit('if value.__class__ is bb.LazyValue:')
+                    with self.indent():
+                        self.emit('value = value.materialize(self, {}.{})'.format(
+                            class_name, fmt_func(field.name, check_reserved=True)))
+                if stores_none:
+                    self.emit('if value is not bb.NOT_SET and value is not None:')
+                else:
+                    self.emit('if value is not bb.NOT_SET:')
+                with self.indent():
+                    value = 'value'
+                    if is_list_type(field_dt) or is_map_type(field_dt):
+                        # Lists and maps are mutable, so they are validated again.
+                        value = '{}.{}.validator.validate(value)'.format(class_name, field_name)
+                    self._emit_json_compat_with_parent(
+                        field_name,
+                        "d['{}'] = {}".format(
+                            field_name, self._json_compat_encode_expr(ns, field_dt, value)),
+                        is_composite_type(field_dt))
+                if field in data_type.all_required_fields:
+                    self.emit('elif value is bb.NOT_SET:' if stores_none else 'else:')
+                    with self.indent():
+                        self.emit(
+                            'raise bv.ValidationError("missing required field \'{}\'")'.format(
+                                field_name))
+            self.emit('return d')
+        self.emit()
+
+        self.emit('@classmethod')
+        self.emit('def _from_json_compat(cls, obj, strict):')
+        with self.indent():
+            self.emit('if not isinstance(obj, dict):')
+            with self.indent():
+                if not data_type.all_required_fields:
+                    self.emit('if obj is None:')
+                    with self.indent():
+                        self.emit('return cls()')
+                self.emit("raise bv.ValidationError('expected object, got %s' % "
+                          "bv.generic_type_name(obj))")
+            self.emit('if strict:')
+            with self.indent():
+                self.emit('bb.json_compat_check_struct_keys(obj, cls._all_field_names_)')
+            self.emit('ins = cls()')
+            for field in fields:
+                field_name = fmt_var(field.name)
+                attr_name = fmt_func(field.name, check_reserved=True)
+                self.emit("if '{}' in obj:".format(field_name))
+                with self.indent():
+                    self._emit_json_compat_with_parent(
+                        field_name,
+                        'ins.{} = {}'.format(attr_name, self._json_compat_decode_expr(
+                            ns, field.data_type, "obj['{}']".format(field_name))))
+                default = self._json_compat_missing_field_default(ns, field)
+                if default is not None:
+                    self.emit('else:')
+                    with self.indent():
+                        self.emit('ins.{} = {}'.format(attr_name, default))
+            for field in data_type.all_required_fields:
+                if field.omitted_caller is not None:
+                    continue
+                field_name = fmt_var(field.name)
+                self.emit('if ins._{}_value is bb.NOT_SET:'.format(field_name))
+                with self.indent():
+                    self.emit('raise bv.ValidationError("missing required field \'{}\'")'.format(
+                        field_name))
+            self.emit('return ins')
+        self.emit()
+
+    def _json_compat_missing_field_default(self, ns, field):
+        """
+        Returns an expression for the value a field is set to when it's
+        missing from the object being decoded, or None if it stays unset.
+        This mirrors the validator defaults used by the generic decoder.
+        """
+        field_dt, nullable, _ = unwrap(field.data_type)
+        if is_nullable_type(field.data_type):
+            return None
+        elif nullable or is_void_type(field_dt):
+            return 'None'
+        elif is_struct_type(field_dt) and not field_dt.all_required_fields:
+            return '{}()'.format(class_name_for_data_type(field_dt, ns))
+        return None
+
+    def _json_compat_encode_expr(self, ns, data_type, var, depth=0):
+        """
+        Returns an expression converting ``var``, a validated value of
+        ``data_type``, into its JSON-compatible representation.
+        """
+        dt, nullable, _ = unwrap(data_type)
+        if is_list_type(dt):
+            item = 'x{}'.format(depth)
+            item_expr = self._json_compat_encode_expr(ns, dt.data_type, item, depth + 1)
+            if item_expr == item:
+                # Validation already returned a fresh list
+                expr = var
+            else:
+                expr = '[{} for {} in {}]'.format(item_expr, item, var)
+        elif is_map_type(dt):
+            key, item = 'k{}'.format(depth), 'x{}'.format(depth)
+            item_expr = self._json_compat_encode_expr(ns, dt.value_data_type, item, depth + 1)
+            if item_expr == item:
+                # Validation already returned a fresh dict
+                expr = var
+            else:
+                expr = '{{{}: {} for {}, {} in {}.items()}}'.format(
+                    key, item_expr, key, item, var)
+        elif is_struct_type(dt) and dt.has_enumerated_subtypes():
+            expr = 'bb.json_compat_encode_struct_tree({}, {})'.format(
+                generate_validator_constructor(ns, dt), var)
+        elif is_user_defined_type(dt):
+            expr = '{}._to_json_compat({})'.format(class_name_for_data_type(dt, ns), var)
+        elif is_timestamp_type(dt):
+            expr = 'bb.json_compat_encode_timestamp({}, {!r})'.format(var, dt.format)
+        elif is_bytes_type(dt):
+            expr = 'bb.json_compat_encode_bytes({})'.format(var)
+        elif is_integer_type(dt):
+            # bools pass Integer validation, but are encoded as 0 or 1
+            expr = 'int({})'.format(var)
+        elif is_void_type(dt):
+            expr = 'None'
+        else:
+            expr = var
+        if nullable and expr != var:
+            expr = '(None if {} is None else {})'.format(var, expr)
+        return expr
+
+    def _json_compat_decode_expr(self, ns, data_type, var, depth=0):
+        """
+        Returns an expression converting ``var``, a JSON-compatible object,
+        into a value of ``data_type``. The result is validated when it's
+        assigned to a field or union tag.
+        """
+        dt, nullable, _ = unwrap(data_type)
+        if is_list_type(dt):
+            item = 'x{}'.format(depth)
+            item_expr = self._json_compat_decode_expr(ns, dt.data_type, item, depth + 1)
+            if item_expr == item:
+                expr = 'list(bb.json_compat_list({}))'.format(var)
+            else:
+                expr = '[{} for {} in bb.json_compat_list({})]'.format(item_expr, item, var)
+        elif is_map_type(dt):
+            key, item = 'k{}'.format(depth), 'x{}'.format(depth)
+            item_expr = self._json_compat_decode_expr(ns, dt.value_data_type, item, depth + 1)
+            if item_expr == item:
+                expr = 'dict(bb.json_compat_dict({}))'.format(var)
+            else:
+                expr = '{{{}: {} for {}, {} in bb.json_compat_dict({}).items()}}'.format(
+                    key, item_expr, key, item, var)
+        elif is_struct_type(dt) and dt.has_enumerated_subtypes():
+            expr = 'bb.json_compat_decode_struct_tree({}, {}, strict)'.format(
+                generate_validator_constructor(ns, dt), var)
+        elif is_user_defined_type(dt):
+            expr = '{}._from_json_compat({}, strict)'.format(
+                class_name_for_data_type(dt, ns), var)
+        elif is_timestamp_type(dt):
+            expr = 'bb.json_compat_decode_timestamp({}, {!r})'.format(var, dt.format)
+        elif is_bytes_type(dt):
+            expr = 'bb.json_compat_decode_bytes({})'.format(var)
+        elif is_void_type(dt):
+            expr = 'bb.json_compat_decode_void({}, strict)'.format(var)
+        else:
+            expr = var
+        if nullable and expr != var:
+            expr = '(None if {} is None else {})'.format(var, expr)
+        return expr
+
+    def _emit_json_compat_with_parent(self, parent, line, can_raise=True):
+        """
+        Emits ``line``, adding ``parent`` to the path of any validation error
+        it raises.
+        """
+        if not can_raise:
+            self.emit(line)
+            return
+        self.emit('try:')
+        with self.indent():
+            self.emit(line)
+        self.emit('except bv.ValidationError as e:')
+        with self.indent():
+            self.emit("e.add_parent('{}')".format(parent))
+            self.emit('raise')
 
     def _generate_enumerated_subtypes_tag_mapping(self, ns, data_type):
         """
@@ -816,6 +1329,8 @@ class PythonTypesBackend(CodeBackend):
             self._generate_union_class_is_set(data_type)
             self._generate_union_class_get_helpers(ns, data_type)
             self._generate_union_class_custom_annotations(ns, data_type)
+            if self.args.generate_serializers:
+                self._generate_union_class_serializers(ns, data_type)
         self.emit('{0}_validator = bv.Union({0})'.format(
             class_name_for_data_type(data_type)
         ))
@@ -850,10 +1365,10 @@ class PythonTypesBackend(CodeBackend):
         """
         class_name = fmt_class(data_type.name)
 
-        for field in data_type.fields:
+        validator_names = [self._field_validator(ns, field) for field in data_type.fields]
+        self._emit_validator_constants()
+        for field, validator_name in zip(data_type.fields, validator_names):
             field_name = fmt_var(field.name)
-            validator_name = generate_validator_constructor(
-                ns, field.data_type)
             full_validator_name = '{}._{}_validator'.format(class_name, field_name)
             self.emit('{} = {}'.format(full_validator_name, validator_name))
 
@@ -888,6 +1403,7 @@ class PythonTypesBackend(CodeBackend):
                     class_name_for_data_type(data_type.parent_type, ns))
                 )
 
+        self._generate_custom_annotation_types(ns, data_type)
         self.emit()
 
     def _generate_union_class_variant_creators(self, ns, data_type):
@@ -986,15 +1502,12 @@ class PythonTypesBackend(CodeBackend):
             self.emit()
 
             for field in data_type.fields:
-                recursive_processors = list(self._generate_custom_annotation_processors(
-                    ns, field.data_type, field.custom_annotations))
+                recursive_processors = self._field_custom_annotation_processors(ns, field)
 
                 # check if we have any annotations that apply to this field at all
                 if len(recursive_processors) == 0:
                     continue
 
-                recursive_processors = sorted(recursive_processors, key=lambda x: x[0].name)
-
                 field_name = fmt_func(field.name)
                 self.emit('if self.is_{}():'.format(field_name))
 
@@ -1013,6 +1526,138 @@ class PythonTypesBackend(CodeBackend):
                             ))
                         self.emit()
 
+    def _generate_union_class_serializers(self, ns, data_type):
+        """
+        Generates _to_json_compat and _from_json_compat, which convert between
+        instances of the union and their JSON-compatible representation with
+        one branch per tag. Only public tags are handled, matching the generic
+        serializers for callers without extra permissions.
+        """
+        class_name = class_name_for_data_type(data_type)
+        fields = _public_fields_with_inherited(data_type)
+        catch_all_field = _union_catch_all_field(data_type)
+        catch_all = fmt_var(catch_all_field.name) if catch_all_field else None
+
+        self.emit('def _to_json_compat(self):')
+        with self.indent():
+            self.emit('tag = self._tag')
+            for field in fields:
+                tag = fmt_var(field.name)
+                field_dt, nullable, _ = unwrap(field.data_type)
+                self.emit("if tag == '{}':".format(tag))
+                with self.indent():
+                    if is_void_type(field_dt):
+                        self.emit("return {{'.tag': '{}'}}".format(tag))
+                        continue
+                    if nullable:
+                        self.emit('if self._value is None:')
+                        with self.indent():
+                            self.emit("return {{'.tag': '{}'}}".format(tag))
+                    value = 'self._value'
+                    if is_list_type(field_dt) or is_map_type(field_dt):
+                        value = '{}._{}_validator.validate(self._value)'.format(class_name, tag)
+                    expr = self._json_compat_encode_expr(ns, field_dt, value)
+                    if is_struct_type(field_dt) and not field_dt.has_enumerated_subtypes():
+                        self.emit("d = {{'.tag': '{}'}}".format(tag))
+                        self._emit_json_compat_with_parent(tag, 'd.update({})'.format(expr))
+                        self.emit('return d')
+                    else:
+                        self._emit_json_compat_with_parent(
+                            tag,
+                            "return {{'.tag': '{0}', '{0}': {1}}}".format(tag, expr),
+                            is_composite_type(field_dt))
+            self.emit('if tag is None:')
+            with self.indent():
+                self.emit("raise bv.ValidationError('no tag set')")
+            self.emit('raise bv.ValidationError("caller does not have access to \'%s\' tag" % tag)')
+        self.emit()
+
+        symbol_tags, non_symbol_tags = [], []
+        for field in fields:
+            tag = fmt_var(field.name)
+            field_dt, nullable, _ = unwrap(field.data_type)
+            if tag == catch_all:
+                continue
+            elif nullable or is_void_type(field_dt):
+                symbol_tags.append(repr(tag))
+            else:
+                non_symbol_tags.append(repr(tag))
+
+        self.emit('@classmethod')
+        self.emit('def _from_json_compat(cls, obj, strict):')
+        with self.indent():
+            self.emit('if isinstance(obj, str):')
+            with self.indent():
+                if symbol_tags:
+                    self.emit('if obj in {{{}}}:'.format(', '.join(symbol_tags)))
+                    with self.indent():
+                        self.emit('return bb.union_symbol(cls, obj)')
+                if non_symbol_tags:
+                    self.emit('if obj in {{{}}}:'.format(', '.join(non_symbol_tags)))
+                    with self.indent():
+                        self.emit('raise bv.ValidationError('
+                                  '"expected object for \'%s\', got symbol" % obj)')
+                if catch_all:
+                    self._emit_json_compat_catch_all_check('obj', catch_all)
+                self.emit('return bb.json_compat_unknown_union_tag(cls, obj, strict)')
+            self.emit('if not isinstance(obj, dict):')
+            with self.indent():
+                self.emit("raise bv.ValidationError('expected string or object, got %s' % "
+                          "bv.generic_type_name(obj))")
+            self.emit('tag = bb.json_compat_union_tag(obj)')
+            for field in fields:
+                tag = fmt_var(field.name)
+                if tag == catch_all:
+                    continue
+                field_dt, nullable, _ = unwrap(field.data_type)
+                self.emit("if tag == '{}':".format(tag))
+                with self.indent():
+                    if is_void_type(field_dt):
+                        self.emit('if strict:')
+                        with self.indent():
+                            self.emit("bb.json_compat_check_void_union_keys(obj, '{}')".format(tag))
+                        self.emit("return bb.union_symbol(cls, '{}')".format(tag))
+                    elif is_struct_type(field_dt) and not field_dt.has_enumerated_subtypes():
+                        if nullable:
+                            self.emit('if len(obj) == 1:')
+                            with self.indent():
+                                self.emit("return bb.union_symbol(cls, '{}')".format(tag))
+                        self._emit_json_compat_with_parent(
+                            tag,
+                            'val = {}'.format(self._json_compat_decode_expr(ns, field_dt, 'obj')))
+                        self.emit("return cls('{}', val)".format(tag))
+                    else:
+                        self.emit("if '{}' in obj:".format(tag))
+                        with self.indent():
+                            raw_val = "obj['{}']".format(tag)
+                            expr = self._json_compat_decode_expr(ns, field_dt, raw_val)
+                            # Values are validated by the constructor, outside of the try block.
+                            self._emit_json_compat_with_parent(
+                                tag, 'val = {}'.format(expr), expr != raw_val)
+                        self.emit('else:')
+                        with self.indent():
+                            if nullable:
+                                self.emit('val = None')
+                            else:
+                                self.emit(
+                                    'raise bv.ValidationError("missing \'{}\' key")'.format(tag))
+                        self.emit("bb.json_compat_check_union_keys(obj, '{}')".format(tag))
+                        if nullable:
+                            self.emit('if val is None:')
+                            with self.indent():
+                                self.emit("return bb.union_symbol(cls, '{}')".format(tag))
+                        self.emit("return cls('{}', val)".format(tag))
+            if catch_all:
+                self._emit_json_compat_catch_all_check('tag', catch_all)
+            self.emit('return bb.json_compat_unknown_union_tag(cls, tag, strict)')
+        self.emit()
+
+    def _emit_json_compat_catch_all_check(self, var, catch_all):
+        self.emit("if {} == '{}':".format(var, catch_all))
+        with self.indent():
+            self.emit('raise bv.ValidationError('
+                      '"unexpected use of the catch-all tag \'%s\'" % {})'.format(var))
+
     def _generate_union_class_symbol_creators(self, data_type):
         """
         Class attributes that represent a symbol are set after the union class
@@ -1031,19 +1676,31 @@ class PythonTypesBackend(CodeBackend):
 
         check_route_name_conflict(namespace)
 
-        for route in namespace.routes:
-            data_types = [route.arg_data_type, route.result_data_type,
-                          route.error_data_type]
+        route_validator_names = [
+            [self._validator_constant(namespace, data_type)
+             for data_type in (route.arg_data_type, route.result_data_type,
+                               route.error_data_type)]
+            for route in namespace.routes]
+        self._emit_validator_constants()
+
+        for route, validator_names in zip(namespace.routes, route_validator_names):
+            # Routes with lazy validators get them when their data types are first read.
+            lazy = any(self._is_lazy_validator(namespace, data_type)
+                       for data_type in (route.arg_data_type, route.result_data_type,
+                                         route.error_data_type))
             with self.block(
-                    '{} = bb.Route('.format(fmt_func(route.name, version=route.version)),
+                    '{} = bb.{}('.format(fmt_func(route.name, version=route.version),
+                                         'LazyRoute' if lazy else 'Route'),
                     delim=(None, None),
                     after=')'):
                 self.emit("'{}',".format(route.name))
                 self.emit('{},'.format(route.version))
                 self.emit('{!r},'.format(route.deprecated is not None))
-                for data_type in data_types:
-                    self.emit(
-                        generate_validator_constructor(namespace, data_type) + ',')
+                if lazy:
+                    self.emit('lambda: ({}),'.format(', '.join(validator_names)))
+                else:
+                    for validator_name in validator_names:
+                        self.emit(validator_name + ',')
                 attrs = []
                 for field in route_schema.fields:
                     attr_key = field.name
@@ -1067,17 +1724,23 @@ class PythonTypesBackend(CodeBackend):
         elif isinstance(redactor, RedactedBlot):
             self.emit("{}._redact = bv.BlotRedactor({})".format(validator_name, regex))
 
-def generate_validator_constructor(ns, data_type):
+def generate_validator_constructor(ns, data_type, intern=None):
     """
     Given a Stone data type, returns a string that can be used to construct
     the appropriate validation object in Python.
+
+    If ``intern`` is given, it's called with the constructor expression and
+    the data type of every validator that is constructed, including nested
+    ones, and returns the expression to use instead, typically the name of a
+    constant.
     """
     dt, nullable_dt = unwrap_nullable(data_type)
+    is_reference = is_user_defined_type(dt) or is_alias(dt)
     if is_list_type(dt):
         v = generate_func_call(
             'bv.List',
             args=[
-                generate_validator_constructor(ns, dt.data_type)],
+                generate_validator_constructor(ns, dt.data_type, intern)],
             kwargs=[
                 ('min_items', dt.min_items),
                 ('max_items', dt.max_items)],
@@ -1086,8 +1749,8 @@ def generate_validator_constructor(ns, data_type):
         v = generate_func_call(
             'bv.Map',
             args=[
-                generate_validator_constructor(ns, dt.key_data_type),
-                generate_validator_constructor(ns, dt.value_data_type),
+                generate_validator_constructor(ns, dt.key_data_type, intern),
+                generate_validator_constructor(ns, dt.value_data_type, intern),
             ]
         )
     elif is_numeric_type(dt):
@@ -1128,10 +1791,42 @@ def generate_validator_constructor(ns, data_type):
     else:
         raise AssertionError('Unsupported data type: %r' % dt)
 
+    if intern is not None and not is_reference:
+        v = intern(v, dt)
+
     if nullable_dt:
-        return generate_func_call('bv.Nullable', args=[v])
-    else:
-        return v
+        v = generate_func_call('bv.Nullable', args=[v])
+        if intern is not None:
+            v = intern(v, data_type)
+    return v
+
+
+def _refers_to_user_defined_types(data_type):
+    """
+    Returns whether the validator of ``data_type`` refers to the validator of
+    a user-defined type or alias.
+    """
+    dt, _ = unwrap_nullable(data_type)
+    if is_list_type(dt):
+        return _refers_to_user_defined_types(dt.data_type)
+    elif is_map_type(dt):
+        return _refers_to_user_defined_types(dt.key_data_type) or \
+            _refers_to_user_defined_types(dt.value_data_type)
+    return is_user_defined_type(dt) or is_alias(dt)
+
+
+def _refers_to_other_namespaces(ns, data_type):
+    """
+    Returns whether the validator of ``data_type`` refers to the validator of
+    a user-defined type or alias of a namespace other than ``ns``.
+    """
+    dt, _ = unwrap_nullable(data_type)
+    if is_list_type(dt):
+        return _refers_to_other_namespaces(ns, dt.data_type)
+    elif is_map_type(dt):
+        return _refers_to_other_namespaces(ns, dt.key_data_type) or \
+            _refers_to_other_namespaces(ns, dt.value_data_type)
+    return (is_user_defined_type(dt) or is_alias(dt)) and dt.namespace.name != ns.name
 
 
 def generate_func_call(name, args=None, kwargs=None):
@@ -1155,3 +1850,28 @@ def generate_func_call(name, args=None, kwargs=None):
         all_args.extend('{}={}'.format(k, v)
                         for k, v in kwargs if v is not None)
     return '{}({})'.format(name, ', '.join(all_args))
+
+
+def _public_fields_with_inherited(data_type):
+    """
+    Returns the fields of a struct or union that are visible to callers
+    without extra permissions, including inherited fields, in the same
+    order as the generated ``_all_fields_`` attribute.
+    """
+    fields = []
+    if data_type.parent_type:
+        fields.extend(_public_fields_with_inherited(data_type.parent_type))
+    fields.extend(f for f in data_type.fields if f.omitted_caller is None)
+    return fields
+
+
+def _union_catch_all_field(data_type):
+    """
+    Returns the catch-all field of a union, which may be declared by a
+    parent union, or None.
+    """
+    while data_type:
+        if data_type.catch_all_field:
+            return data_type.catch_all_field
+        data_type = data_type.parent_type
+    return None
@@ -2,13 +2,19 @@
 
 
 import base64
+import copy
 import datetime
+import hashlib
 import importlib
+import itertools
 import json
+import pickle
 import shutil
 import subprocess
 import sys
+import textwrap
 import unittest
+from unittest import mock
 
 import six
 
@@ -154,6 +160,73 @@ class TestDropInModules(unittest.TestCase):
         self.assertRaises(bv.ValidationError,
                           lambda: t.validate(now.replace(tzinfo=PST())))
 
+    def test_timestamp_codec(self):
+        # The compiled codecs agree with strptime() and strftime(), including on the values
+        # they leave to them.
+        values = [
+            '2015-05-12T15:50:38Z', '2015-5-2T1:2:3Z', '2015-05-12t15:50:38z', '0999-01-01',
+            '2015-02-30T00:00:00Z', '2015-05-12T24:00:00Z', '2015-05-12T15:50:60Z',
+            '2015-05-12T15:50:38+00:00', '2015-05-12', '20150512', 'garbage', '', 1, None,
+        ]
+        datetimes = [
+            datetime.datetime(2015, 5, 12, 15, 50, 38),
+            datetime.datetime(2015, 5, 12, 15, 50, 38, 123, tzinfo=datetime.timezone.utc),
+            datetime.datetime(999, 1, 1),
+        ]
+        for fmt in ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d', '%Y%m%d', '%a, %d %b %Y']:
+            t = bv.Timestamp(fmt)
+            for val in values:
+                try:
+                    expected = datetime.datetime.strptime(val, fmt)
+                except (TypeError, ValueError) as e:
+                    with self.assertRaises(type(e)) as cm:
+                        t.parse(val)
+                    self.assertEqual(str(cm.exception), str(e))
+                else:
+                    self.assertEqual(t.parse(val), expected)
+            for dt in datetimes:
+                self.assertEqual(t.render(dt), dt.strftime(fmt))
+            # Compiled once per format.
+            self.assertIs(bv.Timestamp(fmt).parse, t.parse)
+
+        # Picklable, e.g. to send validators to other processes, despite the codec's closures.
+        t = bv.Timestamp('%Y')
+        t._redact = bv.HashRedactor(None)
+        for validator in [bv.List(bv.Timestamp('%Y')), bv.List(t)]:
+            copied = pickle.loads(pickle.dumps(validator))
+            self.assertEqual(copied.item_validator.format, '%Y')
+            self.assertIs(copied.item_validator.parse, t.parse)
+            self.assertEqual(hasattr(copied.item_validator, '_redact'),
+                             hasattr(validator.item_validator, '_redact'))
+
+    def test_redactors(self):
+        values = ['a-hash-b', 'plain', 'plain', 12, 1.5, None, ['unhashable']]
+        for redactor in [bv.HashRedactor(None), bv.HashRedactor(r'()(\-hash\-)()'),
+                         bv.HashRedactor(r'()(\-hash\-)()', memo_size=2),
+                         bv.BlotRedactor(None), bv.BlotRedactor(r'()(\-hash\-)()')]:
+            redacted = [redactor.apply(val) for val in values]
+            self.assertEqual(redactor.apply_many(iter(values)), redacted)
+            # Memoized or not, the hashes don't change.
+            self.assertEqual(redactor.apply_many(values), redacted)
+            # Picklable, e.g. with the validators sent to other processes.
+            self.assertEqual(pickle.loads(pickle.dumps(redactor)).apply_many(values), redacted)
+        self.assertEqual(bv.BlotRedactor(None).apply_many(values), ['********'] * len(values))
+        self.assertEqual(bv.BlotRedactor(r'()(\-hash\-)()').apply('a-hash-b'), '***-hash-***')
+        hash_redactor = bv.HashRedactor(None, memo_size=2)
+        self.assertEqual(hash_redactor.apply_many(['plain', 'plain']),
+                         [hashlib.md5(b'plain').hexdigest()] * 2)
+        self.assertEqual(hash_redactor._memo.cache_info().hits, 1)
+        self.assertEqual(hash_redactor.apply(12), hashlib.md5(b'12').hexdigest())
+        # Values that can't be hashed are redacted to None.
+        self.assertIsNone(hash_redactor.apply(None))
+        # Unpickled with an empty memo of the same size.
+        validator = bv.String()
+        validator._redact = hash_redactor
+        copied = pickle.loads(pickle.dumps(validator))._redact
+        self.assertEqual(copied._memo.cache_info().maxsize, 2)
+        self.assertEqual(copied._memo.cache_info().currsize, 0)
+        self.assertIsNone(copied.regex)
+
     def test_list_validator(self):
         l1 = bv.List(bv.String(), min_items=1, max_items=10)
         # Not a valid list type
@@ -167,6 +240,75 @@ class TestDropInModules(unittest.TestCase):
         # Passes
         l1.validate(['a'])
 
+    def test_validate_many(self):
+        email = "^['#&A-Za-z0-9._%+-]+@[A-Za-z0-9-][A-Za-z0-9.-]*\\.[A-Za-z]{2,15}$"
+        valid = [
+            (bv.Int32(), [1, -2**31, 2**31 - 1, True]),
+            (bv.UInt64(min_value=1, max_value=10), [1, 10, 5]),
+            (bv.Float64(), [1.5, -2.0]),
+            (bv.Float32(min_value=-1, max_value=1), [1, 0.5, False]),
+            (bv.Float64(), [1e308, 1e308]),
+            (bv.String(min_length=1, max_length=3, pattern='[a-z]+'), ['a', 'abc']),
+            (bv.Bytes(max_length=2), [b'ab', memoryview(b'a')]),
+            (bv.Boolean(), [True, False]),
+            (bv.Int32(), []),
+        ]
+        for validator, values in valid:
+            expected = [validator.validate(v) for v in values]
+            result = validator.validate_many(values)
+            self.assertEqual(result, expected)
+            self.assertEqual([type(v) for v in result], [type(v) for v in expected])
+            self.assertEqual(validator.validate_many(tuple(values)), expected)
+            self.assertEqual(bv.List(validator).validate(values), expected)
+
+        # The error is the one for the first invalid value.
+        invalid = [
+            (bv.Int32(), [1, 2**31, 1.5]),
+            (bv.UInt32(), [1, 'a', -1]),
+            (bv.Int64(max_value=5), [6, 1]),
+            (bv.Float64(), [1.0, float('nan')]),
+            (bv.Float64(), [float('inf'), float('-inf')]),
+            (bv.Float64(), [1, 10**400]),
+            (bv.Float32(), [1e39]),
+            (bv.Float64(min_value=0), [1.0, -1.0]),
+            (bv.String(max_length=2), ['a', 'abc', 1]),
+            (bv.String(min_length=2), ['ab', 'a']),
+            (bv.String(pattern='[a-z]+'), ['a', 'B']),
+            (bv.String(pattern=email), ['a@example.com', 'b']),
+            (bv.Bytes(min_length=1), [b'a', b'']),
+            (bv.Bytes(), [b'a', 'a']),
+        ]
+        for validator, values in invalid:
+            with self.assertRaises(bv.ValidationError) as cm:
+                for value in values:
+                    validator.validate(value)
+            expected = str(cm.exception)
+            with self.assertRaises(bv.ValidationError) as cm:
+                validator.validate_many(values)
+            self.assertEqual(str(cm.exception), expected)
+            with self.assertRaises(bv.ValidationError) as cm:
+                ss.json_encode(bv.List(validator), values)
+            self.assertEqual(str(cm.exception), expected)
+
+        # Validators that override validate have it called for each value.
+        validated = []
+
+        class LoggingInt32(bv.Int32):
+            def validate(self, val):
+                validated.append(val)
+                return super().validate(val)
+
+        self.assertEqual(LoggingInt32().validate_many([1, 2]), [1, 2])
+        self.assertEqual(validated, [1, 2])
+
+        # Lists of primitives are still encoded the same way.
+        self.assertEqual(ss.json_encode(bv.List(bv.Int32()), [1, True]), '[1, 1]')
+        self.assertEqual(ss.json_encode(bv.List(bv.Float64()), [1, 2.5]), '[1.0, 2.5]')
+        self.assertEqual(ss.json_encode(bv.List(bv.Bytes()), [b'a']), '["YQ=="]')
+        serializer = ss.StoneToPythonPrimitiveSerializer(None, None, False, False, False)
+        self.assertEqual(serializer.encode(bv.List(bv.Int32()), [True]), [1])
+        self.assertEqual(serializer.encode(bv.List(bv.Bytes()), [b'a']), ['YQ=='])
+
     def test_map_validator(self):
         m = bv.Map(bv.String(pattern="^foo.*"), bv.String(pattern=".*bar$"))
 
@@ -727,6 +869,14 @@ union V
     t11 Map(String, Int32)
     t12 Map(String, U)
 
+union W
+    r R
+    n R?
+    l List(String)
+
+struct R
+    items List(S)
+
 struct S
     f String
 
@@ -794,6 +944,15 @@ struct ContainsAlias
 
 struct S3
     u ns2.BaseU = z
+
+struct Metadata
+    name String
+    s S
+    parent Metadata?
+    modified Timestamp("%Y-%m-%dT%H:%M:%SZ")?
+    items List(S)?
+    v V?
+    data Bytes?
 """
 
 test_ns2_spec = """\
@@ -813,6 +972,10 @@ alias AliasedBaseU = BaseU
 
 class TestGeneratedPython(unittest.TestCase):
 
+    # Package the spec is compiled into, and extra arguments for the backend
+    package = 'output'
+    backend_args = ()
+
     def setUp(self):
 
         # Sanity check: stone must be importable for the compiler to work
@@ -824,11 +987,11 @@ class TestGeneratedPython(unittest.TestCase):
              '-m',
              'stone.cli',
              'python_types',
-             'output',
+             self.package,
              '-',
              '--',
              '--package',
-             'output'],
+             self.package] + list(self.backend_args),
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE)
         _, stderr = p.communicate(
@@ -837,13 +1000,24 @@ class TestGeneratedPython(unittest.TestCase):
             raise AssertionError('Could not execute stone tool: %s' %
                                  stderr.decode('utf-8'))
 
-        self.ns2 = importlib.import_module('output.ns2')
-        self.ns = importlib.import_module('output.ns')
+        self.ns2 = importlib.import_module(self.package + '.ns2')
+        self.ns = importlib.import_module(self.package + '.ns')
         self.encode = ss.json_encode
         self.compat_obj_encode = ss.json_compat_obj_encode
         self.decode = ss.json_decode
         self.compat_obj_decode = ss.json_compat_obj_decode
 
+    def test_validators_are_hash_consed(self):
+        # Structurally identical validators are only created once per module.
+        self.assertIs(self.ns.A.a.validator, self.ns.D.a.validator)
+        self.assertIs(self.ns.D.b.validator, self.ns.File.size.validator)
+        self.assertIs(self.ns.D.c.validator.validator, self.ns.D.a.validator)
+        self.assertIs(self.ns.Metadata.s.validator, self.ns.S_validator)
+        self.assertIs(self.ns.V._t4_validator.validator, self.ns.V._t3_validator)
+        self.assertIsNot(self.ns.D.b.validator, self.ns.D.d.validator)
+        # Aliases keep validators of their own, since they're identified by them.
+        self.assertIsNot(self.ns.ContainsAlias.s.validator, self.ns.A.a.validator)
+
     def test_docstring(self):
         # Check that the docstrings from the spec have in some form made it
         # into the Python docstrings for the generated objects.
@@ -1461,7 +1635,7 @@ class TestGeneratedPython(unittest.TestCase):
 
     def tearDown(self):
         # Clear output of stone tool after all tests.
-        shutil.rmtree('output')
+        shutil.rmtree(self.package)
 
     def test_msgpack(self):
         # Do a limited amount of testing just to make sure that unicode
@@ -1469,7 +1643,7 @@ class TestGeneratedPython(unittest.TestCase):
 
         # If the machine doesn't have msgpack, don't worry about these tests.
         try:
-            from stone_serializers import (
+            from stone.backends.python_rsrc.stone_serializers import (
                 msgpack_encode,
                 msgpack_decode,
             )
@@ -1493,6 +1667,50 @@ class TestGeneratedPython(unittest.TestCase):
         u2 = msgpack_decode(bv.String(), s)
         self.assertEqual(u, u2)
 
+        # Bytes are bin types, and memoryviews are packed as they are.
+        import msgpack
+        self.assertEqual(msgpack.unpackb(msgpack_encode(bv.Bytes(), bs), raw=True), bs)
+        s = msgpack_encode(bv.Struct(self.ns.B), self.ns.B(a='hi', b=32, c=memoryview(bs)))
+        self.assertEqual(msgpack_decode(bv.Struct(self.ns.B), s), b)
+
+        with self.assertRaises(bv.ValidationError) as cm:
+            msgpack_decode(bv.Struct(self.ns.B), msgpack.packb({'a': 'hi', 'b': 32, 'c': 'x'}))
+        self.assertEqual("c: expected bytes type, got string", str(cm.exception))
+        for data in (b'\xc1', b'\x92\x01', b'\x01\x02'):
+            with self.assertRaises(bv.ValidationError) as cm:
+                msgpack_decode(bv.List(bv.Int32()), data)
+            self.assertEqual('could not decode input as msgpack', str(cm.exception))
+
+    def test_msgpack_iterdecode(self):
+        try:
+            from stone.backends.python_rsrc.stone_serializers import (
+                msgpack_encode,
+                msgpack_iterdecode,
+            )
+        except ImportError:
+            return
+
+        validator = bv.Union(self.ns.V)
+        objs = [self.ns.V.t0, self.ns.V.t3(self.ns.S(f='\u2650')), self.ns.V.t9(['a', 'b']),
+                self.ns.V.t7(self.ns.File(name='n', size=2 ** 40))]
+        data = b''.join(msgpack_encode(validator, obj) for obj in objs)
+        for chunk_size in (1, 5, len(data)):
+            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+            self.assertEqual(list(msgpack_iterdecode(validator, chunks)), objs)
+        self.assertEqual(list(msgpack_iterdecode(validator, six.BytesIO(data))), objs)
+        self.assertEqual(list(msgpack_iterdecode(validator, [])), [])
+
+        items = msgpack_iterdecode(validator, [data[:3], data[3:]])
+        self.assertEqual(next(items), objs[0])
+
+        invalid = data + msgpack_encode(bv.Struct(self.ns.S), self.ns.S(f='x'))
+        with self.assertRaises(bv.ValidationError) as cm:
+            list(msgpack_iterdecode(validator, [invalid]))
+        self.assertEqual("[4]: missing '.tag' key", str(cm.exception))
+        with self.assertRaises(bv.ValidationError) as cm:
+            list(msgpack_iterdecode(validator, [data[:-1]]))
+        self.assertEqual('[3]: could not decode input as msgpack', str(cm.exception))
+
     def test_alias_validators(self):
 
         def aliased_string_validator(val):
@@ -1542,6 +1760,1257 @@ class TestGeneratedPython(unittest.TestCase):
         s = self.ns.S3()
         assert s.u == self.ns2.BaseU.z
 
+    def test_json_iterencode(self):
+        s = self.ns.S(f='x')
+        values = [
+            (bv.Struct(self.ns.D), self.ns.D(a='A', b=1, d=[1, None], e={'k': None, 'l': 'm'})),
+            (bv.Struct(self.ns.D), self.ns.D(a='A', d=[], e={})),
+            (bv.Struct(self.ns.S2), self.ns.S2()),
+            (bv.Struct(self.ns.S2), self.ns.S2(f1=self.ns.OptionalS())),
+            (bv.Struct(self.ns.S3), self.ns.S3()),
+            (bv.Union(self.ns.V), self.ns.V.t0),
+            (bv.Union(self.ns.V), self.ns.V.t2(None)),
+            (bv.Union(self.ns.V), self.ns.V.t3(s)),
+            (bv.Union(self.ns.V), self.ns.V.t4(None)),
+            (bv.Union(self.ns.V), self.ns.V.t5(self.ns.U.t1('y'))),
+            (bv.Union(self.ns.V), self.ns.V.t7(self.ns.File(name='n', size=1))),
+            (bv.Union(self.ns.V), self.ns.V.t10([self.ns.U.t0, self.ns.U.t1('z')])),
+            (bv.Union(self.ns.V), self.ns.V.t12({'a': self.ns.U.t2})),
+            (bv.Union(self.ns.V), self.ns.V('t1', 'x')),
+            (bv.StructTree(self.ns.Resource), self.ns.Folder(name='n')),
+            (bv.List(bv.List(bv.Struct(self.ns.S))), [[s, s], [], [s]]),
+            (bv.Map(bv.String(), bv.List(bv.Int32())), {'a': [1, 2], 'b': []}),
+            (bv.Nullable(bv.Struct(self.ns.S)), None),
+            (bv.Timestamp('%Y-%m-%dT%H:%M:%SZ'), datetime.datetime(2015, 5, 12, 15, 50, 38)),
+            (bv.Bytes(), b'\x00\x01'),
+            (bv.String(), '\u2650'),
+            # Invalid values
+            (bv.Struct(self.ns.D), self.ns.D(a='A', d=[])),
+            (bv.Struct(self.ns.D), self.ns.S(f='x')),
+            (bv.List(bv.Struct(self.ns.S)), [s, self.ns.S()]),
+            (bv.Union(self.ns.V), self.ns.V.t3(self.ns.S())),
+            (bv.UInt32(), -1),
+        ]
+        # Mutate after assignment so that only serialization catches it.
+        d = self.ns.D(a='A', d=[], e={})
+        d.d.append('x')
+        values.append((bv.Struct(self.ns.D), d))
+
+        for old_style in (False, True):
+            for validator, value in values:
+                try:
+                    expected = self.encode(validator, value, old_style=old_style)
+                except bv.ValidationError as e:
+                    with self.assertRaises(bv.ValidationError) as cm:
+                        ''.join(ss.json_iterencode(validator, value, old_style=old_style))
+                    self.assertEqual(str(e), str(cm.exception))
+                    continue
+
+                for chunk_size in (1, 10, 1000):
+                    chunks = list(ss.json_iterencode(
+                        validator, value, old_style=old_style, chunk_size=chunk_size))
+                    self.assertEqual(''.join(chunks), expected)
+                    self.assertTrue(all(len(chunk) >= chunk_size for chunk in chunks[:-1]))
+
+                fp = six.StringIO()
+                ss.json_encode_stream(validator, value, fp, old_style=old_style)
+                self.assertEqual(fp.getvalue(), expected)
+
+    def test_decoded_union_symbols_are_shared(self):
+        v = bv.Union(self.ns.V)
+        decoder = ss.PythonPrimitiveToStoneDecoder(None, None, False, False, True)
+        for old_style in (False, True):
+            for obj in ('t0', {'.tag': 't0'}, {'t0': None}):
+                if isinstance(obj, dict) and old_style != ('.tag' not in obj):
+                    continue
+                self.assertIs(
+                    self.compat_obj_decode(v, obj, old_style=old_style), self.ns.V.t0)
+            self.assertIs(self.compat_obj_decode(v, 'unknown', strict=False,
+                                                 old_style=old_style),
+                          self.ns.V.other)
+        self.assertIs(decoder.json_compat_obj_decode_helper(v, 't0'), self.ns.V.t0)
+
+        # Inherited void tags and null values get their own shared instances.
+        u_open = self.compat_obj_decode(bv.Union(self.ns.UOpen), 't0')
+        self.assertIsInstance(u_open, self.ns.UOpen)
+        self.assertEqual(u_open, self.ns.UOpen('t0'))
+        self.assertIs(self.compat_obj_decode(bv.Union(self.ns.UOpen), {'.tag': 't0'}), u_open)
+        t2 = self.compat_obj_decode(v, {'.tag': 't2', 't2': None})
+        self.assertEqual(t2, self.ns.V.t2(None))
+        self.assertIs(self.compat_obj_decode(v, 't2'), t2)
+        self.assertIs(ss.json_decode(bv.List(v), '["t0", "t0"]')[1], self.ns.V.t0)
+
+        # Unions with values are still validated and distinct.
+        t1 = self.compat_obj_decode(v, {'.tag': 't1', 't1': 'x'})
+        self.assertEqual(t1, self.ns.V.t1('x'))
+        self.assertIsNot(self.compat_obj_decode(v, {'.tag': 't1', 't1': 'x'}), t1)
+        with self.assertRaises(bv.ValidationError) as cm:
+            self.compat_obj_decode(v, {'.tag': 't1', 't1': 1})
+        self.assertEqual("'1' expected to be a string, got integer", str(cm.exception))
+
+    def test_trusted_decode(self):
+        docs = [
+            (bv.Struct(self.ns.C), {'a': 'x', 'b': 1, 'c': 'YQ==', 'd': 2}),
+            (bv.Struct(self.ns.D), {'a': 'x', 'c': None, 'd': [1, None], 'e': {'k': None}}),
+            (bv.Struct(self.ns.D), {'a': 'x', 'd': [], 'e': {}}),
+            (bv.Struct(self.ns.E), {'c': 1}),
+            (bv.Struct(self.ns.Metadata), {'name': 'a', 's': {'f': 'x'}}),
+            (bv.Union(self.ns.V), {'.tag': 't3', 'f': 'x'}),
+            (bv.Union(self.ns.V), {'.tag': 't11', 't11': {'a': 1}}),
+            (bv.Union(self.ns.V), 't0'),
+            (bv.StructTree(self.ns.Resource), {'.tag': 'file', 'name': 'n', 'size': 1}),
+            (bv.List(bv.Struct(self.ns.S)), [{'f': 'x'}]),
+        ]
+        for validator, obj in docs:
+            expected = self.compat_obj_decode(validator, obj)
+            for decode in (lambda: self.compat_obj_decode(validator, obj, trusted=True),
+                           lambda: self.decode(validator, json.dumps(obj), trusted=True)):
+                result = decode()
+                self.assertEqual(result, expected)
+                # Set and unset fields are the same too.
+                self.assertEqual(repr(result), repr(expected))
+                self.assertEqual(self.encode(validator, result), self.encode(validator, expected))
+
+        # Values are still converted...
+        c = self.compat_obj_decode(
+            bv.Struct(self.ns.C), {'a': 'x', 'b': 1, 'c': 'YQ==', 'd': 2}, trusted=True)
+        self.assertEqual(c.c, b'a')
+        self.assertIs(type(c.d), float)
+        # ...but not validated again.
+        d = self.compat_obj_decode(bv.Struct(self.ns.D), {'a': 1, 'd': ['x'], 'e': {}},
+                                   trusted=True)
+        self.assertEqual((d.a, d.d), (1, ['x']))
+        v = self.compat_obj_decode(bv.Union(self.ns.V), {'.tag': 't1', 't1': 1}, trusted=True)
+        self.assertEqual(v.get_t1(), 1)
+        self.assertEqual(self.compat_obj_decode(bv.Int32(), 2**40, trusted=True), 2**40)
+
+        # Required fields, conversions and unknown keys are still checked.
+        invalid = [
+            (bv.Struct(self.ns.S), {}),
+            (bv.Struct(self.ns.C), {'a': 'x', 'b': 1, 'c': 'a', 'd': 2}),
+            (bv.Struct(self.ns.S), {'f': 'x', 'g': 'y'}),
+            (bv.Union(self.ns.V), {'.tag': 't3'}),
+        ]
+        for validator, obj in invalid:
+            with self.assertRaises(bv.ValidationError) as cm:
+                self.compat_obj_decode(validator, obj)
+            expected = str(cm.exception)
+            with self.assertRaises(bv.ValidationError) as cm:
+                self.compat_obj_decode(validator, obj, trusted=True)
+            self.assertEqual(str(cm.exception), expected)
+        # Null leaves a field unset, as it would a nullable one.
+        with self.assertRaises(bv.ValidationError) as cm:
+            self.compat_obj_decode(bv.Struct(self.ns.S), {'f': None}, trusted=True)
+        self.assertEqual(str(cm.exception), "missing required field 'f'")
+
+    def test_lazy_decode(self):
+        validator = bv.Struct(self.ns.Metadata)
+        obj = {
+            'name': 'a',
+            's': {'f': 'x'},
+            'parent': {'name': 'b', 's': {'f': 'y'}, 'items': [{'f': 'z'}]},
+            'modified': '2015-05-12T15:50:38Z',
+            'v': {'.tag': 't1', 't1': 'x'},
+            'data': 'YQ==',
+        }
+        expected = self.compat_obj_decode(validator, obj)
+        m = self.compat_obj_decode(validator, obj, lazy=True)
+        self.assertIsInstance(m, self.ns.Metadata)
+        self.assertEqual(m._name_value, 'a')
+        for name in ('s', 'parent', 'modified', 'v', 'data'):
+            self.assertIsInstance(getattr(m, '_%s_value' % name), bb.LazyValue)
+        self.assertIs(m._items_value, bb.NOT_SET)
+        self.assertEqual(m.modified, datetime.datetime(2015, 5, 12, 15, 50, 38))
+        self.assertIsInstance(m.parent._s_value, bb.LazyValue)
+        self.assertEqual(m, expected)
+        self.assertIs(bb.validate_all(m), m)
+
+        # Lazy values are decoded when encoding.
+        m = self.decode(validator, json.dumps(obj), lazy=True)
+        self.assertEqual(self.compat_obj_encode(validator, m),
+                         self.compat_obj_encode(validator, expected))
+
+        # And when pickling or deep copying, since a LazyValue holds the decoder.
+        m = self.compat_obj_decode(validator, obj, lazy=True)
+        self.assertEqual(pickle.loads(pickle.dumps(m)), expected)
+        self.assertNotIsInstance(m._parent_value, bb.LazyValue)
+        self.assertNotIsInstance(m.parent._s_value, bb.LazyValue)
+        m = self.compat_obj_decode(validator, obj, lazy=True)
+        self.assertEqual(copy.deepcopy(m), expected)
+        self.assertNotIsInstance(m._s_value, bb.LazyValue)
+
+        # Validation errors have the full path, whether fields are read or validated at once.
+        invalid = [
+            dict(obj, parent=dict(obj['parent'], s={'f': 1})),
+            dict(obj, parent=dict(obj['parent'], s={})),
+            dict(obj, parent=dict(obj['parent'], items=[{'f': 'x'}, {}])),
+            dict(obj, modified='yesterday'),
+            dict(obj, v={'.tag': 't1', 't1': 1}),
+        ]
+        for bad in invalid:
+            with self.assertRaises(bv.ValidationError) as cm:
+                self.compat_obj_decode(validator, bad)
+            expected_error = str(cm.exception)
+            m = self.compat_obj_decode(validator, bad, lazy=True)
+            with self.assertRaises(bv.ValidationError) as cm:
+                for name in ('s', 'v', 'modified', 'parent'):
+                    getattr(m, name)
+                for name in ('s', 'items'):
+                    getattr(m.parent, name)
+            self.assertEqual(str(cm.exception), expected_error)
+            m = self.compat_obj_decode(validator, bad, lazy=True)
+            with self.assertRaises(bv.ValidationError) as cm:
+                bb.validate_all(m)
+            self.assertEqual(str(cm.exception), expected_error)
+
+        # Missing required fields and unknown keys are still reported right away.
+        for bad in ({'name': 'a'}, dict(obj, x=1)):
+            with self.assertRaises(bv.ValidationError) as cm:
+                self.compat_obj_decode(validator, bad)
+            expected_error = str(cm.exception)
+            with self.assertRaises(bv.ValidationError) as cm:
+                self.compat_obj_decode(validator, bad, lazy=True)
+            self.assertEqual(str(cm.exception), expected_error)
+
+    def test_field_mask(self):
+        validator = bv.Struct(self.ns.Metadata)
+        obj = {
+            'name': 'a',
+            's': {'f': 'x'},
+            'parent': {'name': 'b', 's': {'f': 'y'}, 'items': [{'f': 'z'}]},
+            'items': [{'f': 'u'}, {'f': 'w'}],
+            'v': {'.tag': 't3', 'f': 'v'},
+        }
+        m = self.compat_obj_decode(validator, obj)
+
+        # Only fields in the mask are encoded, at every depth.
+        mask = ['name', 'parent.s', 'items[*].f', 'v.f']
+        self.assertEqual(self.compat_obj_encode(validator, m, field_mask=mask), {
+            'name': 'a',
+            'parent': {'s': {'f': 'y'}},
+            'items': [{'f': 'u'}, {'f': 'w'}],
+            'v': {'.tag': 't3', 'f': 'v'},
+        })
+        self.assertEqual(self.compat_obj_encode(validator, m, field_mask='parent.items.f'),
+                         {'parent': {'items': [{'f': 'z'}]}})
+        self.assertEqual(json.loads(self.encode(validator, m, field_mask=['v'])),
+                         {'v': {'.tag': 't3', 'f': 'v'}})
+        map_validator = bv.Map(bv.String(), validator)
+        self.assertEqual(self.compat_obj_encode(map_validator, {'k': m}, field_mask='s'),
+                         {'k': {'s': {'f': 'x'}}})
+        tree_validator = bv.StructTree(self.ns.Resource)
+        f = self.ns.File(name='n', size=3)
+        self.assertEqual(self.compat_obj_encode(tree_validator, f, field_mask='size'),
+                         {'.tag': 'file', 'size': 3})
+
+        # A mask including all fields doesn't change anything.
+        full_mask = [name for name, _ in self.ns.Metadata._all_fields_]
+        self.assertEqual(self.compat_obj_encode(validator, m, field_mask=full_mask),
+                         self.compat_obj_encode(validator, m))
+        self.assertEqual(self.compat_obj_decode(validator, obj, field_mask=full_mask), m)
+
+        # Fields outside the mask are neither decoded nor required.
+        for lazy in (False, True):
+            for trusted in (False, True):
+                decoded = self.compat_obj_decode(
+                    validator, dict(obj, name=1, s={}), field_mask=['parent.s', 'v.f'],
+                    lazy=lazy, trusted=trusted)
+                self.assertIs(decoded._name_value, bb.NOT_SET)
+                self.assertIs(decoded._s_value, bb.NOT_SET)
+                self.assertIs(decoded.parent._name_value, bb.NOT_SET)
+                self.assertIs(decoded.parent._items_value, bb.NOT_SET)
+                self.assertEqual(decoded.parent.s.f, 'y')
+                self.assertEqual(decoded.v.get_t3().f, 'v')
+        decoded = self.decode(validator, json.dumps({'items': [{'f': 'u'}, {'f': 'w'}],
+                                                     'name': 1}), field_mask='items')
+        self.assertEqual(len(decoded.items), 2)
+        self.assertIs(decoded._name_value, bb.NOT_SET)
+        decoded = self.compat_obj_decode(tree_validator, {'.tag': 'file', 'size': 3},
+                                         field_mask='size')
+        self.assertIsInstance(decoded, self.ns.File)
+        self.assertEqual(decoded.size, 3)
+        self.assertIs(decoded._name_value, bb.NOT_SET)
+
+        # Fields in the mask are still required, and unknown fields are still rejected.
+        invalid = [
+            ({}, "missing required field 'name'"),
+            ({'name': 'a', 'parent': {}}, "parent: missing required field 's'"),
+            ({'name': 'a', 'v': {'.tag': 't3'}}, "v.t3: missing required field 'f'"),
+            ({'name': 'a', 'items': [{'f': 'u'}, {}]}, "items: missing required field 'f'"),
+            (dict(obj, x=1), "unknown field 'x'"),
+        ]
+        for bad, error in invalid:
+            for lazy in (False, True):
+                with self.assertRaises(bv.ValidationError) as cm:
+                    decoded = self.compat_obj_decode(validator, bad, field_mask=mask, lazy=lazy)
+                    bb.validate_all(decoded)
+                self.assertEqual(str(cm.exception), error)
+
+        # Names must be those of fields, of a struct or of its subtypes or union members.
+        self.assertEqual(self.compat_obj_encode(tree_validator, f, field_mask='size'),
+                         self.compat_obj_encode(bv.List(tree_validator), [f],
+                                                field_mask='size')[0])
+        self.assertEqual(self.compat_obj_encode(bv.Union(self.ns.V), self.ns.V.t3(m.s),
+                                                field_mask='f'), {'.tag': 't3', 'f': 'x'})
+        for bad_mask in ('nmae', 'items[*].g', 'parent.s.x', 'v.t3', 'v.t1'):
+            with self.assertRaises(ValueError) as cm:
+                self.compat_obj_encode(validator, m, field_mask=bad_mask)
+            self.assertIn(repr(bad_mask.replace('[*]', '')), str(cm.exception))
+            with self.assertRaises(ValueError):
+                self.compat_obj_decode(validator, obj, field_mask=['name', bad_mask])
+            with self.assertRaises(ValueError):
+                self.decode(validator, json.dumps(obj), field_mask=bad_mask, trusted=True)
+        with self.assertRaises(ValueError):
+            self.compat_obj_encode(tree_validator, f, field_mask='sise')
+        # Fields of the subtypes of a struct under a union member
+        self.assertEqual(self.compat_obj_encode(validator, m, field_mask='v.size'),
+                         {'v': {'.tag': 't3'}})
+
+        for bad_mask in ('', 'parent..s', '[*]'):
+            with self.assertRaises(ValueError):
+                self.compat_obj_encode(validator, m, field_mask=bad_mask)
+            with self.assertRaises(ValueError):
+                self.compat_obj_decode(validator, obj, field_mask=bad_mask)
+        with self.assertRaises(TypeError):
+            self.compat_obj_encode(validator, m, field_mask=[1])
+
+    def test_validate_only(self):
+        metadata = {
+            'name': 'a',
+            's': {'f': 'x'},
+            'parent': {'name': 'b', 's': {'f': 'y'}, 'items': [{'f': 'z'}]},
+            'modified': '2015-05-12T15:50:38Z',
+            'items': [{'f': 'u'}],
+            'v': {'.tag': 't3', 'f': 'v'},
+            'data': 'YQ==',
+        }
+        d = {'a': 'x', 'c': None, 'd': [1, None], 'e': {'k': None, 'l': 'm'}}
+        cases = [
+            (bv.Struct(self.ns.Metadata), [
+                metadata,
+                dict(metadata, name=1),
+                dict(metadata, name=None),
+                dict(metadata, s=None),
+                dict(metadata, s={}),
+                dict(metadata, parent=dict(metadata['parent'], items=[{'f': 'x'}, {}])),
+                dict(metadata, parent=dict(metadata['parent'], x=1)),
+                dict(metadata, items={'f': 'u'}),
+                dict(metadata, items=[None]),
+                dict(metadata, items=None),
+                dict(metadata, modified='yesterday'),
+                dict(metadata, data='a'),
+                dict(metadata, v={'.tag': 't1', 't1': 1}),
+                dict(metadata, v={'.tag': 't1', 't1': None}),
+                dict(metadata, v={'.tag': 't2', 't2': None}),
+                dict(metadata, v={'.tag': 't10', 't10': None}),
+                dict(metadata, v={'.tag': 't9', 't9': ['a', 2]}),
+                dict(metadata, v={'.tag': 't10', 't10': ['t0', 't1']}),
+                dict(metadata, v={'.tag': 't11', 't11': {'a': 'b'}}),
+                dict(metadata, v={'.tag': 't12', 't12': {'a': {'.tag': 't3'}}}),
+                dict(metadata, v={'.tag': 't7', 't7': {'.tag': 'file', 'name': 'n'}}),
+                dict(metadata, v={'.tag': 't8', 't8': {'.tag': 'folder', 'name': 'n'}}),
+                dict(metadata, v='t3'),
+                dict(metadata, v={'.tag': 'x'}),
+                {'name': 'a'},
+                [],
+            ]),
+            (bv.Struct(self.ns.D), [
+                d,
+                dict(d, b=-1),
+                dict(d, d=[1, 'x']),
+                dict(d, e={'k': 1}),
+                dict(d, e=[]),
+                {'d': [], 'e': {}},
+            ]),
+            (bv.Struct(self.ns.E), [{}, {'c': None}, {'a': None}, {'c': 'x'}]),
+            (bv.StructTree(self.ns.Resource), [
+                {'.tag': 'file', 'name': 'n', 'size': 3},
+                {'.tag': 'file', 'name': 'n', 'size': -3},
+                {'.tag': 'file', 'name': 'n'},
+                {'.tag': 'folder', 'name': 'n', 'size': 3},
+                {'.tag': 'x', 'name': 'n'},
+                {'name': 'n'},
+            ]),
+            (bv.Union(self.ns.U), ['t0', {'.tag': 't1', 't1': 'x'}, 't1', {'.tag': 't1'}, 1,
+                                   {'.tag': 't1', 't1': None}, {'.tag': 't0', 't0': None}]),
+            (bv.Nullable(bv.Struct(self.ns.S)), [None, {'f': 'x'}, {'f': None}]),
+            (bv.List(bv.Struct(self.ns.S)), [[{'f': 'x'}], [{'f': 'x'}, {}], {}]),
+            (bv.Map(bv.String(), bv.Union(self.ns.U)), [{'a': 't0'}, {'a': 't3'}]),
+            (bv.Nullable(bv.List(bv.Struct(self.ns.S))), [None, [{'f': 'x'}], [None]]),
+            (bv.Nullable(bv.Map(bv.String(), bv.Union(self.ns.U))), [None, {'a': 't3'}]),
+            (bv.String(max_length=1), ['a', 'ab', None]),
+            (bv.Timestamp('%Y-%m-%dT%H:%M:%SZ'), ['2015-05-12T15:50:38Z', 'yesterday']),
+        ]
+        for validator, objs in cases:
+            for obj in objs:
+                try:
+                    self.compat_obj_decode(validator, obj)
+                except bv.ValidationError as e:
+                    with self.assertRaises(bv.ValidationError) as cm:
+                        ss.json_compat_obj_validate(validator, obj)
+                    self.assertEqual(str(cm.exception), str(e))
+                    with self.assertRaises(bv.ValidationError) as cm:
+                        ss.json_validate(validator, json.dumps(obj).encode('utf-8'))
+                    self.assertEqual(str(cm.exception), str(e))
+                else:
+                    self.assertIsNone(ss.json_compat_obj_validate(validator, obj))
+                    self.assertIsNone(ss.json_validate(validator, json.dumps(obj)))
+
+        # No instances are created.
+        validator = bv.List(bv.Struct(self.ns.Metadata))
+        with mock.patch.object(self.ns.Metadata, '__new__', side_effect=AssertionError), \
+                mock.patch.object(self.ns.S, '__new__', side_effect=AssertionError), \
+                mock.patch.object(self.ns.V, '__new__', side_effect=AssertionError):
+            with self.assertRaises(AssertionError):
+                self.ns.S()
+            self.assertIsNone(ss.json_compat_obj_validate(validator, [metadata]))
+
+        # Unlike json_compat_obj_decode(), members of lists and maps are validated at the top
+        # level too.
+        for validator, obj in [(bv.List(bv.String()), [1]),
+                               (bv.Map(bv.String(), bv.Int32()), {'a': 'x'}),
+                               (bv.Nullable(bv.String(min_length=2)), 'x')]:
+            with self.assertRaises(bv.ValidationError):
+                ss.json_compat_obj_validate(validator, obj)
+
+        with self.assertRaises(bv.ValidationError) as cm:
+            ss.json_validate(validator, b'{')
+        self.assertEqual('could not decode input as JSON', str(cm.exception))
+        # Unknown fields are allowed when not strict.
+        ss.json_compat_obj_validate(
+            bv.Struct(self.ns.Metadata), dict(metadata, x=1), strict=False)
+
+    def test_transcode(self):
+        metadata = {
+            'name': 'a',
+            's': {'f': 'x'},
+            'parent': {'name': 'b', 's': {'f': 'y'}, 'items': [{'f': 'z'}]},
+            'modified': '2015-05-12T15:50:38Z',
+            'items': [{'f': 'u'}],
+            'v': {'.tag': 't3', 'f': 'x'},
+            'data': 'YWI=',
+        }
+        cases = [
+            (bv.Struct(self.ns.Metadata), [
+                metadata,
+                dict(metadata, v={'.tag': 't4'}),
+                dict(metadata, v={'.tag': 't10', 't10': ['t0', {'.tag': 't1', 't1': 'x'}]}),
+                dict(metadata, v={'.tag': 't12', 't12': {'a': 't2'}}),
+                dict(metadata, v='t0', parent=None),
+                dict(metadata, items=None),
+            ]),
+            (bv.Struct(self.ns.D), [
+                {'a': 'x', 'c': None, 'd': [1, None], 'e': {'k': None, 'l': 'm'}},
+                {'a': 'x', 'b': 3, 'd': [], 'e': {}},
+            ]),
+            (bv.Struct(self.ns.E), [{}, {'c': 1}]),
+            (bv.Struct(self.ns.C), [{'a': 'x', 'b': 1, 'c': 'YQ==', 'd': 1}]),
+            (bv.List(bv.Union(self.ns.U)), [['t0', {'.tag': 't1', 't1': 'x'}]]),
+            (bv.Nullable(bv.List(bv.Struct(self.ns.S))), [None, [{'f': 'x'}]]),
+            (bv.Nullable(bv.Map(bv.String(), bv.Union(self.ns.U))), [None, {'a': 't0'}]),
+            (bv.Timestamp('%Y-%m-%d'), ['2015-5-2']),
+        ]
+        for validator, objs in cases:
+            for obj in objs:
+                value = self.compat_obj_decode(validator, obj)
+                for old_style, output_old_style in itertools.product((False, True),
+                                                                     (False, True)):
+                    input_obj = self.compat_obj_encode(validator, value, old_style=old_style)
+                    expected = self.compat_obj_encode(validator, value,
+                                                      old_style=output_old_style)
+                    self.assertEqual(
+                        ss.json_compat_obj_transcode(
+                            validator, input_obj, old_style=old_style,
+                            output_old_style=output_old_style),
+                        expected)
+                    self.assertEqual(
+                        json.loads(ss.json_transcode(
+                            validator, json.dumps(input_obj).encode('utf-8'),
+                            old_style=old_style, output_old_style=output_old_style)),
+                        json.loads(json.dumps(expected)))
+        # Struct trees are only decoded in the new style.
+        validator = bv.Struct(self.ns.Metadata)
+        obj = dict(metadata, v={'.tag': 't7', 't7': {'.tag': 'file', 'name': 'n', 'size': 3}})
+        value = self.compat_obj_decode(validator, obj)
+        for output_old_style in (False, True):
+            self.assertEqual(
+                ss.json_compat_obj_transcode(validator, obj, output_old_style=output_old_style),
+                self.compat_obj_encode(validator, value, old_style=output_old_style))
+        self.assertEqual(ss.json_compat_obj_transcode(bv.Struct(self.ns.C),
+                                                      {'a': 'x', 'b': 1, 'c': '', 'd': 1}),
+                         {'a': 'x', 'b': 1, 'c': '', 'd': 1.0})
+
+        # Input is validated like json_compat_obj_decode() does, unless it's trusted.
+        for bad in (dict(metadata, s={}), dict(metadata, name=1), dict(metadata, x=1)):
+            with self.assertRaises(bv.ValidationError) as cm:
+                self.compat_obj_decode(validator, bad)
+            expected_error = str(cm.exception)
+            with self.assertRaises(bv.ValidationError) as cm:
+                ss.json_compat_obj_transcode(validator, bad, output_old_style=True)
+            self.assertEqual(str(cm.exception), expected_error)
+        self.assertEqual(
+            ss.json_compat_obj_transcode(validator, dict(metadata, name=1), trusted=True)['name'],
+            1)
+        self.assertEqual(
+            ss.json_compat_obj_transcode(validator, dict(metadata, x=1), strict=False),
+            ss.json_compat_obj_transcode(validator, metadata))
+
+    def test_json_engines(self):
+        validator = bv.Struct(self.ns.D)
+        obj = self.ns.D(a='\u2650', b=2 ** 63, c='"\\/', d=[-1, None], e={'k': None})
+        expected = ss.json_encode(validator, obj)
+        self.assertEqual(expected, json.dumps(json.loads(expected)))
+
+        default_engine = ss.get_json_engine()
+        self.assertEqual(default_engine.name, 'json')
+        self.assertEqual(json.loads(ss.json_encode_bytes(validator, obj).decode('utf-8')),
+                         json.loads(expected))
+        self.assertEqual(ss.json_decode_bytes(validator, expected.encode('utf-8')), obj)
+        with self.assertRaises(ValueError):
+            ss.set_json_engine('unknown')
+
+        calls = []
+
+        def dumps(obj):
+            calls.append(obj)
+            return json.dumps(obj, separators=(',', ':'))
+
+        ss.register_json_engine(ss.JsonEngine('test', dumps, json.loads))
+        try:
+            for name in ('json', 'orjson', 'ujson', 'test'):
+                try:
+                    ss.set_json_engine(name)
+                except ValueError:
+                    continue
+                self.assertEqual(ss.get_json_engine().name, name)
+                encoded = ss.json_encode(validator, obj)
+                self.assertEqual(json.loads(encoded), json.loads(expected))
+                self.assertEqual(ss.json_decode(validator, encoded), obj)
+                encoded = ss.json_encode_bytes(validator, obj)
+                self.assertIsInstance(encoded, bytes)
+                self.assertEqual(json.loads(encoded.decode('utf-8')), json.loads(expected))
+                self.assertEqual(ss.json_decode_bytes(validator, encoded), obj)
+                for data in (b'{', b'{"a": "\xff"}'):
+                    with self.assertRaises(bv.ValidationError) as cm:
+                        ss.json_decode_bytes(validator, data)
+                    self.assertEqual('could not decode input as JSON', str(cm.exception))
+            self.assertEqual(ss.json_encode(bv.String(), 'x'), '"x"')
+            self.assertEqual(calls[-1], 'x')
+        finally:
+            ss.set_json_engine(None)
+        self.assertIs(ss.get_json_engine(), default_engine)
+
+    def test_json_encode_decode_many(self):
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        validator = bv.Struct(self.ns.D)
+        objs = [self.ns.D(a=str(i), b=i, d=[i, None], e={'k': str(i)}) for i in range(25)]
+        expected = [ss.json_encode(validator, obj) for obj in objs]
+
+        self.assertEqual(ss.json_encode_many(validator, objs), expected)
+        self.assertEqual(ss.json_encode_many(validator, iter(objs)), expected)
+        self.assertEqual(ss.json_decode_many(validator, expected), objs)
+        self.assertEqual(ss.json_encode_many(validator, []), [])
+
+        with ThreadPoolExecutor(2) as executor:
+            for batch_size in (1, 7, 100):
+                self.assertEqual(
+                    ss.json_encode_many(validator, objs, executor=executor,
+                                        batch_size=batch_size),
+                    expected)
+                self.assertEqual(
+                    ss.json_decode_many(validator, expected, executor=executor,
+                                        batch_size=batch_size),
+                    objs)
+        with ProcessPoolExecutor(2) as executor:
+            self.assertEqual(
+                ss.json_encode_many(validator, objs, executor=executor, batch_size=10),
+                expected)
+            self.assertEqual(
+                ss.json_decode_many(validator, expected, executor=executor, batch_size=10),
+                objs)
+            # Validators are pickled along with the batches.
+            timestamps = bv.List(bv.Timestamp('%Y-%m-%d'))
+            dates = [[datetime.datetime(2015, 5, i)] for i in range(1, 4)]
+            self.assertEqual(
+                ss.json_encode_many(timestamps, dates, executor=executor, batch_size=1),
+                ['["2015-05-01"]', '["2015-05-02"]', '["2015-05-03"]'])
+
+        # Errors are reported with the index of the failing object.
+        invalid = list(objs)
+        invalid[12] = self.ns.D(a='A', e={})
+        invalid[20] = self.ns.S(f='x')
+        serialized = list(expected)
+        serialized[3] = '{"a": "A", "d": ["x"], "e": {}}'
+        serialized[4] = '{'
+        for executor in (None, ThreadPoolExecutor(2)):
+            with self.assertRaises(bv.ValidationError) as cm:
+                ss.json_encode_many(validator, invalid, executor=executor, batch_size=5)
+            self.assertEqual("[12]: missing required field 'd'", str(cm.exception))
+            with self.assertRaises(bv.ValidationError) as cm:
+                ss.json_decode_many(validator, serialized, executor=executor, batch_size=5)
+            self.assertEqual('[3].d: expected integer, got string', str(cm.exception))
+
+            results = ss.json_encode_many(
+                validator, invalid, executor=executor, batch_size=5, return_exceptions=True)
+            self.assertEqual(
+                [r for i, r in enumerate(results) if i not in (12, 20)],
+                [r for i, r in enumerate(expected) if i not in (12, 20)])
+            self.assertEqual("[12]: missing required field 'd'", str(results[12]))
+            self.assertIsInstance(results[20], bv.ValidationError)
+            results = ss.json_decode_many(
+                validator, serialized, executor=executor, batch_size=5, return_exceptions=True)
+            self.assertEqual(results[5:], objs[5:])
+            self.assertEqual('[4]: could not decode input as JSON', str(results[4]))
+            if executor:
+                executor.shutdown()
+
+    def _iterdecode(self, data_type, data, chunk_size, **kwargs):
+        decoder = ss.StreamingJsonDecoder(data_type, **kwargs)
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        items = list(decoder.iter_decode(chunks))
+        return items, decoder.result
+
+    def test_streaming_decoder(self):
+        s_list = bv.List(bv.Struct(self.ns.S))
+        cases = [
+            (s_list, (), [{'f': 'x'}, {'f': '\u2650'}, {'f': 'z'}]),
+            (s_list, (), []),
+            (bv.List(bv.StructTree(self.ns.Resource)), (),
+             [{'.tag': 'file', 'name': 'n', 'size': 1}, {'.tag': 'folder', 'name': 'o'}]),
+            (bv.List(bv.Int32(), max_items=2), (), [1, 2]),
+            (bv.List(bv.Nullable(bv.Struct(self.ns.S))), (), [None, {'f': 'x'}]),
+            (bv.Struct(self.ns.D), ('d',), {'a': 'A', 'd': [1, None, 123456789], 'e': {}}),
+            (bv.Struct(self.ns.D), ('d',), {'e': {'k': None}, 'd': [], 'b': 3, 'a': 'A'}),
+            (bv.Union(self.ns.V), ('t10',), {'.tag': 't10', 't10': ['t0', {'.tag': 't2'}]}),
+            (bv.Union(self.ns.V), ('t10',), {'.tag': 't0'}),
+            (bv.Union(self.ns.V), ('t10',), {'.tag': 't9', 't9': ['a', 'b']}),
+        ]
+        for data_type, list_path, obj in cases:
+            expected = ss.json_decode(data_type, json.dumps(obj))
+            expected_items = expected
+            for key in list_path:
+                if isinstance(expected_items, bb.Union):
+                    expected_items = expected_items._value if expected_items._tag == key else None
+                else:
+                    expected_items = getattr(expected_items, key)
+            for data in (json.dumps(obj).encode('utf-8'), json.dumps(obj, indent=2),
+                         json.dumps(obj, ensure_ascii=False).encode('utf-8')):
+                for chunk_size in (1, 3, 1000):
+                    items, result = self._iterdecode(
+                        data_type, data, chunk_size, list_path=list_path)
+                    self.assertEqual(items, expected_items or [])
+                    if list_path:
+                        # The streamed list is left out of the result.
+                        obj_without_list = dict(obj)
+                        if list_path[0] in obj:
+                            obj_without_list[list_path[0]] = []
+                        self.assertEqual(
+                            result, ss.json_compat_obj_decode(data_type, obj_without_list))
+            self.assertEqual(
+                list(ss.json_iterdecode(data_type, [json.dumps(obj)], list_path=list_path)),
+                expected_items or [])
+
+        # The fields of a struct under a union tag are inlined in the object of the union.
+        w = bv.Union(self.ns.W)
+        obj = {'.tag': 'r', 'items': [{'f': 'x'}, {'f': 'y'}]}
+        for list_path in (['r', 'items'], ['n', 'items']):
+            obj['.tag'] = list_path[0]
+            for chunk_size in (1, 1000):
+                items, result = self._iterdecode(
+                    w, json.dumps(obj), chunk_size, list_path=list_path)
+                self.assertEqual(items, [self.ns.S(f='x'), self.ns.S(f='y')])
+                self.assertEqual(result, getattr(self.ns.W, list_path[0])(self.ns.R(items=[])))
+        # A list under another tag, or read before the '.tag' key, is left in the result.
+        items, result = self._iterdecode(
+            w, '{"items": [{"f": "x"}], ".tag": "r"}', 1, list_path=['r', 'items'])
+        self.assertEqual(items, [])
+        self.assertEqual(result, self.ns.W.r(self.ns.R(items=[self.ns.S(f='x')])))
+        items, result = self._iterdecode(
+            w, '{".tag": "n", "items": [{"f": "x"}]}', 1, list_path=['r', 'items'])
+        self.assertEqual(items, [])
+        self.assertEqual(result, self.ns.W.n(self.ns.R(items=[self.ns.S(f='x')])))
+        # Old-style unions keep the struct under the tag.
+        items, result = self._iterdecode(
+            w, '{"r": {"items": [{"f": "x"}]}}', 1, list_path=['r', 'items'], old_style=True)
+        self.assertEqual(items, [self.ns.S(f='x')])
+        self.assertEqual(result, self.ns.W.r(self.ns.R(items=[])))
+        with self.assertRaises(bv.ValidationError) as cm:
+            self._iterdecode(w, '{".tag": "r", "items": [{}]}', 1, list_path=['r', 'items'])
+        self.assertEqual("r.items: missing required field 'f'", str(cm.exception))
+
+        # Items of a nested list are validated like the rest of the document.
+        with self.assertRaises(bv.ValidationError) as cm:
+            self._iterdecode(bv.Struct(self.ns.D), b'{"a": "A", "d": [1, "x"]}', 2,
+                             list_path=['d'])
+        self.assertEqual("d: expected integer, got string", str(cm.exception))
+        with self.assertRaises(bv.ValidationError) as cm:
+            self._iterdecode(bv.Union(self.ns.V), b'{".tag": "t10", "t10": ["t3"]}', 2,
+                             list_path=['t10'])
+        self.assertEqual("t10: unknown tag 't3'", str(cm.exception))
+        with self.assertRaises(bv.ValidationError) as cm:
+            self._iterdecode(s_list, b'[{"f": "x"}, {"f": "x", "g": 1}]', 4, strict=True)
+        self.assertEqual("unknown field 'g'", str(cm.exception))
+
+        # Items are produced as soon as they are complete.
+        decoder = ss.StreamingJsonDecoder(s_list)
+        self.assertEqual(decoder.feed(b'[{"f": "a"}, {"f": "b'), [self.ns.S(f='a')])
+        self.assertEqual(decoder.feed(b'"}'), [self.ns.S(f='b')])
+        self.assertEqual(decoder.feed(b']'), [])
+        self.assertEqual(decoder.close(), [])
+        self.assertEqual(decoder.result, [])
+        # Numbers are not split across chunks.
+        decoder = ss.StreamingJsonDecoder(bv.List(bv.Int32()))
+        self.assertEqual(decoder.feed('[12'), [])
+        self.assertEqual(decoder.feed('3'), [])
+        self.assertEqual(decoder.feed(']'), [123])
+        # Including after a prefix that is a number itself.
+        for data in ('[1.5, -2.25e+3, 1E-2, 0]', '[1e3]'):
+            expected = json.loads(data)
+            for i in range(1, len(data)):
+                decoder = ss.StreamingJsonDecoder(bv.List(bv.Float64()))
+                items = decoder.feed(data[:i]) + decoder.feed(data[i:]) + decoder.close()
+                self.assertEqual(items, expected)
+
+        # The streamed list keeps its size constraints.
+        with self.assertRaises(bv.ValidationError) as cm:
+            self._iterdecode(bv.List(bv.Int32(), max_items=2), b'[1, 2, 3]', 1)
+        self.assertEqual('list has more than 2 items', str(cm.exception))
+        for data, expected in ((b'{"f1": [1]}', [1]), (b'{"f1": [1, 2]}', [1, 2])):
+            items, result = self._iterdecode(
+                bv.Nullable(bv.Struct(self._min_items_struct())), data, 1, list_path=['f1'])
+            self.assertEqual(items, expected)
+            self.assertEqual(result.f1, [1])
+        with self.assertRaises(bv.ValidationError) as cm:
+            self._iterdecode(bv.Struct(self._min_items_struct()), b'{"f1": []}', 1,
+                             list_path=['f1'])
+        self.assertEqual('f1: list has fewer than 1 items', str(cm.exception))
+
+        # Malformed input.
+        for data in (b'[1, 2', b'[1 2]', b'[1], 2', b'{"a": "A", "d": [1], "e": {}',
+                     b'[1, \xff]', b'', b'[1,]'):
+            with self.assertRaises(bv.ValidationError) as cm:
+                self._iterdecode(bv.List(bv.Int32()), data, 1)
+            self.assertEqual('could not decode input as JSON', str(cm.exception))
+        with self.assertRaises(bv.ValidationError) as cm:
+            self._iterdecode(bv.Struct(self.ns.D), b'{"a": "A", "d": [1], "e": {}', 1,
+                             list_path=['d'])
+        self.assertEqual('could not decode input as JSON', str(cm.exception))
+
+    def _min_items_struct(self):
+        class MinItems(object):
+            _all_field_names_ = {'f1'}
+            _all_fields_ = [('f1', bv.List(bv.Int64(), min_items=1))]
+
+            def __init__(self, f1=None):
+                self.f1 = f1
+
+        return MinItems
+
+    def test_streaming_decoder_async(self):
+        import asyncio
+
+        class Chunks(object):
+            def __init__(self, chunks):
+                self._chunks = iter(chunks)
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                await asyncio.sleep(0)
+                try:
+                    return next(self._chunks)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        async def collect(decoder, chunks):
+            return [item async for item in decoder.aiter_decode(Chunks(chunks))]
+
+        decoder = ss.StreamingJsonDecoder(bv.Struct(self.ns.D), ['d'])
+        loop = asyncio.new_event_loop()
+        try:
+            items = loop.run_until_complete(
+                collect(decoder, [b'{"a": "A", ', b'"d": [1, 2', b', 3], "e": {}}']))
+        finally:
+            loop.close()
+        self.assertEqual(items, [1, 2, 3])
+        self.assertEqual(decoder.result.a, 'A')
+
+    def test_list_and_map_members_validated_once(self):
+        validations = []
+
+        class CountingString(bv.String):
+            def validate(self, val):
+                validations.append(val)
+                return super().validate(val)
+
+        s = self.ns.S(f='x')
+        cases = [
+            (bv.List(CountingString()), ['a', 'b', 'c'], 3),
+            (bv.List(bv.List(CountingString(), max_items=2)), [['a', 'b'], [], ['c']], 3),
+            (bv.Map(CountingString(), bv.Nullable(bv.List(CountingString()))),
+             {'a': ['b'], 'c': None}, 3),
+            (bv.Map(bv.String(), bv.List(CountingString())), {'a': ['b'], 'c': ['d', 'e']}, 3),
+        ]
+        serializer = ss.StoneToPythonPrimitiveSerializer(None, None, False, False, False)
+        for validator, value, count in cases:
+            expected = json.loads(json.dumps(validator.validate(value)))
+            for encode in (lambda: json.loads(self.encode(validator, value)),
+                           lambda: json.loads(''.join(ss.json_iterencode(validator, value))),
+                           lambda: serializer.encode(validator, value)):
+                del validations[:]
+                self.assertEqual(encode(), expected)
+                self.assertEqual(len(validations), count)
+
+        # Members are still converted the way validate converts them.
+        validator = bv.Map(bv.String(), bv.List(bv.Float64()))
+        self.assertEqual(ss.json_encode(validator, {'a': [1, 2.5]}), '{"a": [1.0, 2.5]}')
+        self.assertEqual(''.join(ss.json_iterencode(validator, {'a': [1]})), '{"a": [1.0]}')
+        self.assertEqual(serializer.encode(validator, {'a': [1]}), {'a': [1.0]})
+        self.assertIs(type(serializer.encode(validator, {'a': [1]})['a'][0]), float)
+
+        # Errors are the same as validating the whole list first.
+        invalid = [
+            (bv.List(bv.String(max_length=1)), ['a', 'bc']),
+            (bv.List(bv.List(bv.Int32(), min_items=1)), [[1], []]),
+            (bv.List(bv.Struct(self.ns.S)), [s, self.ns.S()]),
+            (bv.List(bv.Struct(self.ns.S)), [s, self.ns.T(f='x')]),
+            (bv.List(bv.Union(self.ns.U)), [self.ns.U.t0, self.ns.V.t0]),
+            (bv.List(bv.Nullable(bv.Struct(self.ns.S))), [None, self.ns.S()]),
+            (bv.Map(bv.String(max_length=1), bv.Int32()), {'a': 1, 'bc': 2}),
+            (bv.Map(bv.String(), bv.List(bv.UInt32())), {'a': [1], 'b': [-1]}),
+            (bv.List(bv.Int32(), max_items=1), [1, 2]),
+        ]
+        for validator, value in invalid:
+            with self.assertRaises(bv.ValidationError) as cm:
+                validator.validate(value)
+            expected = str(cm.exception)
+            for encode in (lambda: self.encode(validator, value),
+                           lambda: ''.join(ss.json_iterencode(validator, value)),
+                           lambda: serializer.encode(validator, value)):
+                with self.assertRaises(bv.ValidationError) as cm:
+                    encode()
+                self.assertEqual(str(cm.exception), expected)
+
+    def test_decode_plans_match_decoder(self):
+        cases = [
+            (bv.Struct(self.ns.D), {'a': 'A', 'b': 1, 'c': None, 'd': [1, None], 'e': {}}),
+            (bv.Struct(self.ns.D), {'a': 'A', 'd': [], 'e': {}, 'z': 1}),
+            (bv.Struct(self.ns.D), {'a': 'A', 'd': ['x'], 'e': {}}),
+            (bv.Struct(self.ns.S2), {}),
+            (bv.Struct(self.ns.S3), {'u': 'x'}),
+            (bv.Union(self.ns.V), 't0'),
+            (bv.Union(self.ns.V), 't1'),
+            (bv.Union(self.ns.V), 'unknown'),
+            (bv.Union(self.ns.V), {'.tag': 't3', 'f': 'F'}),
+            (bv.Union(self.ns.V), {'.tag': 't4'}),
+            (bv.Union(self.ns.V), {'t4': None}),
+            (bv.Union(self.ns.V), {'.tag': 't5', 't5': 't1'}),
+            (bv.Union(self.ns.V), {'.tag': 't10', 't10': ['t0', {'.tag': 't1', 't1': 'a'}]}),
+            (bv.Union(self.ns.V), {'.tag': 't11', 't11': {'a': 1}, 'x': 2}),
+            (bv.Union(self.ns.V), {'.tag': 'other', 'other': None}),
+            (bv.Union(self.ns.V), {'t1': 'a'}),
+            (bv.Union(self.ns.V), ['t0']),
+            (bv.Union(self.ns.UOpen), {'.tag': 't3', 't3': 1}),
+            (bv.StructTree(self.ns.Resource), {'.tag': 'file', 'name': 'n', 'size': 1}),
+            (bv.StructTree(self.ns.Resource), {'.tag': 'folder', 'name': 'n'}),
+            (bv.StructTree(self.ns.Resource), {'.tag': 'other', 'name': 'n'}),
+            (bv.StructTree(self.ns.ResourceLax), {'.tag': 'other', 'name': 'n'}),
+            (bv.StructTree(self.ns.Resource), {'.tag': 1}),
+            (bv.List(bv.Nullable(bv.Struct(self.ns.S))), [{'f': 'a'}, None]),
+            (bv.Map(bv.String(), bv.Union(self.ns.U)), {'a': 't0', 'b': {'.tag': 't2'}}),
+            (bv.Timestamp('%Y-%m-%dT%H:%M:%SZ'), '2015-05-12T15:50:38Z'),
+            (bv.Timestamp('%Y-%m-%dT%H:%M:%SZ'), 'garbage'),
+            (bv.Bytes(), 'AAE='),
+            (bv.UInt32(), -1),
+            (bv.Void(), 1),
+        ]
+
+        for strict in (True, False):
+            for old_style in (True, False):
+                for data_type, obj in cases:
+                    decoder = ss.PythonPrimitiveToStoneDecoder(
+                        None, None, False, old_style, strict)
+                    try:
+                        if isinstance(data_type, bv.Primitive):
+                            expected = decoder.make_stone_friendly(data_type, obj, True)
+                        else:
+                            expected = decoder.json_compat_obj_decode_helper(data_type, obj)
+                    except bv.ValidationError as e:
+                        with self.assertRaises(bv.ValidationError) as cm:
+                            self.compat_obj_decode(
+                                data_type, obj, strict=strict, old_style=old_style)
+                        self.assertEqual(str(e), str(cm.exception))
+                        continue
+
+                    # Decode twice so that the cached plan is exercised as well.
+                    for _ in range(2):
+                        self.assertEqual(
+                            self.compat_obj_decode(
+                                data_type, obj, strict=strict, old_style=old_style),
+                            expected)
+
+    def test_pickle_and_copy(self):
+        d = self.ns.D(a='A', d=[1, None], e={'k': None})
+        c = self.ns.C(a='A', b=1, c=b'c', d=1.5)
+        v = self.ns.V.t4(self.ns.S(f='F'))
+        v.extra = 1
+        objs = [d, c, v, self.ns.V.t0, self.ns.U.t1('x')]
+
+        copies = {
+            'pickle': lambda o: pickle.loads(pickle.dumps(o, pickle.HIGHEST_PROTOCOL)),
+            'pickle protocol 0': lambda o: pickle.loads(pickle.dumps(o, 0)),
+            'copy': copy.copy,
+            'deepcopy': copy.deepcopy,
+        }
+        # Values aren't validated again.
+        with mock.patch.object(bv.String, 'validate', side_effect=AssertionError), \
+                mock.patch.object(bv.Struct, 'validate_type_only', side_effect=AssertionError):
+            for name, make_copy in copies.items():
+                for obj in objs:
+                    obj2 = make_copy(obj)
+                    self.assertIsNot(obj2, obj, name)
+                    self.assertIs(type(obj2), type(obj), name)
+                    self.assertEqual(obj2, obj, name)
+                d2 = make_copy(d)
+                self.assertIs(d2._c_value, bb.NOT_SET, name)
+                self.assertIsNone(d2.c, name)
+                self.assertEqual(d2.b, 10, name)
+                self.assertEqual(make_copy(v).extra, 1, name)
+
+        # Shallow copies share values and deep copies don't.
+        self.assertIs(copy.copy(d).d, d.d)
+        self.assertIsNot(copy.deepcopy(d).d, d.d)
+        self.assertIs(copy.copy(v).get_t4(), v.get_t4())
+        self.assertIsNot(copy.deepcopy(v).get_t4(), v.get_t4())
+        d_list = copy.deepcopy([d, d])
+        self.assertIs(d_list[0], d_list[1])
+
+        # Slot names are pickled once per class.
+        state = d.__getstate__()
+        self.assertIs(state[0], self.ns.D(a='B', d=[], e={}).__getstate__()[0])
+        self.assertEqual(
+            state, (('_a_value', '_b_value', '_c_value', '_d_value', '_e_value'),
+                    ('A', bb.NOT_SET, bb.NOT_SET, [1, None], {'k': None})))
+
+        # State pickled by earlier versions, through copyreg
+        d2 = self.ns.D.__new__(self.ns.D)
+        d2.__setstate__((None, {'_a_value': 'A', '_b_value': bb.NOT_SET, '_c_value': bb.NOT_SET,
+                                '_d_value': [1, None], '_e_value': {'k': None}}))
+        self.assertEqual(d2, d)
+        u = self.ns.U.__new__(self.ns.U)
+        u.__setstate__(({'extra': 1}, {'_tag': 't1', '_value': 'x'}))
+        self.assertEqual(u, self.ns.U.t1('x'))
+        self.assertEqual(u.extra, 1)
+
+class TestGeneratedPythonWithSerializers(TestGeneratedPython):
+    """
+    Runs the same tests against types generated with --generate-serializers, which
+    json_encode() and json_decode() use for the default options.
+    """
+
+    package = 'output_serializers'
+    backend_args = ('--generate-serializers',)
+
+    def test_generated_serializers_are_used(self):
+        self.assertIn('_to_json_compat', vars(self.ns.A))
+        self.assertIn('_from_json_compat', vars(self.ns.U))
+
+        a = self.ns.A(a='A', b=1)
+        self.assertEqual(a._to_json_compat(), {'a': 'A', 'b': 1})
+        self.assertEqual(self.ns.A._from_json_compat({'a': 'A', 'b': 1}, True), a)
+        self.assertEqual(self.compat_obj_encode(bv.Struct(self.ns.A), a), {'a': 'A', 'b': 1})
+
+        # Options the generated functions don't implement fall back to the generic code.
+        self.assertEqual(
+            self.compat_obj_encode(bv.Union(self.ns.U), self.ns.U.t0, old_style=True), 't0')
+        self.assertEqual(
+            self.compat_obj_decode(bv.Union(self.ns.U), {'t0': None}, old_style=True),
+            self.ns.U.t0)
+
+    def test_generated_serializers_match_generic(self):
+        s = self.ns.S(f='x')
+        cases = [
+            (bv.Struct(self.ns.D), self.ns.D(a='A', b=1, c=None, d=[1, None], e={}), None),
+            (bv.Struct(self.ns.D), None, {'a': 'A', 'd': [], 'e': {'k': [1]}, 'z': 1}),
+            (bv.Struct(self.ns.D), None, {'a': 'A', 'd': ['x'], 'e': {}}),
+            (bv.Struct(self.ns.D), None, {'d': [], 'e': {}}),
+            (bv.Struct(self.ns.S2), self.ns.S2(), {}),
+            (bv.Struct(self.ns.S2), None, None),
+            (bv.Struct(self.ns.S3), None, {'u': 'x'}),
+            (bv.Union(self.ns.V), self.ns.V.t0, 't0'),
+            (bv.Union(self.ns.V), self.ns.V.t3(s), {'.tag': 't3', 'f': 'F'}),
+            (bv.Union(self.ns.V), self.ns.V.t4(None), {'.tag': 't4'}),
+            (bv.Union(self.ns.V), None, 't1'),
+            (bv.Union(self.ns.V), None, 'unknown'),
+            (bv.Union(self.ns.V), None, {'.tag': 't4', 'f': 'F', 'x': 1}),
+            (bv.Union(self.ns.V), None, {'.tag': 't5', 't5': 't1'}),
+            (bv.Union(self.ns.V), None, {'.tag': 't10', 't10': ['t0', {'.tag': 't1', 't1': 'a'}]}),
+            (bv.Union(self.ns.V), None, {'.tag': 't11', 't11': {'a': 1}, 'x': 2}),
+            (bv.Union(self.ns.V), None, {'.tag': 'other', 'other': None}),
+            (bv.Union(self.ns.V), None, {'.tag': 't0', 't0': 1}),
+            (bv.Union(self.ns.V), None, ['t0']),
+            (bv.Union(self.ns.UOpen), None, {'.tag': 't3', 't3': 1}),
+            (bv.StructTree(self.ns.Resource), self.ns.File(name='n', size=1),
+             {'.tag': 'file', 'name': 'n', 'size': 1}),
+            (bv.StructTree(self.ns.Resource), self.ns.File(name='n'),
+             {'.tag': 'folder', 'name': 'n'}),
+            (bv.StructTree(self.ns.Resource), None, {'.tag': 'other', 'name': 'n'}),
+            (bv.StructTree(self.ns.ResourceLax), None, {'.tag': 'other', 'name': 'n'}),
+            (bv.StructTree(self.ns.Resource), None, {'.tag': 1}),
+            (bv.List(bv.Nullable(bv.Struct(self.ns.S))), [s, None], [{'f': 'a'}, None]),
+        ]
+
+        for strict in (True, False):
+            for data_type, value, obj in cases:
+                if value is not None:
+                    serializer = ss.StoneToPythonPrimitiveSerializer(
+                        None, None, False, False, False)
+                    self._assert_same_result(
+                        lambda: serializer.encode(data_type, value),
+                        lambda: self.compat_obj_encode(data_type, value))
+                if obj is not None or isinstance(data_type, bv.Struct):
+                    decoder = ss.PythonPrimitiveToStoneDecoder(None, None, False, False, strict)
+                    self._assert_same_result(
+                        lambda: decoder.json_compat_obj_decode_helper(data_type, obj),
+                        lambda: self.compat_obj_decode(data_type, obj, strict=strict))
+
+    def _assert_same_result(self, expected_f, actual_f):
+        try:
+            expected = expected_f()
+        except bv.ValidationError as e:
+            with self.assertRaises(bv.ValidationError) as cm:
+                actual_f()
+            self.assertEqual(str(e), str(cm.exception))
+        else:
+            self.assertEqual(actual_f(), expected)
+
+class TestGeneratedPythonWithSharedValidators(TestGeneratedPython):
+    """
+    Runs the same tests against types generated with --shared-validators, which share the
+    validators that don't refer to user-defined types between namespaces.
+    """
+
+    package = 'output_shared_validators'
+    backend_args = ('--shared-validators',)
+
+    def test_validators_are_shared_between_modules(self):
+        self.assertIs(self.ns.A.b.validator, self.ns2.BaseS.z.validator)
+        self.assertIs(self.ns.V._t1_validator, self.ns2.BaseU._x_validator)
+        self.assertIs(self.ns.ContainsAlias.s.validator, self.ns.AliasedString_validator)
+
+class TestGeneratedPythonWithLazyImports(TestGeneratedPython):
+    """
+    Runs the same tests against types generated with --lazy-imports, whose package and
+    namespace modules import namespaces when they're first used.
+    """
+
+    package = 'output_lazy_imports'
+    backend_args = ('--lazy-imports',)
+
+    def test_lazy_imports(self):
+        script = textwrap.dedent("""\
+            import sys
+            import {0}
+            assert '{0}.ns' not in sys.modules and '{0}.ns2' not in sys.modules
+            assert {{'ns', 'ns2'}} <= set(dir({0}))
+            assert {0}.ns2.BaseS(z=1).z == 1
+            assert '{0}.ns' not in sys.modules
+            assert {0}.ns.ImportTestS(a='a', z=1).z == 1
+            try:
+                {0}.ns3
+            except AttributeError:
+                pass
+            else:
+                raise AssertionError('expected AttributeError')
+        """).format(self.package)
+        subprocess.check_call([sys.executable, '-c', script])
+
+    def test_lazy_references(self):
+        # Importing a namespace alone leaves the namespaces it refers to unloaded, until a
+        # validator or route that uses them is first needed.
+        package = 'output_lazy_references'
+        p = subprocess.Popen(
+            [sys.executable, '-m', 'stone.cli', 'python_types', package, '-', '--',
+             '--package', package, '--lazy-imports', '--deferred-wiring'],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        _, stderr = p.communicate(input=test_lazy_references_spec.encode('utf-8'))
+        if p.wait() != 0:
+            raise AssertionError('Could not execute stone tool: %s' %
+                                 stderr.decode('utf-8'))
+        self.addCleanup(shutil.rmtree, package)
+        script = textwrap.dedent("""\
+            import sys
+            from stone.backends.python_rsrc import stone_serializers as ss
+            from {0} import a
+
+            def loaded():
+                return type(sys.modules['{0}.b']).__name__ != '_LazyModule'
+
+            assert not loaded()
+            assert a.s.name == 's' and a.s.arg_type.definition is a.Rec and not loaded()
+            assert a.Rec._all_field_names_ == {{'y', 'n'}} and loaded()
+            assert a.r.arg_type.definition is sys.modules['{0}.b'].Y
+            assert a.r.error_type.definition is sys.modules['{0}.b'].E
+            rec = ss.json_decode(a.r.result_type, '{{"y": {{"f": "x"}}}}')
+            assert rec.y.f == 'x' and rec.n is None
+        """).format(package)
+        subprocess.check_call([sys.executable, '-c', script])
+
+
+test_lazy_references_spec = """\
+namespace a
+
+import b
+
+struct Rec
+    y b.Y
+    n b.Y?
+
+route r(b.Y, Rec, b.E)
+route s(Rec, Void, Void)
+
+namespace b
+
+struct Y
+    f String
+
+union E
+    x
+"""
+
+
+class TestGeneratedPythonWithDeferredWiring(TestGeneratedPython):
+    """
+    Runs the same tests against types generated with --deferred-wiring, whose reflection
+    attributes are assigned when each class is first used.
+    """
+
+    package = 'output_deferred_wiring'
+    backend_args = ('--deferred-wiring',)
+
+    def test_deferred_wiring(self):
+        script = textwrap.dedent("""\
+            import pickle
+            import sys
+            from stone.backends.python_rsrc import stone_base as bb
+            from stone.backends.python_rsrc import stone_serializers as ss
+            from stone.backends.python_rsrc import stone_validators as bv
+            from {0} import ns
+
+            def is_wired(cls):
+                # Wiring removes the attribute triggers and the __setstate__ trampoline.
+                return not any(isinstance(value, bb._WiredAttribute)
+                               for value in vars(cls).values()) and '__setstate__' not in vars(cls)
+
+            assert not is_wired(ns.A) and not is_wired(ns.U)
+            # Reading a field wires the class, which sets the validators and defaults of fields.
+            assert isinstance(ns.A.a.validator, bv.String)
+            assert is_wired(ns.A) and not is_wired(ns.B)
+            assert ns.E.a.default == 'test' and is_wired(ns.E)
+            # So does reading a reflection attribute, also through a subclass, or instantiating
+            # the class.
+            assert ns.C._all_field_names_ == {{'a', 'b', 'c', 'd'}}
+            assert is_wired(ns.B) and is_wired(ns.C)
+            assert ns.Folder(name='n').name == 'n' and is_wired(ns.Folder)
+            assert ns.U.t0 == ns.U('t0') and is_wired(ns.U)
+            assert ss.json_decode(bv.Union(ns.V), '"t0"') == ns.V.t0
+            # Unpickling in a new process instantiates without __init__.
+            assert not is_wired(ns.D)
+            pickle.loads(sys.stdin.buffer.read())
+            assert is_wired(ns.D)
+        """).format(self.package)
+        p = subprocess.Popen([sys.executable, '-c', script], stdin=subprocess.PIPE)
+        p.communicate(pickle.dumps(self.ns.D(a='a', d=[], e={})))
+        self.assertEqual(p.wait(), 0)
+
+    def test_failed_wiring(self):
+        class Rec(bb.Struct):
+            __slots__ = ('_x_value',)
+            x = bb.Attribute('x')
+
+        calls = []
+
+        def wire():
+            calls.append(None)
+            Rec.x.validator = bv.String()
+            if len(calls) == 1:
+                raise RuntimeError('wiring failed')
+            Rec._all_field_names_ = {'x'}
+
+        bb.defer_wiring(Rec, wire, ['_all_field_names_', 'x'])
+        with self.assertRaises(RuntimeError):
+            Rec._all_field_names_  # pylint: disable=pointless-statement
+        # Wiring is tried again rather than leaving the class with the attributes of bb.Struct,
+        # or with fields that are only partly wired.
+        self.assertIsInstance(vars(Rec)['x'], bb._WiredAttribute)
+        self.assertIsInstance(Rec.x, bb.Attribute)
+        self.assertEqual(Rec._all_field_names_, {'x'})
+        self.assertEqual(len(calls), 2)
+        self.assertNotIn('__setstate__', vars(Rec))
+
+class TestGeneratedPythonWithSlotFields(TestGeneratedPython):
+    """
+    Runs the same tests against types generated with --slot-fields, whose fields are read
+    directly from their slots.
+    """
+
+    package = 'output_slot_fields'
+    backend_args = ('--slot-fields',)
+
+    def test_slot_fields(self):
+        self.assertIsInstance(self.ns.A.a, bb.SlotAttribute)
+        self.assertTrue(issubclass(self.ns.A, bb.SlotStruct))
+
+        # Unset fields leave their slot empty, but read as with bb.Attribute.
+        e = self.ns.E()
+        self.assertEqual(e.a, 'test')
+        self.assertEqual(e.b, 10)
+        self.assertIsNone(e.c)
+        self.assertIs(e._c_value, bb.NOT_SET)
+        a = self.ns.A(a='A')
+        with self.assertRaises(AttributeError) as cm:
+            a.b  # pylint: disable=pointless-statement
+        self.assertEqual(str(cm.exception), "missing required field 'b'")
+        self.assertFalse(hasattr(a, 'b'))
+        with self.assertRaises(AttributeError):
+            a.z  # pylint: disable=pointless-statement
+        with self.assertRaises(AttributeError):
+            a._z_value  # pylint: disable=pointless-statement
+
+        # Values are validated on write.
+        with self.assertRaises(bv.ValidationError):
+            a.b = 'x'
+        a.b = 1
+        self.assertEqual(a.b, 1)
+        e.c = 2
+        e.c = None
+        self.assertIs(e._c_value, bb.NOT_SET)
+        del a.b
+        del a.b
+        self.assertFalse(hasattr(a, 'b'))
+        self.assertEqual(repr(a), "A(a='A', b=NOT_SET)")
+
+        # Pickling and copying keep unset fields unset.
+        e2 = pickle.loads(pickle.dumps(e))
+        self.assertIs(e2.c, None)
+        self.assertEqual(copy.copy(e2), e)
+
+    def test_lazy_decode(self):
+        # Fields are read directly from their slots, which can't hold a bb.LazyValue, so lazy
+        # decoding falls back to decoding in full.
+        validator = bv.Struct(self.ns.Metadata)
+        obj = {'name': 'a', 's': {'f': 'x'}, 'parent': {'name': 'b', 's': {}}}
+        with self.assertRaises(bv.ValidationError) as cm:
+            self.compat_obj_decode(validator, obj, lazy=True)
+        self.assertEqual(str(cm.exception), "parent.s: missing required field 'f'")
+        obj['parent']['s']['f'] = 'y'
+        m = self.compat_obj_decode(validator, obj, lazy=True)
+        self.assertEqual(m._s_value, self.ns.S(f='x'))
+        self.assertEqual(m, self.compat_obj_decode(validator, obj))
+
 # Adapted from:
 # http://code.activestate.com/recipes/306860-proleptic-gregorian-dates-and-strftime-before-1900/
 # Make sure that the day names are in order from 0001/01/01 until
@@ -3382,6 +4851,271 @@ class TestAnnotationsGeneratedPython(unittest.TestCase):
             self.compat_obj_encode(bv.Union(self.ns3.U), ui,
                 caller_permissions=self.internal_and_alpha_cp, should_redact=True), json_data)
 
+    def _encode_plan_test_values(self):
+        bi = self.ns3.B(
+            a='A', b=1, c='C', d=[self.ns3.X(a='TEST-blot-TEST', b='TEST-hash-TEST')],
+            e={'e1': 'e2'}, f=self.ns3.X(a='TEST-blot-TEST', b='TEST-hash-TEST'), g=4, h='H',
+            x='X', y='Y')
+        fi = self.ns3.File(name='n', x=self.ns3.X(a='A', b='B'), size=10, y='Y')
+        values = [
+            (bv.Struct(self.ns3.B), bi),
+            (bv.StructTree(self.ns3.Resource), fi),
+            (bv.List(bv.Union(self.ns3.U)), [self.ns3.U.t0, self.ns3.U.t2([])]),
+            (bv.Nullable(bv.Union(self.ns3.U2)), self.ns3.U2.t1(['test_str'])),
+        ]
+        return values
+
+    def test_permissioned_field_tables(self):
+        cps = (self.default_cp, self.internal_cp, self.alpha_cp, self.internal_and_alpha_cp,
+               CallerPermissionsTest(['alpha', 'internal']))
+        for cp in cps:
+            for definition in (self.ns3.A, self.ns3.B, self.ns3.File):
+                fields = list(definition._all_fields_)
+                field_names = set(definition._all_field_names_)
+                for permission in cp.permissions:
+                    fields += getattr(definition, '_all_{}_fields_'.format(permission), [])
+                    field_names |= getattr(
+                        definition, '_all_{}_field_names_'.format(permission), set())
+                self.assertEqual(list(bv.permissioned_fields(definition, cp)), fields)
+                self.assertEqual(bv.permissioned_field_names(definition, cp), field_names)
+                # Tables are computed once per permissions.
+                self.assertIs(bv.permissioned_fields(definition, cp),
+                              bv.permissioned_fields(definition, CallerPermissionsTest(
+                                  list(cp.permissions))))
+
+            for definition in (self.ns3.U, self.ns3.UOpen):
+                tagmap = bv.permissioned_tagmap(definition, cp)
+                for tag in ('t0', 't1', 't2', 't3', 't4', 't5', 't6', 't_void', 'other'):
+                    present = tag in definition._tagmap or any(
+                        tag in getattr(definition, '_{}_tagmap'.format(permission), {})
+                        for permission in cp.permissions)
+                    self.assertEqual(definition._is_tag_present(tag, cp), present)
+                    self.assertEqual(tag in tagmap, present)
+                    if present:
+                        self.assertIs(definition._get_val_data_type(tag, cp), tagmap[tag])
+
+        self.assertEqual(sorted(bv.full_tagmap(self.ns3.UOpen)),
+                         ['other', 't0', 't1', 't2', 't3', 't4', 't5', 't6', 't_void'])
+        self.assertEqual(self.ns3.UOpen('t6', 'x').get_t6(), 'x')
+        with self.assertRaises(AssertionError):
+            self.ns3.UOpen('t7')
+
+        # Permissioned required fields are checked.
+        b = self.ns3.B(a='A', h='H', b=1.0, d=[], e={}, f=self.ns3.X(a='a', b='b'), g=1,
+                       x='X')
+        bv.Struct(self.ns3.B).validate_fields_only_with_permissions(b, self.internal_cp)
+        with self.assertRaises(bv.ValidationError) as cm:
+            bv.Struct(self.ns3.B).validate_fields_only_with_permissions(
+                b, self.internal_and_alpha_cp)
+        self.assertEqual("missing required field 'y'", str(cm.exception))
+
+    def test_encode_plans_match_serializer(self):
+        for cp in (self.default_cp, self.internal_cp, self.internal_and_alpha_cp):
+            for old_style in (False, True):
+                for should_redact in (False, True):
+                    for validator, value in self._encode_plan_test_values():
+                        serializer = ss.StoneToPythonPrimitiveSerializer(
+                            cp, None, False, old_style, should_redact)
+                        try:
+                            expected = serializer.encode(validator, value)
+                        except bv.ValidationError as e:
+                            with self.assertRaises(bv.ValidationError) as cm:
+                                self.compat_obj_encode(
+                                    validator, value, caller_permissions=cp,
+                                    old_style=old_style, should_redact=should_redact)
+                            self.assertEqual(str(e), str(cm.exception))
+                            continue
+
+                        # Encode twice so that the cached plan is exercised as well.
+                        for _ in range(2):
+                            self.assertEqual(
+                                self.compat_obj_encode(
+                                    validator, value, caller_permissions=cp,
+                                    old_style=old_style, should_redact=should_redact),
+                                expected)
+
+    def test_json_iterencode_matches_json_encode(self):
+        for cp in (self.default_cp, self.internal_cp, self.internal_and_alpha_cp):
+            for old_style in (False, True):
+                for should_redact in (False, True):
+                    for validator, value in self._encode_plan_test_values():
+                        kwargs = dict(caller_permissions=cp, old_style=old_style,
+                                      should_redact=should_redact)
+                        try:
+                            expected = self.encode(validator, value, **kwargs)
+                        except bv.ValidationError as e:
+                            with self.assertRaises(bv.ValidationError) as cm:
+                                ''.join(ss.json_iterencode(validator, value, **kwargs))
+                            self.assertEqual(str(e), str(cm.exception))
+                            continue
+
+                        self.assertEqual(
+                            ''.join(ss.json_iterencode(validator, value, chunk_size=1,
+                                                       **kwargs)),
+                            expected)
+
+    def test_transcode_matches_decode_and_encode(self):
+        ai = self.ns3.A(
+            a='A', b=1, c='C', d=[self.ns3.X(a='TEST-blot-TEST', b='TEST-hash-TEST')],
+            e={'e1': 'e2', 'e3': None}, f=self.ns3.X(a='a', b='b'), g=4)
+        values = self._encode_plan_test_values() + [
+            (bv.Struct(self.ns3.A), ai),
+            (bv.Union(self.ns3.U), self.ns3.U.t1('TEST-hash-TEST')),
+            (bv.Union(self.ns3.U), self.ns3.U.t_void),
+            (bv.Union(self.ns3.U), self.ns3.U.t3([self.ns3.X(a='a', b='b')])),
+            (bv.Union(self.ns3.UOpen), self.ns3.UOpen.t5('x')),
+            (bv.Union(self.ns3.UOpen), self.ns3.UOpen.t6('x')),
+            (bv.Struct(self.ns3.S2), self.ns3.S2(a=['a', 'b'], b={'c': 'd'})),
+            (bv.Union(self.ns3.U2), self.ns3.U2.t2({'c': 'd'})),
+        ]
+        all_cp = CallerPermissionsTest(['internal', 'alpha', 'test_void_field'])
+        cps = (self.default_cp, self.internal_cp, self.alpha_cp, self.internal_and_alpha_cp,
+               all_cp)
+        for validator, value in values:
+            for old_style in (False, True):
+                obj = self.compat_obj_encode(validator, value, old_style=old_style,
+                                             caller_permissions=all_cp)
+                for cp, output_cp in itertools.product(cps, cps):
+                    for output_old_style, should_redact in itertools.product(
+                            (False, True), (False, True)):
+                        try:
+                            expected = self.compat_obj_encode(
+                                validator,
+                                self.compat_obj_decode(validator, obj, caller_permissions=cp,
+                                                       old_style=old_style),
+                                caller_permissions=output_cp, old_style=output_old_style,
+                                should_redact=should_redact)
+                        except bv.ValidationError as e:
+                            with self.assertRaises(bv.ValidationError) as cm:
+                                ss.json_compat_obj_transcode(
+                                    validator, obj, caller_permissions=cp,
+                                    old_style=old_style, output_caller_permissions=output_cp,
+                                    output_old_style=output_old_style,
+                                    should_redact=should_redact)
+                            self.assertEqual(str(cm.exception), str(e))
+                            continue
+                        self.assertEqual(
+                            ss.json_compat_obj_transcode(
+                                validator, obj, caller_permissions=cp, old_style=old_style,
+                                output_caller_permissions=output_cp,
+                                output_old_style=output_old_style,
+                                should_redact=should_redact),
+                            expected)
+
+
+test_custom_annotations_spec = """\
+namespace ca
+
+annotation_type Sensitive
+    kind String = "pii"
+
+annotation_type Audited
+    owner String = "team"
+
+annotation Pii = Sensitive()
+annotation Audit = Audited()
+
+struct Leaf
+    secret String
+        @Pii
+    plain String
+
+struct Plain
+    a String
+
+struct Base
+    leaf Leaf?
+
+struct Root extends Base
+    leaves List(Leaf)
+    by_name Map(String, Leaf)
+    nested List(List(Leaf))
+    plains List(Plain)
+    choice Choice
+    note String
+        @Audit
+
+union Choice
+    leaf Leaf
+    plain Plain
+    text String
+        @Pii
+"""
+
+
+class TestCustomAnnotationsGeneratedPython(unittest.TestCase):
+
+    package = 'output_custom_annotations'
+
+    def setUp(self):
+        p = subprocess.Popen(
+            [sys.executable, '-m', 'stone.cli', 'python_types', self.package, '-', '--',
+             '--package', self.package],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        _, stderr = p.communicate(input=test_custom_annotations_spec.encode('utf-8'))
+        if p.wait() != 0:
+            raise AssertionError('Could not execute stone tool: %s' %
+                                 stderr.decode('utf-8'))
+        self.ca = importlib.import_module(self.package + '.ca')
+
+    def tearDown(self):
+        shutil.rmtree(self.package)
+
+    def test_custom_annotation_types(self):
+        ca = self.ca
+        self.assertEqual(ca.Leaf._custom_annotation_types_, frozenset([ca.Sensitive]))
+        self.assertEqual(ca.Plain._custom_annotation_types_, frozenset())
+        self.assertEqual(ca.Base._custom_annotation_types_, frozenset([ca.Sensitive]))
+        # Including the annotation types of the parent struct
+        self.assertEqual(ca.Root._custom_annotation_types_,
+                         frozenset([ca.Audited, ca.Sensitive]))
+        self.assertEqual(ca.Choice._custom_annotation_types_, frozenset([ca.Sensitive]))
+
+    def test_process_custom_annotations(self):
+        ca = self.ca
+
+        def leaf(i):
+            return ca.Leaf(secret='s{}'.format(i), plain='p')
+
+        root = ca.Root(leaf=leaf(0), leaves=[leaf(1), leaf(2)], by_name={'x': leaf(3)},
+                       nested=[[leaf(4)], []], plains=[ca.Plain(a='a')],
+                       choice=ca.Choice.leaf(leaf(5)), note='n')
+        calls = []
+
+        def processor(annotation, field_path, value):
+            calls.append((type(annotation), field_path, value))
+            return value.upper()
+
+        root._process_custom_annotations(ca.Sensitive, 'root', processor)
+        self.assertEqual(calls, [
+            (ca.Sensitive, 'root.leaf.secret', 's0'),
+            (ca.Sensitive, 'root.leaves[0].secret', 's1'),
+            (ca.Sensitive, 'root.leaves[1].secret', 's2'),
+            (ca.Sensitive, "root.by_name['x'].secret", 's3'),
+            (ca.Sensitive, 'root.nested[0][0].secret', 's4'),
+            (ca.Sensitive, 'root.choice.leaf.secret', 's5'),
+        ])
+        self.assertEqual([x.secret for x in root.leaves], ['S1', 'S2'])
+        self.assertEqual(root.by_name['x'].secret, 'S3')
+        self.assertEqual(root.nested[0][0].secret, 'S4')
+        self.assertEqual(root.choice.get_leaf().secret, 'S5')
+        self.assertEqual(root.note, 'n')
+
+        del calls[:]
+        root._process_custom_annotations(ca.Audited, 'root', processor)
+        self.assertEqual(calls, [(ca.Audited, 'root.note', 'n')])
+        self.assertEqual(root.note, 'N')
+
+        # Values whose class can't contain the annotation type aren't visited.
+        with mock.patch.object(ca.Plain, '_process_custom_annotations') as process:
+            bb.make_list_annotation_processor(
+                bb.make_pruning_struct_annotation_processor(ca.Sensitive, processor))(
+                    'plains', root.plains + [None])
+            bb.make_pruning_struct_annotation_processor(ca.Sensitive, processor)(
+                'plain', ca.Plain(a='a'))
+        process.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
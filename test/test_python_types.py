@@ -109,22 +109,25 @@ class TestGeneratedPythonTypes(unittest.TestCase):
         result = self._evaluate_namespace(ns)
 
         expected = textwrap.dedent("""\
+            _v0 = bv.Void()
+            _v1 = bv.Int32()
+
             alpha_get_metadata = bb.Route(
                 'alpha/get_metadata',
                 1,
                 False,
-                bv.Void(),
-                bv.Void(),
-                bv.Void(),
+                _v0,
+                _v0,
+                _v0,
                 {},
             )
             alpha_get_metadata_v2 = bb.Route(
                 'alpha/get_metadata',
                 2,
                 False,
-                bv.Void(),
-                bv.Int32(),
-                bv.Void(),
+                _v0,
+                _v1,
+                _v0,
                 {},
             )
 